@@ -0,0 +1,168 @@
+# Writes synthetic .mythrec files that recprocessor can parse, for benchmarking without real recorded games.
+# They have the l33t-zlib header at 0x10d, a BG hierarchy with an MP/ST metadata table using every key type parseMetadata handles,
+# J1/PL/BP/P1 player blocks and GM/GD/gd packed XMBs (including civs), padded out to whatever size is wanted.
+# Usage: python benchmarks/generate.py OUTPUT_FOLDER [--count N] [--players N] [--padding BYTES] [--extra-keys N] [--random-teams] [--unknown-gods]
+
+import argparse
+import os
+import random
+import struct
+import typing
+import zlib
+
+LOW_ENTROPY_BYTES = bytes(x % 16 for x in range(256))
+MAP_NAMES = ["giza", "alfheim", "mediterranean", "oasis", "tundra", "jotunheim", "ghost_lake", "elysium"]
+
+def packInt32(value: int) -> bytes:
+    return struct.pack("<i", value)
+
+def packUtf16(value: str) -> bytes:
+    return packInt32(len(value)) + value.encode("utf-16-le")
+
+def packNode(twoLetterCode: str, data: bytes) -> bytes:
+    return twoLetterCode.encode("ascii") + struct.pack("<I", len(data)) + data
+
+def packMetadataKey(name: str, keyType: int, value: typing.Any) -> bytes:
+    data = packUtf16(name) + packInt32(keyType)
+    if keyType in (1, 2):
+        data += packInt32(value)
+    elif keyType == 3:
+        data += bytes(8)
+    elif keyType == 4:
+        data += struct.pack("<h", value)
+    elif keyType == 6:
+        data += struct.pack("<?", value)
+    elif keyType == 10:
+        data += packUtf16(value)
+    else:
+        raise ValueError(f"Unsupported metadata key type {keyType}")
+    return data
+
+# An XMB element: (tag, text, attributes, children)
+XMBElement = typing.Tuple[str, str, typing.Dict[str, str], list]
+
+def packXMB(root: XMBElement) -> bytes:
+    elements: typing.List[str] = []
+    attributes: typing.List[str] = []
+    def collectNames(element: XMBElement):
+        tag, text, attribs, children = element
+        if tag not in elements:
+            elements.append(tag)
+        for attribName in attribs:
+            if attribName not in attributes:
+                attributes.append(attribName)
+        for child in children:
+            collectNames(child)
+    def packElement(element: XMBElement) -> bytes:
+        tag, text, attribs, children = element
+        data = b"XN" + bytes(4) + packUtf16(text) + packInt32(elements.index(tag)) + bytes(4) + packInt32(len(attribs))
+        for attribName, attribValue in attribs.items():
+            data += packInt32(attributes.index(attribName)) + packUtf16(attribValue)
+        data += packInt32(len(children))
+        return data + b"".join(packElement(child) for child in children)
+    collectNames(root)
+    body = b"XR" + packInt32(4) + packInt32(8)
+    body += packInt32(len(elements)) + b"".join(packUtf16(element) for element in elements)
+    body += packInt32(len(attributes)) + b"".join(packUtf16(attribute) for attribute in attributes)
+    body += packElement(root)
+    return b"X1" + packInt32(len(body)) + body
+
+def makeCivsXMB(numCivs: int) -> XMBElement:
+    return ("civs", "", {}, [("civ", "", {"id": str(civID)}, [("name", f"Civ{civID}", {}, []), ("culture", "Greek", {}, [])]) for civID in range(1, numCivs+1)])
+
+def makeFillerXMB(name: str, numElements: int) -> XMBElement:
+    return (name, "", {}, [("entry", f"value {x}", {"index": str(x), "flag": "true"}, []) for x in range(numElements)])
+
+def makeFillerKeys(prefix: str, count: int, rng: random.Random) -> typing.List[bytes]:
+    "Metadata keys nothing reads, of the types real recorded games have most of"
+    keys = []
+    for x in range(count):
+        keyType = (2, 10, 6, 1)[x % 4]
+        value = {2: rng.randrange(100000), 10: f"value{rng.randrange(1000)}", 6: bool(x & 1), 1: 0}[keyType]
+        keys.append(packMetadataKey(f"{prefix}extra{x}", keyType, value))
+    return keys
+
+def makeRecBody(players: typing.List[typing.Tuple[str, int, int]], mapName: str, paddingBytes: int, numFillerXMBs: int, version: str, rng: random.Random, extraKeys=0) -> bytes:
+    "Decompressed recorded game data for players given as (name, metadata team id, civ id), with extraKeys unread metadata keys per player and for the game"
+    keys = [
+        packMetadataKey("gamenumplayers", 2, len(players)),
+        packMetadataKey("gamemapname", 10, mapName),
+        packMetadataKey("gameversion", 10, version),
+        packMetadataKey("gamesyncstate", 3, None),
+        packMetadataKey("gameplayer0rating", 1, 0),
+        packMetadataKey("gameunknownshort", 4, 0),
+        packMetadataKey("gameranked", 6, True),
+        packMetadataKey("gamelength", 2, rng.randrange(300, 3600)),
+    ]
+    keys += makeFillerKeys("game", extraKeys, rng)
+    for playerIndex, (name, team, civ) in enumerate(players, 1):
+        keys.append(packMetadataKey(f"gameplayer{playerIndex}name", 10, name))
+        keys.append(packMetadataKey(f"gameplayer{playerIndex}teamid", 2, team))
+        keys.append(packMetadataKey(f"gameplayer{playerIndex}civ", 2, civ))
+        keys.append(packMetadataKey(f"gameplayer{playerIndex}rating", 1, 0))
+        keys += makeFillerKeys(f"gameplayer{playerIndex}", extraKeys, rng)
+    metadata = bytes(4) + packInt32(len(keys)) + b"".join(keys)
+
+    # Mother nature first, then each player with their final team
+    playerBlocks = [packNode("P1", bytes(8))]
+    for playerIndex, (name, team, civ) in enumerate(players, 1):
+        finalTeam = team if team != -1 else 1 + (playerIndex-1) % 2
+        playerBlocks.append(packNode("P1", packInt32(playerIndex) + b"\0" + packUtf16(name) + bytes(9) + packUtf16(name) + packInt32(finalTeam)))
+
+    packedFiles = [("civs", packXMB(makeCivsXMB(max(32, max(civ for name, team, civ in players)))))]
+    for x in range(numFillerXMBs):
+        packedFiles.append((f"filler{x}", packXMB(makeFillerXMB(f"filler{x}", 50))))
+    gd = b"\0" + struct.pack("<I", len(packedFiles))
+    for name, data in packedFiles:
+        gd += packUtf16(name) + packUtf16(name) + data
+
+    # The rest of a real recorded game, which nothing here reads
+    # Low entropy so it compresses roughly as well as real game data does
+    padding = rng.randbytes(paddingBytes).translate(LOW_ENTROPY_BYTES)
+    children = [
+        packNode("MP", packNode("ST", metadata)),
+        packNode("J1", packNode("PL", packNode("BP", b"".join(playerBlocks)))),
+        packNode("GM", packNode("GD", packNode("gd", gd))),
+        packNode("ZZ", padding),
+    ]
+    return packNode("BG", b"".join(children))
+
+def writeRec(filepath: str, body: bytes):
+    compressed = zlib.compress(body, 6)
+    with open(filepath, "wb") as f:
+        f.write(bytes(0x10d) + packInt32(len(compressed)) + b"l33t" + packInt32(len(body)) + compressed)
+
+def generate(outputFolder: str, count=1, numPlayers=2, paddingBytes=1024*1024, randomTeams=False, unknownGods=False, numFillerXMBs=20, seed=0, extraKeys=0) -> typing.List[str]:
+    "Write count recorded games into outputFolder, returning their paths"
+    rng = random.Random(seed)
+    os.makedirs(outputFolder, exist_ok=True)
+    paths = []
+    for index in range(count):
+        players = []
+        for playerIndex in range(1, numPlayers+1):
+            civ = rng.randrange(20, 30) if unknownGods else rng.randrange(1, 14)
+            team = -1 if randomTeams else 1 + (playerIndex-1) % 2
+            players.append((f"Player{rng.randrange(1000)}", team, civ))
+        body = makeRecBody(players, rng.choice(MAP_NAMES), paddingBytes, numFillerXMBs, "1.0.0", rng, extraKeys)
+        filepath = os.path.join(outputFolder, f"Record Game {index:05d}.mythrec")
+        writeRec(filepath, body)
+        paths.append(filepath)
+    return paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic recorded games")
+    parser.add_argument("output")
+    parser.add_argument("--count", type=int, default=1)
+    parser.add_argument("--players", type=int, default=2)
+    parser.add_argument("--padding", type=int, default=1024*1024, help="bytes of unparsed data after the header containers")
+    parser.add_argument("--filler-xmbs", type=int, default=20, help="packed XMBs besides civs")
+    parser.add_argument("--random-teams", action="store_true", help="leave team ids as -1 so the player blocks have to be read")
+    parser.add_argument("--unknown-gods", action="store_true", help="use civ ids not in the ini so the packed civs XMB has to be read")
+    parser.add_argument("--extra-keys", type=int, default=0, help="unread metadata keys per player, and for the game as a whole")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    paths = generate(args.output, args.count, args.players, args.padding, args.random_teams, args.unknown_gods, args.filler_xmbs, args.seed, args.extra_keys)
+    print(f"Wrote {len(paths)} recorded games to {args.output}")
+
+if __name__ == "__main__":
+    main()
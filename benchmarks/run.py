@@ -0,0 +1,111 @@
+# Times each stage of processing a recorded game on synthetic files from generate.py, to catch regressions locally.
+# Single file: decompression, tryParsingHierarchy, iterRecNodes, parseMetadata/parseRenameMetadata, parseXMB and the renamer's name building, each on its own.
+# Folder: the whole of processFile (including renaming) over a folder of many files.
+# Usage: python benchmarks/run.py [--repeat N] [--folder-count N] [--players N] [--padding BYTES] [--extra-keys N] [--random-teams] [--unknown-gods]
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import recmemory
+import recprocessor
+import generate
+
+def formatRSS() -> str:
+    peak = recmemory.peakRSSMB()
+    return "n/a" if peak is None else f"{peak:.1f} MB"
+
+def setUpConfig():
+    recprocessor.config.read(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recprocessor.ini"), snapshot=False)
+    # Benchmark the work itself, not the log or cache files
+    recprocessor.config.set("development", "Log", "0")
+    recprocessor.config.set("cache", "Cache", "0")
+    for option in ("OutputDecompressed", "OutputJson", "OutputXmb"):
+        recprocessor.config.set("development", option, "0")
+
+def timeStage(name: str, repeat: int, function: typing.Callable[[], typing.Any], bytesPerCall: int) -> float:
+    function()
+    start = time.perf_counter()
+    for x in range(repeat):
+        function()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"  {name:<38} {elapsed*1000:9.3f} ms  {bytesPerCall/elapsed/1024/1024 if elapsed > 0 else 0:9.1f} MB/s")
+    return elapsed
+
+def decompress(filepath: str, streaming=False) -> recprocessor.StreamingDecompressor:
+    with open(filepath, "rb") as f:
+        return recprocessor.decompressl33tZlib(f, recprocessor.RECORDED_GAME_MAX_DECOMPRESS_SIZE, streaming=streaming)
+
+def benchmarkSingleFile(filepath: str, repeat: int):
+    decompressed = decompress(filepath)
+    compressedSize = os.path.getsize(filepath)
+    size = decompressed.length
+    print(f"Single file: {compressedSize/1024:.0f} KB compressed, {size/1024:.0f} KB decompressed, {repeat} repeats")
+    timeStage("decompressl33tZlib (all)", repeat, lambda: decompress(filepath), size)
+    def parseEager():
+        decompressed.seek(0)
+        return recprocessor.tryParsingHierarchy(decompressed)
+    timeStage("tryParsingHierarchy (eager)", repeat, parseEager, size)
+    def parseLazy():
+        stream = decompress(filepath, streaming=True)
+        return recprocessor.tryParsingHierarchy(stream, stopAfter=["MP"], lazy=True)
+    timeStage("streaming + lazy tryParsingHierarchy", repeat, parseLazy, size)
+    timeStage("iterRecNodes (every node)", repeat, lambda: sum(1 for node in recprocessor.iterRecNodes(filepath)), size)
+    hierarchy = parseEager()
+    timeStage("parseMetadata (all keys)", repeat, lambda: recprocessor.parseMetadata(hierarchy), size)
+    timeStage("parseRenameMetadata", repeat, lambda: recprocessor.parseRenameMetadata(hierarchy), size)
+    timeStage("parseXMB (all)", repeat, lambda: recprocessor.parseXMB(filepath, hierarchy), size)
+    timeStage("parseXMB (civs only)", repeat, lambda: recprocessor.parseXMB(filepath, hierarchy, only={"civs"}), size)
+    metadata = recprocessor.parseRenameMetadata(hierarchy)
+    def buildName():
+        # Without remembered civ tables, so unknown gods are looked up in the file every time
+        recprocessor.civTables.clear()
+        info = recprocessor.RecInfo(metadata, *recprocessor.resolveTeams(filepath, metadata, hierarchy))
+        return recprocessor.buildRecName(filepath, info)
+    timeStage("renameRec (name only)", repeat, buildName, size)
+    timeStage("processFile (no rename)", repeat, lambda: recprocessor.readRecInfo(filepath), size)
+
+def benchmarkFolder(folder: str, paths: typing.List[str]):
+    totalSize = sum(os.path.getsize(path) for path in paths)
+    start = time.perf_counter()
+    cpuStart = time.process_time()
+    for path in paths:
+        recprocessor.processFile(path)
+    recprocessor.applyRenames()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpuStart
+    renamed = sum(1 for file in os.listdir(folder) if file.endswith("_.mythrec"))
+    print(f"Folder: {len(paths)} files, {totalSize/1024/1024:.1f} MB compressed")
+    print(f"  {'processFile + rename':<38} {elapsed:9.3f} s   {len(paths)/elapsed:9.1f} files/s  {totalSize/elapsed/1024/1024:9.1f} MB/s  cpu {cpu:.3f} s  renamed {renamed}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark recprocessor stages on synthetic recorded games")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--folder-count", type=int, default=10000, help="files in the folder benchmark, 0 to skip it")
+    parser.add_argument("--players", type=int, default=4)
+    parser.add_argument("--padding", type=int, default=4*1024*1024, help="unparsed bytes per file in the single file benchmark")
+    parser.add_argument("--folder-padding", type=int, default=64*1024, help="unparsed bytes per file in the folder benchmark")
+    parser.add_argument("--extra-keys", type=int, default=40, help="unread metadata keys per player and for the game, real recorded games have lots")
+    parser.add_argument("--random-teams", action="store_true")
+    parser.add_argument("--unknown-gods", action="store_true")
+    args = parser.parse_args()
+    setUpConfig()
+    workDir = tempfile.mkdtemp(prefix="recprocessor-bench-")
+    try:
+        single = generate.generate(os.path.join(workDir, "single"), 1, args.players, args.padding, args.random_teams, args.unknown_gods, extraKeys=args.extra_keys)
+        benchmarkSingleFile(single[0], args.repeat)
+        if args.folder_count > 0:
+            folder = os.path.join(workDir, "folder")
+            paths = generate.generate(folder, args.folder_count, args.players, args.folder_padding, args.random_teams, args.unknown_gods, seed=1, extraKeys=args.extra_keys)
+            benchmarkFolder(folder, paths)
+    finally:
+        shutil.rmtree(workDir)
+    print(f"Peak RSS: {formatRSS()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# Microbenchmark for scanForSensibleTwoLetterCodeAndLength on badly aligned data.
+# Compares against the previous byte-at-a-time implementation, and checks both give the same answers first.
+# Usage: python benchmarks/scan.py [number of scans]
+
+import os
+import random
+import struct
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import recprocessor
+
+def legacyScan(stream, maxDataLength=None):
+    "The original implementation, kept here as the reference to compare against"
+    unk = b""
+    for x in range(0, recprocessor.SCAN_MAXIMUM):
+        bad = False
+        thisTwoLetterCode = "\x00\x00"
+        try:
+            thisTwoLetterCode = stream.read(2).decode("ascii")
+        except Exception:
+            bad = True
+        for char in thisTwoLetterCode:
+            if ord(char) < 32:
+                bad = True
+                break
+        thisLength = struct.unpack("<I", stream.read(4))[0]
+        if maxDataLength is not None and thisLength > maxDataLength:
+            bad = True
+        if bad:
+            stream.seek(stream.tell() - 6)
+            unk += stream.read(1)
+            continue
+        return (thisTwoLetterCode, thisLength, unk)
+    msg = f"Failed to find sensible two letter code and length at {stream.tell()}"
+    stream.seek(stream.tell()-recprocessor.SCAN_MAXIMUM)
+    raise recprocessor.ScanFailureError(msg)
+
+def makeCases(count: int, seed=1):
+    "Buffers with a code and length after a random amount of junk, some too long or with no code at all"
+    rng = random.Random(seed)
+    cases = []
+    for x in range(count):
+        junk = bytes(rng.choice((0, 1, 0xff, 0x80, rng.randrange(256))) for y in range(rng.randrange(0, 60)))
+        code = bytes(rng.randrange(0x41, 0x5b) for y in range(2))
+        length = rng.choice((rng.randrange(0, 1000), rng.randrange(0, 2**32)))
+        data = junk + code + struct.pack("<I", length) + bytes(rng.randrange(256) for y in range(rng.randrange(0, 8)))
+        cases.append((data, rng.choice((None, 1000, 2**31))))
+    return cases
+
+def runScan(scan, data: bytes, maxDataLength):
+    stream = recprocessor.StreamingDecompressor(zlib.compress(data), len(data))
+    try:
+        result = scan(stream, maxDataLength)
+    except struct.error:
+        # Running out of data fails the whole file, so where the stream was left doesn't matter
+        return "struct.error", None
+    except recprocessor.ScanFailureError:
+        result = "ScanFailureError"
+    return result, stream.tell()
+
+def timeScan(scan, streams, maxDataLength=None) -> float:
+    start = time.perf_counter()
+    for stream in streams:
+        stream.seek(0)
+        try:
+            scan(stream, maxDataLength)
+        except recprocessor.ScanFailureError:
+            pass
+    return time.perf_counter() - start
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    mismatches = 0
+    for data, maxDataLength in makeCases(2000):
+        if runScan(legacyScan, data, maxDataLength) != runScan(recprocessor.scanForSensibleTwoLetterCodeAndLength, data, maxDataLength):
+            mismatches += 1
+    print(f"Checked 2000 cases against the old implementation: {mismatches} mismatches")
+    # Worst realistic case: a code right at the end of the scan window
+    data = bytes(recprocessor.SCAN_MAXIMUM - 1) + b"ST" + struct.pack("<I", 100) + bytes(100)
+    streams = [recprocessor.StreamingDecompressor(zlib.compress(data), len(data)) for x in range(count)]
+    for stream in streams:
+        stream.fill(None)
+    for name, scan in (("old", legacyScan), ("new", recprocessor.scanForSensibleTwoLetterCodeAndLength)):
+        elapsed = timeScan(scan, streams)
+        print(f"{name}: {count} scans skipping {recprocessor.SCAN_MAXIMUM - 1} bytes in {elapsed:.3f}s ({elapsed/count*1e6:.2f} us/scan)")
+
+if __name__ == "__main__":
+    main()
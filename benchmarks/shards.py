@@ -0,0 +1,72 @@
+# Runs recprocessor over one folder of synthetic recorded games as several shards at once, then merges them,
+# and checks every recorded game ended up renamed exactly once with nothing lost to name collisions between shards.
+# Every game is written twice under different names, so each name is wanted by two files that are usually in different shards.
+# Usage: python benchmarks/shards.py [--shards N] [--count N] [--workers N]
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+RECPROCESSOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recprocessor.py")
+
+def writeConfig(folder: str, replayFolder: str, workers: int):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "recprocessor.ini")) as f:
+        config = f.read()
+    config = config.replace("ReplayFolder1=./", f"ReplayFolder1={replayFolder}").replace("\nReplayFolder2=", "\n;ReplayFolder2=")
+    config = config.replace("Workers=1", f"Workers={workers}")
+    with open(os.path.join(folder, "recprocessor.ini"), "w") as f:
+        f.write(config)
+
+def run(folder: str, *args: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, RECPROCESSOR, *args], cwd=folder)
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that sharded processing and merging renames every recorded game once")
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--count", type=int, default=200, help="games to generate, each of which is written twice")
+    parser.add_argument("--workers", type=int, default=1, help="Workers setting for each shard")
+    parser.add_argument("--padding", type=int, default=16*1024)
+    args = parser.parse_args()
+    workDir = tempfile.mkdtemp(prefix="recprocessor-shards-")
+    try:
+        replays = os.path.join(workDir, "replays")
+        for path in generate.generate(replays, args.count, paddingBytes=args.padding):
+            shutil.copyfile(path, path.replace("Record Game", "Copy of Record Game"))
+        total = len(os.listdir(replays))
+        writeConfig(workDir, replays, args.workers)
+        start = time.perf_counter()
+        shards = [run(workDir, "--shard", f"{index}/{args.shards}") for index in range(1, args.shards+1)]
+        failed = [index for index, process in enumerate(shards, 1) if process.wait() != 0]
+        shardTime = time.perf_counter() - start
+        renamedByShards = sum(1 for name in os.listdir(replays) if name.endswith("_.mythrec"))
+        start = time.perf_counter()
+        merge = run(workDir, "--merge")
+        merge.wait()
+        mergeTime = time.perf_counter() - start
+        names = os.listdir(replays)
+        renamed = [name for name in names if name.endswith("_.mythrec")]
+        leftover = [name for name in names if name.endswith(".mythrec") and not name.endswith("_.mythrec")]
+        manifests = [name for name in os.listdir(workDir) if name.startswith("_recprocessor_shard") and name.endswith(".jsonl")]
+        print(f"{total} files, {args.shards} shards: shards took {shardTime:.2f} s, merge took {mergeTime:.2f} s")
+        print(f"  renamed {len(renamed)}, left alone {len(leftover)}, renamed before merging {renamedByShards}, manifests left {len(manifests)}")
+        problems = []
+        if failed:
+            problems.append(f"shards {failed} exited with an error")
+        if merge.returncode != 0:
+            problems.append("the merge exited with an error")
+        if len(renamed) != total or leftover or renamedByShards or manifests:
+            problems.append("not every file was renamed exactly once by the merge")
+        for problem in problems:
+            print(f"FAILED: {problem}")
+        sys.exit(1 if problems else 0)
+    finally:
+        shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+    main()
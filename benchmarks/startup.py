@@ -0,0 +1,107 @@
+# Times starting recprocessor up the way a scheduled run does it: a couple of new recorded games turn up, it is started,
+# processes them and exits. Reports how long importing it took, how long until the first recorded game was processed and the whole run,
+# each measured from launching the process, and which of the modules that should only be imported when needed were imported anyway,
+# both by importing recprocessor and by the end of the run.
+# Every run after the first reuses the previous runs' cache and config snapshot, like a scheduler would.
+# Usage: python benchmarks/startup.py [--runs N] [--count N]
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import generate
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Only needed for outputs that are off by default, parallel processing, sharding, command line arguments, or when something goes wrong
+LAZY_MODULES = ("xmb", "xml.etree.ElementTree", "configparser", "concurrent.futures", "multiprocessing", "tempfile", "traceback",
+                "reccache", "recexport", "recstats", "recshard", "recindex", "json", "sqlite3", "datetime", "argparse", "array", "glob")
+
+# Run in the new process: times are wall clock so they compare with when the parent launched it
+PROBE = """
+import sys, time
+sys.path.insert(0, {root!r})
+import recprocessor
+imported = time.time()
+loadedByImport = [name for name in {lazy!r} if name in sys.modules]
+processed = []
+processAndLog = recprocessor.processAndLog
+def timedProcessAndLog(filepath):
+    result = processAndLog(filepath)
+    processed.append(time.time())
+    return result
+recprocessor.processAndLog = timedProcessAndLog
+recprocessor.main([])
+finished = time.time()
+loaded = [name for name in {lazy!r} if name in sys.modules]
+import json
+print(json.dumps({{"imported": imported, "firstFile": processed[0] if processed else None, "finished": finished, "files": len(processed), "loadedByImport": loadedByImport, "loaded": loaded}}))
+"""
+
+def writeConfig(folder: str, replayFolder: str):
+    with open(os.path.join(ROOT, "recprocessor.ini")) as f:
+        config = f.read()
+    config = config.replace("ReplayFolder1=./", f"ReplayFolder1={replayFolder}").replace("\nReplayFolder2=", "\n;ReplayFolder2=")
+    with open(os.path.join(folder, "recprocessor.ini"), "w") as f:
+        f.write(config)
+
+def runOnce(folder: str) -> dict:
+    probe = PROBE.format(root=os.path.abspath(ROOT), lazy=LAZY_MODULES)
+    launched = time.time()
+    output = subprocess.run([sys.executable, "-c", probe], cwd=folder, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["launched"] = launched
+    return result
+
+def timeInterpreter() -> float:
+    "How long starting Python and doing nothing takes, for comparison"
+    start = time.time()
+    subprocess.run([sys.executable, "-c", "pass"], check=True)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Time recprocessor's startup over repeated runs that each find a few new recorded games")
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--count", type=int, default=2, help="new recorded games for each run to process")
+    parser.add_argument("--padding", type=int, default=64*1024)
+    args = parser.parse_args()
+    workDir = tempfile.mkdtemp(prefix="recprocessor-startup-")
+    try:
+        replays = os.path.join(workDir, "replays")
+        writeConfig(workDir, replays)
+        results = []
+        for run in range(args.runs):
+            # Named by the run so they don't land on the (renamed) files from earlier runs
+            newFolder = os.path.join(workDir, "new")
+            for path in generate.generate(newFolder, args.count, paddingBytes=args.padding, seed=run):
+                os.makedirs(replays, exist_ok=True)
+                os.replace(path, os.path.join(replays, f"Run {run} {os.path.basename(path)}"))
+            results.append(runOnce(workDir))
+        interpreter = statistics.median(timeInterpreter() for run in range(args.runs))
+        # The first run has no cache or snapshot to start from, so it is reported on its own
+        first, rest = results[0], results[1:] or results
+        def median(key: str) -> float:
+            return statistics.median(result[key] - result["launched"] for result in rest)*1000
+        print(f"Python itself: {interpreter*1000:.1f} ms")
+        print(f"First run: imported {(first['imported'] - first['launched'])*1000:.1f} ms, first file {(first['firstFile'] - first['launched'])*1000:.1f} ms, "
+              f"finished {(first['finished'] - first['launched'])*1000:.1f} ms")
+        print(f"Later runs (median of {len(rest)}): imported {median('imported'):.1f} ms, first file {median('firstFile'):.1f} ms, finished {median('finished'):.1f} ms")
+        loadedByImport = sorted(set(name for result in rest for name in result["loadedByImport"]))
+        print(f"Imported with recprocessor but only needed sometimes: {', '.join(loadedByImport) if loadedByImport else 'none'}")
+        # Depends on what the ini has switched on, eg the cache brings in reccache, sqlite3 and json
+        loaded = sorted(set(name for result in rest for name in result["loaded"]))
+        print(f"Imported by the end of the run for what the ini has on: {', '.join(loaded) if loaded else 'none'}")
+        if any(result["files"] != args.count for result in results):
+            print(f"FAILED: not every run processed {args.count} files")
+            sys.exit(1)
+    finally:
+        shutil.rmtree(workDir)
+
+if __name__ == "__main__":
+    main()
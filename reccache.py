@@ -0,0 +1,214 @@
+# On-disk cache of what was read out of each recorded game, so unchanged files don't need decompressing and parsing again.
+# Entries are keyed by path and checked against the file's size and mtime, so an unchanged file only needs a stat.
+# A file with no entry at its path (like a copy, or one moved by something else) is matched on size, mtime and a hash of its first few KB,
+# which only needs reading when some entry has the same size and mtime.
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+import typing
+
+HEADER_HASH_BYTES = 4096
+COMMIT_EVERY = 100
+
+def hashHeader(filepath: str) -> bytes:
+    with open(filepath, "rb") as f:
+        return hashlib.blake2b(f.read(HEADER_HASH_BYTES), digest_size=16).digest()
+
+class RecCache:
+    def __init__(self, path: str, maxEntries: int, maxAgeDays: float, maxCivTables: int):
+        self.maxEntries = maxEntries
+        self.maxCivTables = maxCivTables
+        self.maxAgeDays = maxAgeDays
+        self.uncommitted = 0
+        self.now = time.time()
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS recs (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            headerHash BLOB NOT NULL,
+            lastUsed REAL NOT NULL,
+            metadata TEXT NOT NULL,
+            teams TEXT,
+            godNames TEXT,
+            fullMetadata TEXT,
+            gameId TEXT
+        )""")
+        # Caches from before the whole metadata table and game id were kept
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(recs)")]
+        for column in ("fullMetadata", "gameId"):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE recs ADD COLUMN {column} TEXT")
+        self.db.execute("CREATE INDEX IF NOT EXISTS recsLastUsed ON recs (lastUsed)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS recsIdentity ON recs (size, mtime)")
+        # Civ names read from packed game data, shared by every recorded game from the same game build
+        self.db.execute("""CREATE TABLE IF NOT EXISTS civTables (
+            fingerprint TEXT PRIMARY KEY,
+            lastUsed REAL NOT NULL,
+            civNames TEXT NOT NULL
+        )""")
+        # Folders that had nothing to process in them, and what was in them then, so they can be skipped until their mtime changes
+        self.db.execute("""CREATE TABLE IF NOT EXISTS folders (
+            path TEXT PRIMARY KEY,
+            mtime INTEGER NOT NULL,
+            lastUsed REAL NOT NULL,
+            subfolders TEXT NOT NULL
+        )""")
+        # The first copy seen of each game, by fingerprint, and the name it was given when renamed
+        self.db.execute("""CREATE TABLE IF NOT EXISTS games (
+            fingerprint TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            name TEXT,
+            lastUsed REAL NOT NULL
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS gamesPath ON games (path)")
+        # Other copies of those games that were left where they were, so they can be passed over without being opened
+        self.db.execute("""CREATE TABLE IF NOT EXISTS duplicates (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime INTEGER NOT NULL,
+            fingerprint TEXT NOT NULL,
+            lastUsed REAL NOT NULL
+        )""")
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def changed(self):
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_EVERY:
+            self.commit()
+
+    def lookup(self, filepath: str) -> typing.Optional[typing.Tuple[typing.Dict[str, typing.Any], typing.Optional[list], typing.Optional[typing.Dict[int, str]],
+                                                                     typing.Optional[typing.Dict[str, typing.Any]], typing.Optional[str]]]:
+        """Return (metadata, teams, god names, whole metadata table, game id) stored for filepath, or None if there is nothing stored or the file has changed since.
+        The whole metadata table and game id are None unless they had been read when it was stored"""
+        key = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        row = self.db.execute("SELECT size, mtime, metadata, teams, godNames, fullMetadata, gameId FROM recs WHERE path = ?", (key,)).fetchone()
+        if row is not None and (row[0], row[1]) == (stat.st_size, stat.st_mtime_ns):
+            self.db.execute("UPDATE recs SET lastUsed = ? WHERE path = ?", (self.now, key))
+        else:
+            # Nothing (or something out of date) at this path, but the same file might be stored under another one
+            candidates = self.db.execute("SELECT headerHash, size, mtime, metadata, teams, godNames, fullMetadata, gameId FROM recs WHERE size = ? AND mtime = ? AND path != ?",
+                                         (stat.st_size, stat.st_mtime_ns, key)).fetchall()
+            if len(candidates) == 0:
+                return None
+            headerHash = hashHeader(filepath)
+            matching = [candidate for candidate in candidates if candidate[0] == headerHash]
+            if len(matching) == 0:
+                return None
+            row = matching[0][1:]
+            # So next time it only needs a stat
+            self.db.execute("INSERT OR REPLACE INTO recs (path, size, mtime, headerHash, lastUsed, metadata, teams, godNames, fullMetadata, gameId) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            (key, row[0], row[1], headerHash, self.now, *row[2:]))
+        self.changed()
+        size, mtime, metadata, teams, godNames, fullMetadata, gameId = row
+        if teams is not None:
+            teams = [[tuple(player) for player in team] for team in json.loads(teams)]
+        if godNames is not None:
+            # json only allows string keys
+            godNames = {int(civID): name for civID, name in json.loads(godNames).items()}
+        if fullMetadata is not None:
+            fullMetadata = json.loads(fullMetadata)
+        return json.loads(metadata), teams, godNames, fullMetadata, gameId
+
+    def store(self, filepath: str, metadata: typing.Dict[str, typing.Any], teams: typing.Optional[list], godNames: typing.Optional[typing.Dict[int, str]],
+              fullMetadata: typing.Optional[typing.Dict[str, typing.Any]]=None, gameId: typing.Optional[str]=None):
+        stat = os.stat(filepath)
+        self.db.execute("INSERT OR REPLACE INTO recs (path, size, mtime, headerHash, lastUsed, metadata, teams, godNames, fullMetadata, gameId) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns, hashHeader(filepath), self.now, json.dumps(metadata),
+                         None if teams is None else json.dumps(teams), None if godNames is None else json.dumps(godNames),
+                         None if fullMetadata is None else json.dumps(fullMetadata), gameId))
+        self.changed()
+
+    def move(self, oldpath: str, newpath: str):
+        "Carry an entry over to a recorded game's new name after renaming it"
+        self.db.execute("DELETE FROM recs WHERE path = ?", (os.path.abspath(newpath),))
+        self.db.execute("UPDATE recs SET path = ? WHERE path = ?", (os.path.abspath(newpath), os.path.abspath(oldpath)))
+        self.db.execute("UPDATE games SET path = ? WHERE path = ?", (os.path.abspath(newpath), os.path.abspath(oldpath)))
+        self.db.execute("DELETE FROM duplicates WHERE path = ?", (os.path.abspath(newpath),))
+        self.db.execute("UPDATE duplicates SET path = ? WHERE path = ?", (os.path.abspath(newpath), os.path.abspath(oldpath)))
+        self.changed()
+
+    def loadCivTables(self) -> typing.Dict[str, typing.List[typing.Optional[str]]]:
+        return {fingerprint: json.loads(civNames) for fingerprint, civNames in self.db.execute("SELECT fingerprint, civNames FROM civTables")}
+
+    def storeCivTable(self, fingerprint: str, civNames: typing.List[typing.Optional[str]]):
+        self.db.execute("INSERT OR REPLACE INTO civTables (fingerprint, lastUsed, civNames) VALUES (?, ?, ?)", (fingerprint, self.now, json.dumps(civNames)))
+        self.changed()
+
+    def touchCivTable(self, fingerprint: str):
+        self.db.execute("UPDATE civTables SET lastUsed = ? WHERE fingerprint = ? AND lastUsed < ?", (self.now, fingerprint, self.now))
+
+    def lookupFolder(self, path: str) -> typing.Optional[typing.Tuple[int, typing.List[typing.Tuple[str, bool]]]]:
+        key = os.path.abspath(path)
+        row = self.db.execute("SELECT mtime, subfolders FROM folders WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE folders SET lastUsed = ? WHERE path = ? AND lastUsed < ?", (self.now, key, self.now))
+        return row[0], [(name, hidden) for name, hidden in json.loads(row[1])]
+
+    def storeFolder(self, path: str, mtime: int, subfolders: typing.List[typing.Tuple[str, bool]]):
+        self.db.execute("INSERT OR REPLACE INTO folders (path, mtime, lastUsed, subfolders) VALUES (?, ?, ?, ?)", (os.path.abspath(path), mtime, self.now, json.dumps(subfolders)))
+        self.changed()
+
+    def forgetFolder(self, path: str):
+        self.db.execute("DELETE FROM folders WHERE path = ?", (os.path.abspath(path),))
+        self.changed()
+
+    def lookupOriginal(self, fingerprint: str) -> typing.Optional[typing.Tuple[str, typing.Optional[str]]]:
+        "Return (path, name it was renamed to or None) of the first copy seen of the game with this fingerprint"
+        row = self.db.execute("SELECT path, name FROM games WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        if row is None:
+            return None
+        self.db.execute("UPDATE games SET lastUsed = ? WHERE fingerprint = ? AND lastUsed < ?", (self.now, fingerprint, self.now))
+        return row[0], row[1]
+
+    def hasOriginalAt(self, filepath: str) -> bool:
+        return self.db.execute("SELECT 1 FROM games WHERE path = ?", (os.path.abspath(filepath),)).fetchone() is not None
+
+    def storeOriginal(self, fingerprint: str, filepath: str, name: typing.Optional[str]):
+        self.db.execute("INSERT OR REPLACE INTO games (fingerprint, path, name, lastUsed) VALUES (?, ?, ?, ?)", (fingerprint, os.path.abspath(filepath), name, self.now))
+        self.changed()
+
+    def lookupDuplicate(self, filepath: str) -> typing.Optional[str]:
+        "Return the fingerprint of filepath if it was stored as a copy of another game and hasn't changed since, going by its size and mtime alone"
+        key = os.path.abspath(filepath)
+        row = self.db.execute("SELECT size, mtime, fingerprint FROM duplicates WHERE path = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        size, mtime, fingerprint = row
+        stat = os.stat(filepath)
+        if stat.st_size != size or stat.st_mtime_ns != mtime:
+            return None
+        self.db.execute("UPDATE duplicates SET lastUsed = ? WHERE path = ? AND lastUsed < ?", (self.now, key, self.now))
+        return fingerprint
+
+    def storeDuplicate(self, filepath: str, fingerprint: str):
+        stat = os.stat(filepath)
+        self.db.execute("INSERT OR REPLACE INTO duplicates (path, size, mtime, fingerprint, lastUsed) VALUES (?, ?, ?, ?, ?)",
+                        (os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns, fingerprint, self.now))
+        self.changed()
+
+    def compact(self) -> int:
+        "Forget entries not used within maxAgeDays, then the least recently used ones beyond maxEntries. Returns how many were removed"
+        removed = self.db.execute("DELETE FROM recs WHERE lastUsed < ?", (self.now - self.maxAgeDays*86400,)).rowcount
+        removed += self.db.execute("DELETE FROM recs WHERE path IN (SELECT path FROM recs ORDER BY lastUsed DESC LIMIT -1 OFFSET ?)", (self.maxEntries,)).rowcount
+        # Old builds' tables, folders and games go too, but don't count towards what is reported as removed
+        for table in ("folders", "games", "duplicates"):
+            self.db.execute(f"DELETE FROM {table} WHERE lastUsed < ?", (self.now - self.maxAgeDays*86400,))
+        self.db.execute("DELETE FROM civTables WHERE fingerprint IN (SELECT fingerprint FROM civTables ORDER BY lastUsed DESC LIMIT -1 OFFSET ?)", (self.maxCivTables,))
+        self.commit()
+        if removed > self.maxEntries//10:
+            self.db.execute("VACUUM")
+        return removed
+
+    def close(self) -> int:
+        removed = self.compact()
+        self.db.close()
+        return removed
@@ -0,0 +1,123 @@
+# Reading the settings in recprocessor.ini without going through configparser on every run.
+# What configparser makes of the ini is kept in a snapshot next to it (a marshal dump, which needs nothing imported to read back),
+# and used for as long as the ini's contents are the same, so configparser is only imported after the ini has been edited.
+# Config has the parts of ConfigParser's interface recprocessor uses, over the values from either.
+
+import marshal
+import os
+import typing
+import zlib
+
+VERSION = 1
+SNAPSHOT_PREFIX = "_"
+SNAPSHOT_EXTENSION = ".snapshot"
+
+# The same as ConfigParser.BOOLEAN_STATES
+BOOLEAN_STATES = {"1": True, "yes": True, "true": True, "on": True, "0": False, "no": False, "false": False, "off": False}
+
+# {section: {option (lowercase): value}}
+Values = typing.Dict[str, typing.Dict[str, str]]
+
+_UNSET = object()
+
+class MissingOptionError(LookupError):
+    pass
+
+def snapshotPath(path: str) -> str:
+    folder, name = os.path.split(path)
+    return os.path.join(folder, SNAPSHOT_PREFIX + name + SNAPSHOT_EXTENSION)
+
+def parseIni(path: str) -> Values:
+    import configparser
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    values = {}
+    for section in parser.sections():
+        values[section] = {}
+        for option in parser.options(section):
+            try:
+                values[section][option] = parser.get(section, option)
+            except configparser.InterpolationError:
+                # ConfigParser would only complain about a stray % when the option is used, by which point it would be read as it is anyway
+                values[section][option] = parser.get(section, option, raw=True)
+    return values
+
+def loadSnapshot(path: str, key: typing.Tuple[int, int]) -> typing.Optional[Values]:
+    try:
+        with open(snapshotPath(path), "rb") as f:
+            version, snapshotKey, values = marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != VERSION or tuple(snapshotKey) != key:
+        return None
+    return values
+
+def removeSnapshot(path: str):
+    try:
+        os.remove(snapshotPath(path))
+    except OSError:
+        pass
+
+def writeSnapshot(path: str, key: typing.Tuple[int, int], values: Values):
+    target = snapshotPath(path)
+    temporary = f"{target}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, "wb") as f:
+            marshal.dump((VERSION, key, values), f)
+        os.replace(temporary, target)
+    except OSError:
+        # A folder that can't be written to just means parsing the ini every time
+        pass
+
+class Config:
+    def __init__(self, values: typing.Optional[Values]=None):
+        self.values: Values = values if values is not None else {}
+
+    def read(self, path: str, snapshot=True, switch: typing.Optional[typing.Tuple[str, str]]=None):
+        """Load the settings in an ini file, from its snapshot if it has one that is up to date. Raises FileNotFoundError if it doesn't exist.
+        switch is the (section, option) in the ini that stops snapshots being kept when it is off"""
+        with open(path, "rb") as f:
+            contents = f.read()
+        key = (len(contents), zlib.crc32(contents))
+        values = loadSnapshot(path, key) if snapshot else None
+        if values is None:
+            values = parseIni(path)
+            if switch is not None and BOOLEAN_STATES.get(values.get(switch[0], {}).get(switch[1].lower(), "1").lower()) is False:
+                # Turned off since the last snapshot was written, which is then just clutter
+                removeSnapshot(path)
+            elif snapshot:
+                writeSnapshot(path, key, values)
+        for section, options in values.items():
+            self.values.setdefault(section, {}).update(options)
+
+    def get(self, section: str, option: str, fallback: typing.Any=_UNSET) -> typing.Any:
+        try:
+            return self.values[section][option.lower()]
+        except KeyError:
+            if fallback is _UNSET:
+                raise MissingOptionError(f"No {option} in the [{section}] section of the ini")
+            return fallback
+
+    def has_option(self, section: str, option: str) -> bool:
+        return option.lower() in self.values.get(section, {})
+
+    def getint(self, section: str, option: str, fallback: typing.Any=_UNSET) -> typing.Any:
+        if not self.has_option(section, option) and fallback is not _UNSET:
+            return fallback
+        return int(self.get(section, option))
+
+    def getfloat(self, section: str, option: str, fallback: typing.Any=_UNSET) -> typing.Any:
+        if not self.has_option(section, option) and fallback is not _UNSET:
+            return fallback
+        return float(self.get(section, option))
+
+    def getboolean(self, section: str, option: str, fallback: typing.Any=_UNSET) -> typing.Any:
+        if not self.has_option(section, option) and fallback is not _UNSET:
+            return fallback
+        value = self.get(section, option)
+        if value.lower() not in BOOLEAN_STATES:
+            raise ValueError(f"Not a boolean: {value}")
+        return BOOLEAN_STATES[value.lower()]
+
+    def set(self, section: str, option: str, value: str):
+        self.values.setdefault(section, {})[option.lower()] = value
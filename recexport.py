@@ -0,0 +1,108 @@
+# Collects what was read out of every processed recorded game into one file: a json line per game, or rows in an SQLite database.
+# Both are only ever added to, and remember which games (by a hash of their contents) and files they already have,
+# so each run only adds the recorded games that weren't there before.
+
+import json
+import os
+import sqlite3
+import typing
+
+COMMIT_EVERY = 100
+
+# A game as exported: id, file, originalFile, timestamp, map, players [{number, name, team, civ, god}], teams [[player name]] and metadata
+ExportRecord = typing.Dict[str, typing.Any]
+
+class JsonlExporter:
+    def __init__(self, path: str):
+        self.ids: typing.Set[str] = set()
+        self.files: typing.Set[str] = set()
+        if os.path.isfile(path):
+            with open(path, encoding="utf8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Most likely the end of a line that was being written when a previous run was stopped
+                        continue
+                    self.ids.add(record["id"])
+                    self.files.add(record["file"])
+        self.file = open(path, "a", encoding="utf8")
+
+    def hasFile(self, filepath: str) -> bool:
+        return os.path.abspath(filepath) in self.files
+
+    def hasGame(self, gameId: str) -> bool:
+        return gameId in self.ids
+
+    def add(self, record: ExportRecord):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.ids.add(record["id"])
+        self.files.add(record["file"])
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class SqliteExporter:
+    def __init__(self, path: str):
+        self.uncommitted = 0
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS games (
+            id TEXT PRIMARY KEY,
+            file TEXT NOT NULL,
+            originalFile TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            map TEXT,
+            metadata TEXT NOT NULL
+        )""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS players (
+            gameId TEXT NOT NULL REFERENCES games (id),
+            number INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            team INTEGER NOT NULL,
+            civ INTEGER NOT NULL,
+            god TEXT NOT NULL,
+            PRIMARY KEY (gameId, number)
+        )""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS gamesFile ON games (file)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS gamesMap ON games (map)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS playersName ON players (name)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS playersGod ON players (god)")
+
+    def hasFile(self, filepath: str) -> bool:
+        return self.db.execute("SELECT 1 FROM games WHERE file = ?", (os.path.abspath(filepath),)).fetchone() is not None
+
+    def hasGame(self, gameId: str) -> bool:
+        return self.db.execute("SELECT 1 FROM games WHERE id = ?", (gameId,)).fetchone() is not None
+
+    def add(self, record: ExportRecord):
+        self.db.execute("INSERT OR IGNORE INTO games (id, file, originalFile, timestamp, map, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+                        (record["id"], record["file"], record["originalFile"], record["timestamp"], record["map"], json.dumps(record["metadata"], ensure_ascii=False)))
+        self.db.executemany("INSERT OR IGNORE INTO players (gameId, number, name, team, civ, god) VALUES (?, ?, ?, ?, ?, ?)",
+                            [(record["id"], player["number"], player["name"], player["team"], player["civ"], player["god"]) for player in record["players"]])
+        self.uncommitted += 1
+        if self.uncommitted >= COMMIT_EVERY:
+            self.flush()
+
+    def flush(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+Exporter = typing.Union[JsonlExporter, SqliteExporter]
+EXPORT_FORMATS: typing.Dict[str, typing.Tuple[typing.Callable[[str], Exporter], str]] = {
+    "jsonl": (JsonlExporter, "_recprocessor_export.jsonl"),
+    "sqlite": (SqliteExporter, "_recprocessor_export.sqlite"),
+}
+
+def openExporter(exportFormat: str, path: typing.Optional[str], folder: str) -> Exporter:
+    "Open an exporter for exportFormat (jsonl or sqlite, any case), to path or the default file for the format in folder"
+    if exportFormat.lower() not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {exportFormat}, expected one of {', '.join(EXPORT_FORMATS)}")
+    exporterClass, defaultFile = EXPORT_FORMATS[exportFormat.lower()]
+    return exporterClass(os.path.join(folder, path or defaultFile))
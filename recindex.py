@@ -0,0 +1,161 @@
+# A compact, seekable copy of a recorded game's decompressed data, for looking at later instead of OutputDecompressed's full dump.
+# The data is split into checkpoints every few MB, each compressed on its own so reading can start at any of them,
+# plus a table of where each top level section of the hierarchy is. Reading a byte range or a section only decompresses the checkpoints it overlaps.
+# (Python's zlib can't resume the recorded game's own stream partway through, so the checkpoints can't just point into the original.)
+#
+# Layout: header (magic, version, checkpoint size), the compressed checkpoints, then a table of checkpoints and sections,
+# then a footer giving the total length and where the table starts.
+# Usage: python recindex.py FILE.index [--section CODE [--occurrence N] | --range OFFSET LENGTH] [--output FILE]
+
+import argparse
+import struct
+import sys
+import typing
+import zlib
+
+MAGIC = b"RCIX"
+VERSION = 1
+HEADER = struct.Struct("<4sII")
+# output offset, file offset, compressed length
+CHECKPOINT = struct.Struct("<QQI")
+# two letter code, data offset, data length
+SECTION = struct.Struct("<2sQQ")
+# total decompressed length, table offset, magic
+FOOTER = struct.Struct("<QQ4s")
+# Quick rather than small, the checkpoints are still a small fraction of what OutputDecompressed would write
+COMPRESSION_LEVEL = 1
+
+# (two letter code, offset of its data, length of its data)
+Section = typing.Tuple[str, int, int]
+
+class RecIndexError(Exception):
+    pass
+
+class CheckpointIndexBuilder:
+    "Fed decompressed data in order as it is inflated, and compresses it a checkpoint at a time"
+    def __init__(self, checkpointSize: int):
+        self.checkpointSize = checkpointSize
+        self.pending = bytearray()
+        # (output offset, compressed data)
+        self.checkpoints: typing.List[typing.Tuple[int, bytes]] = []
+        self.length = 0
+
+    def add(self, data: typing.Union[bytes, memoryview]):
+        self.pending += data
+        while len(self.pending) >= self.checkpointSize:
+            self.compressPending(self.checkpointSize)
+
+    def compressPending(self, size: int):
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+        compressed = compressor.compress(self.pending[:size]) + compressor.flush()
+        self.checkpoints.append((self.length, compressed))
+        self.length += size
+        del self.pending[:size]
+
+    def write(self, path: str, sections: typing.Iterable[Section]):
+        "Write out everything added so far, with the given hierarchy sections"
+        if len(self.pending) > 0:
+            self.compressPending(len(self.pending))
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, self.checkpointSize))
+            table = []
+            for outputOffset, compressed in self.checkpoints:
+                table.append(CHECKPOINT.pack(outputOffset, f.tell(), len(compressed)))
+                f.write(compressed)
+            tableOffset = f.tell()
+            f.write(struct.pack("<I", len(table)))
+            f.write(b"".join(table))
+            sections = list(sections)
+            f.write(struct.pack("<I", len(sections)))
+            for code, offset, length in sections:
+                f.write(SECTION.pack(code.encode("ascii"), offset, length))
+            f.write(FOOTER.pack(self.length, tableOffset, MAGIC))
+
+class CheckpointIndex:
+    "Reads data back out of a file written by CheckpointIndexBuilder"
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        magic, version, self.checkpointSize = HEADER.unpack(self.file.read(HEADER.size))
+        if magic != MAGIC:
+            raise RecIndexError(f"{path} isn't a recorded game index")
+        if version != VERSION:
+            raise RecIndexError(f"{path} is index version {version}, only {VERSION} is supported")
+        self.file.seek(-FOOTER.size, 2)
+        self.length, tableOffset, magic = FOOTER.unpack(self.file.read(FOOTER.size))
+        if magic != MAGIC:
+            raise RecIndexError(f"{path} is incomplete")
+        self.file.seek(tableOffset)
+        numCheckpoints = struct.unpack("<I", self.file.read(4))[0]
+        self.checkpoints = [CHECKPOINT.unpack(self.file.read(CHECKPOINT.size)) for x in range(numCheckpoints)]
+        numSections = struct.unpack("<I", self.file.read(4))[0]
+        self.sections: typing.List[Section] = []
+        for x in range(numSections):
+            code, offset, length = SECTION.unpack(self.file.read(SECTION.size))
+            self.sections.append((code.decode("ascii"), offset, length))
+        # The last checkpoint decompressed, as reads tend to be near each other
+        self.cachedIndex = -1
+        self.cachedData = b""
+
+    def checkpointData(self, checkpointIndex: int) -> bytes:
+        if checkpointIndex != self.cachedIndex:
+            outputOffset, fileOffset, compressedLength = self.checkpoints[checkpointIndex]
+            self.file.seek(fileOffset)
+            self.cachedData = zlib.decompress(self.file.read(compressedLength), -15)
+            self.cachedIndex = checkpointIndex
+        return self.cachedData
+
+    def read(self, offset: int, length: int) -> bytes:
+        "Up to length bytes of the decompressed data from offset, only decompressing the checkpoints they are in"
+        if offset < 0 or length < 0:
+            raise ValueError(f"Can't read {length} bytes at {offset}")
+        end = min(offset + length, self.length)
+        out = []
+        while offset < end:
+            checkpointIndex = offset // self.checkpointSize
+            checkpointStart = self.checkpoints[checkpointIndex][0]
+            data = self.checkpointData(checkpointIndex)
+            piece = data[offset - checkpointStart:end - checkpointStart]
+            out.append(piece)
+            offset += len(piece)
+        return b"".join(out)
+
+    def findSections(self, code: str) -> typing.List[Section]:
+        return [section for section in self.sections if section[0] == code]
+
+    def readSection(self, code: str, occurrence=0) -> bytes:
+        "The data of a top level section of the hierarchy, or its occurrence'th one for codes that appear more than once"
+        sections = self.findSections(code)
+        if occurrence >= len(sections):
+            raise RecIndexError(f"Only {len(sections)} {code} sections in this index")
+        code, offset, length = sections[occurrence]
+        return self.read(offset, length)
+
+    def close(self):
+        self.file.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Read decompressed recorded game data out of a .index file")
+    parser.add_argument("index")
+    parser.add_argument("--section", help="two letter code of a top level section to read")
+    parser.add_argument("--occurrence", type=int, default=0)
+    parser.add_argument("--range", type=int, nargs=2, metavar=("OFFSET", "LENGTH"))
+    parser.add_argument("--output", help="file to write what was read to, instead of stdout")
+    args = parser.parse_args()
+    index = CheckpointIndex(args.index)
+    if args.section is not None:
+        data = index.readSection(args.section, args.occurrence)
+    elif args.range is not None:
+        data = index.read(*args.range)
+    else:
+        print(f"{index.length} bytes in {len(index.checkpoints)} checkpoints of {index.checkpointSize}")
+        for code, offset, length in index.sections:
+            print(f"{code} at {offset}, {length} bytes")
+        return
+    if args.output is not None:
+        with open(args.output, "wb") as f:
+            f.write(data)
+    else:
+        sys.stdout.buffer.write(data)
+
+if __name__ == "__main__":
+    main()
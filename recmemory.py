@@ -0,0 +1,96 @@
+# Keeps the memory used by recorded games being processed at once under MaxMemoryMB.
+# Each file's decompressed size is known from its header before anything is inflated, so the main process reserves that much
+# before handing a file to a worker, and holds back new files until enough of the ones in flight have finished.
+# Files too big for their share of the budget are inflated into a temporary file's mapping instead, which the OS can write out
+# to disk under pressure rather than keeping it all in memory.
+
+import struct
+import sys
+import typing
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, which has GetProcessMemoryInfo instead
+    resource = None
+
+# Where the l33t-zlib header (compressed length, "l33t", decompressed length) starts
+L33T_HEADER_OFFSET = 0x10d
+L33T_HEADER = struct.Struct("<i4si")
+
+def readDecompressedSize(filepath: str) -> typing.Optional[int]:
+    "How big a recorded game says it is once decompressed, from its header alone. None if the header isn't there"
+    with open(filepath, "rb") as f:
+        f.seek(L33T_HEADER_OFFSET)
+        header = f.read(L33T_HEADER.size)
+    if len(header) < L33T_HEADER.size:
+        return None
+    compressedLength, magic, decompressedLength = L33T_HEADER.unpack(header)
+    if magic != b"l33t" or decompressedLength < 0:
+        return None
+    return decompressedLength
+
+class MemoryGovernor:
+    """Counts the bytes reserved by files in flight against a budget (0 for no limit).
+    Each file reserves an estimate from its header when it starts, replaced by what its buffer actually came to once that is known"""
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.held = 0
+        # file -> bytes reserved for it
+        self.reserved: typing.Dict[str, int] = {}
+        self.peakHeld = 0
+        # Times a file had to wait for others to finish before it could start
+        self.waits = 0
+
+    def fits(self, size: int) -> bool:
+        # Something always has to be allowed to run, however big it is
+        return self.budget <= 0 or self.held == 0 or self.held + size <= self.budget
+
+    def reserve(self, filepath: str, size: int):
+        self.reserved[filepath] = size
+        self.held += size
+        self.peakHeld = max(self.peakHeld, self.held)
+
+    def update(self, filepath: str, size: int):
+        "Replace what was reserved for a file in flight with what it turned out to use"
+        if filepath in self.reserved:
+            self.held += size - self.reserved[filepath]
+            self.reserved[filepath] = size
+            self.peakHeld = max(self.peakHeld, self.held)
+
+    def release(self, filepath: str):
+        self.held -= self.reserved.pop(filepath, 0)
+
+def windowsPeakWorkingSetMB() -> typing.Optional[float]:
+    "Peak working set of this process from GetProcessMemoryInfo, or None if that fails"
+    import ctypes
+    from ctypes import wintypes
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD), ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t), ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaNonPagedPoolUsage", ctypes.c_size_t), ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+    try:
+        kernel32 = ctypes.WinDLL("kernel32")
+        psapi = ctypes.WinDLL("psapi")
+    except OSError:
+        return None
+    # A pseudo handle (-1), which would be cut down to an int without saying it is a HANDLE
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+    psapi.GetProcessMemoryInfo.restype = wintypes.BOOL
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    if not psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters.PeakWorkingSetSize / (1024*1024)
+
+def peakRSSMB(children=False) -> typing.Optional[float]:
+    """Peak resident memory of this process, or with children the largest of its finished child processes. None where that can't be found out,
+    which includes children on Windows"""
+    if sys.platform == "win32":
+        return None if children else windowsPeakWorkingSetMB()
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024*1024 if sys.platform == "darwin" else 1024)
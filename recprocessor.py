@@ -2,29 +2,245 @@ import typing
 import struct
 import io
 import os
-import json
+import sys
 import zlib
-import configparser
-import traceback
-import datetime
-import xmb
+import hashlib
+import mmap
+import types
+import time
+import recconfig
+import recmemory
+import recprofile
+import recrename
+import rectemplate
+import recwalk
+import recwatch
 import re
-from xml.etree import ElementTree as ET
+import collections
+
+# Only needed for the XMBs, parallel processing, sharding and outputs that are off by default (and the modules for those, which import
+# json, sqlite3 and the like), so imported where they are used to keep starting up quick
+if typing.TYPE_CHECKING:
+    import argparse
+    import concurrent.futures
+    import reccache
+    import recexport
+    import recindex
+    import recshard
+    import recstats
+    import xmb
+    from xml.etree import ElementTree as ET
 
 RECORDED_GAME_MAX_DECOMPRESS_SIZE = 150*1024*1024
 LOGFILE = "_recprocessor.log"
+RENAME_JOURNAL_FILE = "_recprocessor_renames.journal"
+CONFIG_FILE = "./recprocessor.ini"
 ILLEGAL_FILENAME_CHARACTERS = "/\\<>:|?\""
 
-def decompressl33tZlib(stream: typing.BinaryIO, maxSize=0) -> typing.BinaryIO:
-    "Decompress up to maxSize bytes of a l33t-zlib compressed file, returning a file-like object of decompressed data"
+DECOMPRESS_CHUNK_SIZE = 64*1024
+
+class StreamingDecompressor:
+    """Seekable read-only file-like object that only inflates as much of a zlib payload as has actually been read.
+    Output goes into one anonymous memory mapping so the hierarchy can hand out views of it instead of copies.
+    With spill=True it goes into the mapping of a temporary file in spillFolder instead, which can be paged out to the file rather than held in memory.
+    It also switches to that if it has to grow past spillAbove (if that isn't 0), for files whose header understated their size."""
+    def __init__(self, compressed: bytes, sizeHint: int, maxSize=0, checkpoints: typing.Optional["recindex.CheckpointIndexBuilder"]=None,
+                 spill=False, spillFolder: typing.Optional[str]=None, spillAbove=0):
+        self.compressed = compressed
+        self.spill = spill
+        self.spillFolder = spillFolder
+        self.spillAbove = spillAbove
+        # Given everything as it is inflated, to build a seekable index of it
+        self.checkpoints = checkpoints
+        self.compressedPos = 0
+        self.decompressor = zlib.decompressobj()
+        self.maxSize = maxSize
+        # Sized from the header. On Linux and macOS pages of an anonymous mapping only take up memory once written to, but Windows charges
+        # all of it against the commit limit when it is made, which is one reason files over their share of MaxMemoryMB get a temporary file's mapping instead
+        self.allocate(max(sizeHint, DECOMPRESS_CHUNK_SIZE))
+        self.length = 0
+        self.pos = 0
+        self.finished = False
+    def memoryHeld(self) -> int:
+        "How much of the buffer counts against MaxMemoryMB: all of it, or for a spilled one no more than its share, as the rest can be paged out to its file"
+        return min(self.capacity, self.spillAbove) if self.spill and self.spillAbove else self.capacity
+    def allocate(self, capacity: int):
+        if self.maxSize:
+            capacity = min(capacity, self.maxSize)
+        if not self.spill and self.spillAbove and capacity > self.spillAbove:
+            self.spill = True
+            recprofile.count("spilledBytes", capacity)
+        if self.spill:
+            import tempfile
+            # Already deleted (or deleted on close), the mapping keeps what it needs of it
+            with tempfile.TemporaryFile(dir=self.spillFolder or None) as spillFile:
+                spillFile.truncate(capacity)
+                newBuffer = mmap.mmap(spillFile.fileno(), capacity)
+        else:
+            newBuffer = mmap.mmap(-1, capacity)
+        if hasattr(self, "view"):
+            newBuffer[:self.length] = self.view[:self.length]
+        # Views already handed out keep the old mapping alive, and its contents are unchanged
+        self.buffer = newBuffer
+        self.view = memoryview(newBuffer)
+        self.capacity = capacity
+    def fill(self, target: typing.Optional[int]):
+        "Inflate until at least target bytes are available, or everything if target is None"
+        while not self.finished and (target is None or self.length < target):
+            if self.length == self.capacity:
+                if self.maxSize and self.capacity >= self.maxSize:
+                    self.finished = True
+                    break
+                self.allocate(self.capacity*2)
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.compressed[self.compressedPos:self.compressedPos+DECOMPRESS_CHUNK_SIZE]
+                self.compressedPos += len(data)
+            if not data:
+                self.finished = True
+                break
+            with recprofile.stage("inflate"):
+                chunk = self.decompressor.decompress(data, min(DECOMPRESS_CHUNK_SIZE*4, self.capacity - self.length))
+            self.view[self.length:self.length+len(chunk)] = chunk
+            self.length += len(chunk)
+            if self.checkpoints is not None:
+                self.checkpoints.add(chunk)
+            if self.decompressor.eof:
+                self.finished = True
+    def getView(self, offset: int, length: int) -> memoryview:
+        "Zero-copy view of up to length bytes from offset. Shorter if the data ends first"
+        self.fill(offset+length)
+        return self.view[offset:min(offset+length, self.length)]
+    def read(self, size=-1) -> bytes:
+        if size is None or size < 0:
+            self.fill(None)
+            size = self.length - self.pos
+        data = bytes(self.getView(self.pos, max(size, 0)))
+        self.pos += len(data)
+        return data
+    def seek(self, offset: int, whence=0) -> int:
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            self.fill(None)
+            offset += self.length
+        self.pos = offset
+        return self.pos
+    def tell(self) -> int:
+        return self.pos
+
+class WindowedDecompressor:
+    """Like StreamingDecompressor, but only keeps the data from the last release() onwards, so any amount of data
+    can be read through in the memory of the largest span that was held at once.
+    Views stay valid after their data is released: the window moves to a new mapping rather than overwriting the old one."""
+    def __init__(self, compressed: bytes, windowSize: int):
+        self.compressed = compressed
+        self.compressedPos = 0
+        self.decompressor = zlib.decompressobj()
+        self.windowSize = windowSize
+        self.allocate(windowSize)
+        # Stream offset of the start of the window, everything before it has been thrown away
+        self.base = 0
+        self.length = 0
+        self.keepFrom = 0
+        self.pos = 0
+        self.finished = False
+    def allocate(self, capacity: int):
+        newBuffer = mmap.mmap(-1, capacity)
+        if hasattr(self, "view"):
+            # Only what is still wanted moves into the new mapping
+            dropped = min(self.keepFrom, self.length) - self.base
+            newBuffer[:self.length-self.base-dropped] = self.view[dropped:self.length-self.base]
+            self.base += dropped
+        self.buffer = newBuffer
+        self.view = memoryview(newBuffer)
+        self.capacity = capacity
+    def release(self, offset: int):
+        "Data before offset won't be read again, so can be dropped"
+        self.keepFrom = max(self.keepFrom, offset)
+    def makeRoom(self):
+        held = self.length - min(self.keepFrom, self.length)
+        # Grow only when what is held fills most of the window, so moving it doesn't happen every chunk
+        capacity = self.capacity if held <= self.capacity // 2 else self.capacity*2
+        self.allocate(capacity)
+    def fill(self, target: typing.Optional[int]):
+        "Inflate until the data up to target is available, or everything if target is None"
+        while not self.finished and (target is None or self.length < target):
+            if self.length - self.base == self.capacity:
+                self.makeRoom()
+            data = self.decompressor.unconsumed_tail
+            if not data:
+                data = self.compressed[self.compressedPos:self.compressedPos+DECOMPRESS_CHUNK_SIZE]
+                self.compressedPos += len(data)
+            if not data:
+                self.finished = True
+                break
+            with recprofile.stage("inflate"):
+                chunk = self.decompressor.decompress(data, min(DECOMPRESS_CHUNK_SIZE*4, self.capacity - (self.length - self.base)))
+            if self.base == self.length and self.length + len(chunk) <= self.keepFrom:
+                # Released before it was even inflated, like the middle of an entry being skipped over
+                self.base += len(chunk)
+            else:
+                start = self.length - self.base
+                self.view[start:start+len(chunk)] = chunk
+            self.length += len(chunk)
+            if self.decompressor.eof:
+                self.finished = True
+    def getView(self, offset: int, length: int) -> memoryview:
+        "Zero-copy view of up to length bytes from offset. Shorter if the data ends first"
+        if offset < self.base:
+            raise ValueError(f"Data at {offset} has already been released (window starts at {self.base})")
+        self.fill(offset+length)
+        return self.view[offset-self.base:min(offset+length, self.length)-self.base]
+    def iterData(self, offset: int, length: int, chunkSize=DECOMPRESS_CHUNK_SIZE) -> typing.Iterator[memoryview]:
+        "Views of length bytes from offset, chunkSize at a time, releasing each piece once the next is wanted"
+        end = offset + length
+        while offset < end:
+            self.release(offset)
+            piece = self.getView(offset, min(chunkSize, end - offset))
+            if len(piece) == 0:
+                return
+            yield piece
+            offset += len(piece)
+    def read(self, size: int) -> bytes:
+        data = bytes(self.getView(self.pos, max(size, 0)))
+        self.pos += len(data)
+        return data
+    def seek(self, offset: int, whence=0) -> int:
+        if whence == 1:
+            offset += self.pos
+        self.pos = offset
+        return self.pos
+    def tell(self) -> int:
+        return self.pos
+
+def readl33tZlibPayload(stream: typing.BinaryIO) -> typing.Tuple[bytes, int]:
+    "Read the compressed data out of a l33t-zlib compressed file, returning (compressed data, length it decompresses to)"
     stream.seek(0x10d)
     compressedLength = struct.unpack("<i", stream.read(4))[0]
     header = stream.read(4)
     if header != b"l33t":
         raise ValueError(f"Bad l33t-zlib header: {header.decode(errors='replace')}")
-    decompress = zlib.decompressobj()
     origDataLength = struct.unpack("<i", stream.read(4))[0]
-    return io.BytesIO(decompress.decompress(stream.read(compressedLength), maxSize))
+    # The compressed payload is small next to what it inflates to, and reading it now means the
+    # source file can be closed (and renamed) while the parser is still pulling data
+    return stream.read(compressedLength), origDataLength
+
+def decompressl33tZlib(stream: typing.BinaryIO, maxSize=0, streaming=False, checkpoints: typing.Optional["recindex.CheckpointIndexBuilder"]=None,
+                       spillAbove=0, spillFolder: typing.Optional[str]=None) -> StreamingDecompressor:
+    """Decompress up to maxSize bytes of a l33t-zlib compressed file, returning a file-like object of decompressed data.
+    With streaming=True the data is only inflated as it is read, so stopping early skips the remainder of the work.
+    checkpoints is given all the data as it is inflated.
+    Files that decompress to more than spillAbove bytes (if it isn't 0) are decompressed into a temporary file's mapping in spillFolder."""
+    compressed, origDataLength = readl33tZlibPayload(stream)
+    size = min(origDataLength, maxSize) if maxSize else origDataLength
+    spill = spillAbove > 0 and size > spillAbove
+    if spill:
+        recprofile.count("spilledBytes", size)
+    decompressed = StreamingDecompressor(compressed, origDataLength, maxSize, checkpoints, spill, spillFolder, spillAbove)
+    if not streaming:
+        decompressed.fill(None)
+    return decompressed
 
 def readInt32(stream: typing.BinaryIO) -> int:
     return struct.unpack("<i", stream.read(4))[0]
@@ -32,6 +248,17 @@ def readInt32(stream: typing.BinaryIO) -> int:
 def readUtf16(stream: typing.BinaryIO) -> str:
     length = readInt32(stream)
     return stream.read(length*2).decode("utf16")
+
+# Equivalents of the above for reading straight out of a buffer, returning (value, offset after the value)
+def unpackInt32(data: memoryview, offset: int) -> typing.Tuple[int, int]:
+    return struct.unpack_from("<i", data, offset)[0], offset+4
+
+def unpackUtf16(data: memoryview, offset: int) -> typing.Tuple[str, int]:
+    length, offset = unpackInt32(data, offset)
+    end = offset+length*2
+    if end > len(data):
+        raise ValueError(f"String of {length} characters at {offset} runs past the end of its data")
+    return str(data[offset:end], "utf16"), end
     
 # Navigating the embedded two letter coded object tree.
 # I didn't realise that this was actually part of the legacy game format too and I could have saved many hours looking at existing tools that worked on that...
@@ -58,44 +285,56 @@ DEBUG = False
 class ScanFailureError(Exception):
     pass
 
-def scanForSensibleTwoLetterCodeAndLength(stream: typing.BinaryIO, maxDataLength=None):
+# Zero width so that overlapping candidates all match: both bytes of a code must be printable ascii
+SENSIBLE_TWO_LETTER_CODE = re.compile(b"(?=[\x20-\x7f]{2})")
+
+def scanForSensibleTwoLetterCodeAndLength(stream: StreamingDecompressor, maxDataLength=None):
+    "Find the next two letter code and length within SCAN_MAXIMUM bytes, returning (code, length, skipped bytes)"
     #print(f"Scan at {stream.tell()}")
-    unk = b""
-    for x in range(0, SCAN_MAXIMUM):
-        bad = False
-        thisTwoLetterCode = "\x00\x00"
-        try:
-            thisTwoLetterCode = stream.read(2).decode("ascii")
-        except Exception:
-            bad = True
-        for char in thisTwoLetterCode:
-            if ord(char) < 32:
-                bad = True
-                break
-        thisLength = struct.unpack("<I", stream.read(4))[0]
+    start = stream.tell()
+    window = stream.getView(start, SCAN_MAXIMUM + 5)
+    # Positions from here on don't have room for a code and length before the data runs out
+    checkablePositions = min(SCAN_MAXIMUM, len(window) - 5)
+    # Test every candidate offset in the window at once rather than reading and seeking back a byte at a time
+    for match in SENSIBLE_TWO_LETTER_CODE.finditer(window):
+        position = match.start()
+        if position >= checkablePositions:
+            break
+        thisLength = struct.unpack_from("<I", window, position + 2)[0]
         if maxDataLength is not None and thisLength > maxDataLength:
-            bad = True
-        if bad:
-            stream.seek(stream.tell() - 6)
-            unk += stream.read(1)
             continue
-        if len(unk) > 0:
-            if DEBUG: print(f"Scan search rejected {len(unk)} positions")
-        return (thisTwoLetterCode, thisLength, unk)
-    msg = f"Failed to find sensible two letter code and length at {stream.tell()}"
-    stream.seek(stream.tell()-SCAN_MAXIMUM)
+        if position > 0:
+            if DEBUG: print(f"Scan search rejected {position} positions")
+            recprofile.count("scanRejectedBytes", position)
+        stream.seek(start + position + 6)
+        return (str(window[position:position+2], "ascii"), thisLength, bytes(window[:position]))
+    if checkablePositions < SCAN_MAXIMUM:
+        raise struct.error(f"Ran out of data scanning for a two letter code and length at {start + max(checkablePositions, 0)}")
+    msg = f"Failed to find sensible two letter code and length at {start + SCAN_MAXIMUM}"
+    stream.seek(start)
     raise ScanFailureError(msg)
 
 class HierarchyTableEntry:
-    def __init__(self, stream: typing.BinaryIO, twoLetterCode: str, lengthBytes: int, preUnknown: bytes):
+    # Entries only remember where their data is, rather than holding a copy of it
+    __slots__ = ("twoLetterCode", "lengthBytes", "source", "offset", "preUnknown", "postUnknown")
+    def __init__(self, stream: StreamingDecompressor, twoLetterCode: str, lengthBytes: int, preUnknown: bytes):
         self.twoLetterCode = twoLetterCode
         self.lengthBytes = lengthBytes
-        self.data = stream.read(self.lengthBytes)
+        self.source = stream
+        self.offset = stream.tell()
+        stream.seek(self.offset + self.lengthBytes)
         self.preUnknown = preUnknown
         self.postUnknown = b""
+    @property
+    def view(self) -> memoryview:
+        return self.source.getView(self.offset, self.lengthBytes)
+    @property
+    def data(self) -> bytes:
+        return bytes(self.view)
     
 class HierarchyCollection:
-    def __init__(self, stream: typing.BinaryIO, preUnknown=b"", twoLetterCode=None, lengthBytes=None):
+    __slots__ = ("preUnknown", "postUnknown", "unkBeforeData", "twoLetterCode", "lengthBytes", "startPos", "entries", "seenCodes", "stream", "resumePos", "complete", "lazy", "pausable")
+    def __init__(self, stream: StreamingDecompressor, preUnknown=b"", twoLetterCode=None, lengthBytes=None, stopAfter: typing.Optional[typing.Iterable[str]]=None, lazy=False):
         self.preUnknown = preUnknown
         self.postUnknown = b""
         if twoLetterCode is None or lengthBytes is None:
@@ -107,38 +346,73 @@ class HierarchyCollection:
         self.startPos = stream.tell()
         if DEBUG: print(f"Entry collection {self.twoLetterCode} has total length {self.lengthBytes}, unkBeforeData = {self.unkBeforeData}, start reading entries at {stream.tell()}")
         self.entries = []
-        bytesLeft = self.lengthBytes
+        self.seenCodes = set()
+        self.stream = stream
+        self.resumePos = self.startPos
+        self.complete = False
+        # Lazy collections leave their child containers unread until something looks inside them
+        self.lazy = lazy
+        # Only collections given stopAfter may stop partway. Others always read everything once they start,
+        # as codes like P1 can appear more than once
+        self.pausable = stopAfter is not None
+        if lazy and stopAfter is None:
+            if DEBUG: print(f"Skip over lazy collection {self.twoLetterCode} to {self.startPos + self.lengthBytes}")
+            stream.seek(self.startPos + self.lengthBytes)
+            return
+        self.parseEntries(stopAfter)
+    def parseEntries(self, stopAfter: typing.Optional[typing.Iterable[str]]=None):
+        "Read entries until the end of the collection, or until a child with each of the codes in stopAfter has been read"
+        if self.complete:
+            return
+        waitingFor = None
+        if stopAfter is not None:
+            waitingFor = set(stopAfter) - self.seenCodes
+            if len(waitingFor) == 0:
+                return
+        stream = self.stream
+        stream.seek(self.resumePos)
+        bytesLeft = self.lengthBytes - (stream.tell() - self.startPos)
         while 1:
             try:
                 twoLetterCode, lengthBytes, thisUnk = scanForSensibleTwoLetterCodeAndLength(stream, bytesLeft)
             except ScanFailureError:
                 if DEBUG: print(f"Scan failed at {stream.tell()}, put all {bytesLeft} bytes into last post unknown...")
                 self.entries[-1].postUnknown += stream.read(bytesLeft)
-                return
+                break
             if twoLetterCode in has_substructure_given_parent and (has_substructure_given_parent[twoLetterCode] is None or self.twoLetterCode == has_substructure_given_parent[twoLetterCode]):
                 if DEBUG: print(f"Enter substructure for {twoLetterCode} with parent {self.twoLetterCode}")
-                self.entries.append(HierarchyCollection(stream, thisUnk, twoLetterCode, lengthBytes))
+                self.entries.append(HierarchyCollection(stream, thisUnk, twoLetterCode, lengthBytes, lazy=self.lazy))
             else:
                 thisEntry = HierarchyTableEntry(stream, twoLetterCode, lengthBytes, thisUnk)
                 self.entries.append(thisEntry)
                 if DEBUG: print(f"Read collection entry {len(self.entries)} {thisEntry.twoLetterCode} with {thisEntry.lengthBytes} bytes of data, finishing at {stream.tell()}")
+            self.seenCodes.add(twoLetterCode)
             bytesLeft = self.lengthBytes - (stream.tell() - self.startPos)
             #if DEBUG: print(f"{bytesLeft} bytes left")
             if bytesLeft < 0:
                 raise ValueError(f"{self.twoLetterCode} read {-1*bytesLeft} bytes too many at {stream.tell()}")
             if bytesLeft == 0:
                 if DEBUG: print(f"Stop: reached target length exactly")
-                return
+                break
             if bytesLeft < 6:
                 self.entries[-1].postUnknown += stream.read(bytesLeft)
-                return
-            else:
-                #print(f"Continue: {bytesLeft} bytes of data left")
-                pass
+                break
+            if waitingFor is not None:
+                waitingFor.discard(twoLetterCode)
+                if len(waitingFor) == 0:
+                    if DEBUG: print(f"Stop: found all of {stopAfter} in {self.twoLetterCode}, pausing at {stream.tell()}")
+                    self.resumePos = stream.tell()
+                    return
+            #print(f"Continue: {bytesLeft} bytes of data left")
+        self.complete = True
+        self.resumePos = stream.tell()
     def find(self, target: typing.Union[str, typing.List[str]]):
         if isinstance(target, str):
             return self.find([target])
         thisTarget = target[0]
+        if not self.complete:
+            # A collection paused by stopAfter carries on reading only until it reaches the code being looked for
+            self.parseEntries([thisTarget] if self.pausable else None)
         matching = []
         for entry in self.entries:
             if entry.twoLetterCode == thisTarget:
@@ -149,93 +423,420 @@ class HierarchyCollection:
                 else:
                     matching.append(entry)
         return matching
+    def query(self, paths: typing.Iterable[typing.Sequence[str]]) -> typing.Dict[typing.Tuple[str, ...], list]:
+        "find() several paths at once. On a lazy hierarchy, only the containers along these paths get read"
+        paths = [tuple(path) for path in paths]
+        if not self.complete and self.pausable:
+            self.parseEntries({path[0] for path in paths})
+        return {path: self.find(list(path)) for path in paths}
     
-def tryParsingHierarchy(stream: typing.BinaryIO) -> HierarchyCollection:
+def tryParsingHierarchy(stream: StreamingDecompressor, stopAfter: typing.Optional[typing.Iterable[str]]=None, lazy=False) -> HierarchyCollection:
+    """Parse the BG container. If stopAfter is given, stop reading top level children once one of each listed code has been read.
+    With lazy=True containers below BG are skipped over using their lengths and only read when find() or query() goes into them."""
     if stream.read(2) != b"BG":
         raise ValueError("Missing BG top level container")
     stream.seek(stream.tell()-2)
-    collection = HierarchyCollection(stream, twoLetterCode="BG")
+    collection = HierarchyCollection(stream, twoLetterCode="BG", stopAfter=stopAfter, lazy=lazy)
     return collection
 
-def parseMetadata(hierarchy: HierarchyCollection) -> typing.Dict[str, typing.Any]:
-    "Process a decompressed recorded game file, returning a dict of the metadata array"
+NODE_WINDOW_SIZE = 4*1024*1024
+NODE_VIEW_MAX_BYTES = 1024*1024
+
+# (codes of the containers the node is in, outermost first, its two letter code, offset of its data, length of its data,
+#  view of its data or None for containers and entries bigger than maxViewBytes)
+# The data after BG, which isn't divided into nodes, comes as events with no containers and a code of None
+NodeEvent = typing.Tuple[typing.Tuple[str, ...], typing.Optional[str], int, int, typing.Optional[memoryview]]
+
+def iterNodes(stream: typing.Union[StreamingDecompressor, WindowedDecompressor], containers: typing.Optional[typing.Dict[str, typing.Optional[str]]]=None,
+              maxViewBytes=NODE_VIEW_MAX_BYTES) -> typing.Iterator[NodeEvent]:
+    """Walk every node under BG in file order without building a HierarchyCollection, going into the codes in containers
+    (same format as has_substructure_given_parent, which is the default) and yielding everything else as an entry.
+    Containers are yielded before their children, and anything after BG is yielded maxViewBytes at a time with a code of None.
+    On a WindowedDecompressor everything before the node being yielded is released, so the whole file can be walked in constant memory.
+    Entries over maxViewBytes can be read with stream.iterData while they are being handled."""
+    if containers is None:
+        containers = has_substructure_given_parent
+    stream.seek(0)
+    if stream.getView(0, 2) != b"BG":
+        raise ValueError("Missing BG top level container")
+    code, length, unknown = scanForSensibleTwoLetterCodeAndLength(stream)
+    yield ((), code, stream.tell(), length, None)
+    # (code, offset of the end of its data) of each container the walk is in
+    stack = [(code, stream.tell() + length)]
+    path = (code,)
+    while len(stack) > 0:
+        parent, end = stack[-1]
+        bytesLeft = end - stream.tell()
+        if bytesLeft >= 6:
+            if isinstance(stream, WindowedDecompressor):
+                stream.release(stream.tell())
+            try:
+                code, length, unknown = scanForSensibleTwoLetterCodeAndLength(stream, bytesLeft)
+            except ScanFailureError:
+                # The rest is unknown, like a collection's last postUnknown
+                code = None
+        else:
+            code = None
+        if code is None:
+            stream.seek(end)
+            stack.pop()
+            path = path[:-1]
+            continue
+        offset = stream.tell()
+        if code in containers and (containers[code] is None or containers[code] == parent):
+            yield (path, code, offset, length, None)
+            stack.append((code, offset + length))
+            path += (code,)
+        else:
+            yield (path, code, offset, length, stream.getView(offset, length) if length <= maxViewBytes else None)
+            stream.seek(offset + length)
+    offset = stream.tell()
+    while True:
+        if isinstance(stream, WindowedDecompressor):
+            stream.release(offset)
+        view = stream.getView(offset, maxViewBytes)
+        if len(view) == 0:
+            break
+        yield ((), None, offset, len(view), view)
+        offset += len(view)
+
+class RecNodeIterator:
+    "The events from iterNodes over a recorded game, along with the stream they come from for reading entries too big to come with a view"
+    def __init__(self, stream: WindowedDecompressor, events: typing.Iterator[NodeEvent]):
+        self.stream = stream
+        self.events = events
+    def __iter__(self) -> "RecNodeIterator":
+        return self
+    def __next__(self) -> NodeEvent:
+        return next(self.events)
+    def iterData(self, offset: int, length: int, chunkSize=DECOMPRESS_CHUNK_SIZE) -> typing.Iterator[memoryview]:
+        "The data of the entry just yielded in pieces, which only holds one piece at a time. Has to be read before asking for the next event"
+        return self.stream.iterData(offset, length, chunkSize)
+
+def iterRecNodes(filepath: str, containers: typing.Optional[typing.Dict[str, typing.Optional[str]]]=None, windowSize=NODE_WINDOW_SIZE,
+                 maxViewBytes=NODE_VIEW_MAX_BYTES) -> RecNodeIterator:
+    """iterNodes over a recorded game file, decompressing it as it goes and holding about windowSize bytes of it at once.
+    Entries that come without a view can be read with iterData on what this returns"""
+    with open(filepath, "rb") as f:
+        compressed, origDataLength = readl33tZlibPayload(f)
+    stream = WindowedDecompressor(compressed, windowSize)
+    return RecNodeIterator(stream, iterNodes(stream, containers, min(maxViewBytes, windowSize // 2)))
+
+# Metadata key types: struct format of the value, or how many bytes to skip for types whose values aren't kept
+# Type 10 values are strings, formatted the same way as the key names
+METADATA_STRING_TYPE = 10
+METADATA_VALUE_FORMATS = {
+    # Also assuming int, unknown how it differs from 2
+    # Used for gameplayer0rating, could be uint32?
+    1: "<i",
+    # Looks very much like signed int32
+    2: "<i",
+    # Unknown, only case I've seen has a data area of two bytes which are both nulls
+    4: "<h",
+    # Assuming bool
+    6: "<?",
+}
+METADATA_SKIPPED_TYPES = {
+    # Only gamesyncstate uses this.
+    # I have no idea how to interpret its 8 bytes, whether they're useful in any way, or how to represent them in json, so ignoring it for now
+    3: 8,
+}
+# Widths of every fixed size type, for stepping over values that aren't wanted
+METADATA_VALUE_WIDTHS = {**{keyType: struct.calcsize(valueFormat) for keyType, valueFormat in METADATA_VALUE_FORMATS.items()}, **METADATA_SKIPPED_TYPES}
+# Types whose values are expected to be 0, worth a look when debugging if they aren't
+METADATA_USUALLY_ZERO_TYPES = (1, 4)
+METADATA_MAX_KEYS = 5000
+INT32 = struct.Struct("<i")
+
+def getMetadataTable(hierarchy: HierarchyCollection) -> typing.Tuple[memoryview, int, int]:
+    "Find the metadata table, returning (its data, number of keys, offset of the first key)"
     # For now I feel like the safest assumption I can make for the file format is
     # that the keys are written in the same order
     # Vs AI games don't seem to have the same data in them!
     keyContainer = hierarchy.find(["MP", "ST"])
     if len(keyContainer) != 1:
         raise ValueError(f"Found {len(keyContainer)} metadata entries (wanted 1). Recordings of single player games do not have this, and this renamer will not work on them")
-    stream = io.BytesIO(keyContainer[0].data)
+    data = keyContainer[0].view
     # unk 4 bytes at the start
-    stream.read(4)
-    numkeys = readInt32(stream)
-    if numkeys > 5000:
+    numkeys, offset = unpackInt32(data, 4)
+    if numkeys > METADATA_MAX_KEYS:
         raise ValueError(f"Failed num keys sanity check ({numkeys}). Something likely went wrong.")
+    return data, numkeys, offset
+
+def unpackMetadataValue(data: memoryview, offset: int, keyName: str, keyType: int) -> typing.Tuple[typing.Any, int]:
+    "Decode the value of a metadata key. Returns (value or None if it isn't kept, offset after it)"
+    valueFormat = METADATA_VALUE_FORMATS.get(keyType)
+    if valueFormat is not None:
+        keyValue = struct.unpack_from(valueFormat, data, offset)[0]
+        if DEBUG and keyType in METADATA_USUALLY_ZERO_TYPES and keyValue != 0:
+            print(f"Key {keyName} type {keyType} has nonzero value {keyValue}")
+        return keyValue, offset + METADATA_VALUE_WIDTHS[keyType]
+    if keyType == METADATA_STRING_TYPE:
+        return unpackUtf16(data, offset)
+    if keyType in METADATA_SKIPPED_TYPES:
+        return None, offset + METADATA_SKIPPED_TYPES[keyType]
+    raise ValueError(f"Metadata key {keyName} near offset {hex(offset)} has unknown type {keyType}")
+
+def skipMetadataValue(data: memoryview, offset: int, keyName: str, keyType: int) -> int:
+    "Step over the value of a metadata key without decoding it"
+    width = METADATA_VALUE_WIDTHS.get(keyType)
+    if width is not None:
+        return offset + width
+    if keyType == METADATA_STRING_TYPE:
+        return offset + 4 + 2*struct.unpack_from("<i", data, offset)[0]
+    raise ValueError(f"Metadata key {keyName} near offset {hex(offset)} has unknown type {keyType}")
+
+def parseMetadata(hierarchy: HierarchyCollection) -> typing.Dict[str, typing.Any]:
+    "Process a decompressed recorded game file, returning a dict of the whole metadata array"
+    data, numkeys, offset = getMetadataTable(hierarchy)
     metadata = {}
     for x in range(0, numkeys):
-        keyName = readUtf16(stream)
-        keyType = readInt32(stream)
-        keyValue: typing.Any = None
-        if keyType == 1:
-            # Also assuming int, unknown how it differs from 2
-            # Used for gameplayer0rating, could be uint32?
-            keyValue = readInt32(stream)
-            if keyValue != 0:
-                print(f"Key {keyName} type {keyType} has nonzero value {keyValue}")
-        elif keyType == 2:
-            # Looks very much like signed int32
-            keyValue = readInt32(stream)
-        elif keyType == 3:
-            # Only gamesyncstate uses this.
-            # I have no idea how to interpret its 8 bytes, whether they're useful in any way, or how to represent them in json, so ignoring it for now
-            stream.read(8)
-            keyValue = None
-        elif keyType == 4:
-            # Unknown, only case I've seen has a data area of two bytes which are both nulls
-            keyValue = struct.unpack("<h", stream.read(2))[0]
-            if keyValue != 0:
-                print(f"Key {keyName} type {keyType} has nonzero value {keyValue}")
-        elif keyType == 6:
-            # Assuming bool
-            keyValue = struct.unpack("<?", stream.read(1))[0]
-        elif keyType == 10:
-            # String, formatted the same way as the keynames
-            keyValue = readUtf16(stream)
-        else:
-            raise ValueError(f"Metadata key {keyName} near offset {hex(stream.tell())} has unknown type {keyType}")
-        
+        keyName, offset = unpackUtf16(data, offset)
+        keyType, offset = unpackInt32(data, offset)
+        keyValue, offset = unpackMetadataValue(data, offset, keyName, keyType)
         if keyValue is not None:
             metadata[keyName] = keyValue
     return metadata
-    
-def parseXMB(filepath: str, hierarchy: HierarchyCollection, output=False) -> typing.Dict[str, ET.Element]:
+
+# Recorded games can't have more players than this, so RENAME_METADATA_KEYS covers every key that might be wanted
+MAX_PLAYERS = 16
+RENAME_PLAYER_FIELDS = ("name", "teamid", "civ")
+# utf16 key name -> (field, player number or 0)
+RENAME_METADATA_KEYS: typing.Dict[bytes, typing.Tuple[str, int]] = {
+    "gamenumplayers".encode("utf-16-le"): ("gamenumplayers", 0),
+    "gamemapname".encode("utf-16-le"): ("gamemapname", 0),
+    **{f"gameplayer{playerIndex}{field}".encode("utf-16-le"): (field, playerIndex) for playerIndex in range(1, MAX_PLAYERS+1) for field in RENAME_PLAYER_FIELDS},
+}
+RENAME_METADATA_KEY_LENGTHS = set(len(key) for key in RENAME_METADATA_KEYS)
+RENAME_METADATA_KEY_NAMES = frozenset(key.decode("utf-16-le") for key in RENAME_METADATA_KEYS)
+
+# (extra keys, extra player fields) -> (RENAME_METADATA_KEYS with those added, their lengths), made by getRenameMetadataKeys
+extendedRenameMetadataKeys: typing.Dict[typing.Tuple[typing.Tuple[str, ...], typing.Tuple[str, ...]], typing.Tuple[typing.Dict[bytes, typing.Tuple[str, typing.Optional[int]]], typing.Set[int]]] = {}
+
+def getRenameMetadataKeys(extraKeys: typing.Tuple[str, ...], extraPlayerFields: typing.Tuple[str, ...]) -> typing.Tuple[typing.Dict[bytes, typing.Tuple[str, typing.Optional[int]]], typing.Set[int]]:
+    "The keys parseRenameMetadata looks for and their lengths, with extra ones mapped to (key name, None)"
+    if len(extraKeys) == 0 and len(extraPlayerFields) == 0:
+        return RENAME_METADATA_KEYS, RENAME_METADATA_KEY_LENGTHS
+    extended = extendedRenameMetadataKeys.get((extraKeys, extraPlayerFields))
+    if extended is None:
+        wanted: typing.Dict[bytes, typing.Tuple[str, typing.Optional[int]]] = dict(RENAME_METADATA_KEYS)
+        names = list(extraKeys) + [f"gameplayer{playerIndex}{field}" for playerIndex in range(1, MAX_PLAYERS+1) for field in extraPlayerFields]
+        for name in names:
+            wanted.setdefault(name.encode("utf-16-le"), (name, None))
+        extended = extendedRenameMetadataKeys[(extraKeys, extraPlayerFields)] = (wanted, set(len(key) for key in wanted))
+    return extended
+
+def listExtraMetadataKeys(numPlayers: int, extraKeys: typing.Iterable[str], extraPlayerFields: typing.Iterable[str]) -> typing.List[str]:
+    "Names of the extra keys wanted from a game with numPlayers players"
+    return list(extraKeys) + [f"gameplayer{playerIndex}{field}" for playerIndex in range(1, numPlayers+1) for field in extraPlayerFields]
+
+class RecMetadata:
+    "The metadata keys renaming uses, without everything else in the table"
+    __slots__ = ("numPlayers", "mapName", "playerNames", "playerTeams", "playerCivs", "extra")
+    def __init__(self, numPlayers: int, mapName: typing.Optional[str], playerNames: typing.List[typing.Optional[str]], playerTeams: typing.List[typing.Optional[int]], playerCivs: typing.List[typing.Optional[int]],
+                 extra: typing.Optional[typing.Dict[str, typing.Any]]=None):
+        self.numPlayers = numPlayers
+        self.mapName = mapName
+        # Indexed by player number - 1
+        self.playerNames = playerNames
+        self.playerTeams = playerTeams
+        self.playerCivs = playerCivs
+        # Any other keys the rename formats use, by name. None for ones the recorded game doesn't have
+        self.extra = extra if extra is not None else {}
+    def player(self, playerIndex: int) -> typing.Tuple[str, int, int]:
+        "(name, team id, civ id) of a player, counting from 1"
+        name, team, civ = self.playerNames[playerIndex-1], self.playerTeams[playerIndex-1], self.playerCivs[playerIndex-1]
+        if name is None or team is None or civ is None:
+            raise ValueError(f"Metadata is missing some of player {playerIndex}'s keys")
+        return name, team, civ
+    def findPlayer(self, name: str, civID: int) -> typing.Optional[int]:
+        "The number of the player with this name and civ"
+        for playerIndex in range(1, self.numPlayers+1):
+            if self.playerNames[playerIndex-1] == name and self.playerCivs[playerIndex-1] == civID:
+                return playerIndex
+        return None
+    def get(self, keyName: str) -> typing.Any:
+        "The value of a key read out of the metadata, None if it wasn't read or isn't there"
+        if keyName in self.extra:
+            return self.extra[keyName]
+        return self.toDict().get(keyName)
+    def toDict(self) -> typing.Dict[str, typing.Any]:
+        "The same keys and values as parseMetadata would have for these, along with the extra keys (as None if missing)"
+        metadata: typing.Dict[str, typing.Any] = {"gamenumplayers": self.numPlayers, **self.extra}
+        if self.mapName is not None:
+            metadata["gamemapname"] = self.mapName
+        for playerIndex in range(1, self.numPlayers+1):
+            for field, values in zip(RENAME_PLAYER_FIELDS, (self.playerNames, self.playerTeams, self.playerCivs)):
+                if values[playerIndex-1] is not None:
+                    metadata[f"gameplayer{playerIndex}{field}"] = values[playerIndex-1]
+        return metadata
+    @classmethod
+    def fromDict(cls, metadata: typing.Dict[str, typing.Any]) -> "RecMetadata":
+        "From toDict or parseMetadata's output. Keys besides the ones renaming always uses all go into extra"
+        numPlayers = metadata["gamenumplayers"]
+        players = range(1, numPlayers+1)
+        return cls(numPlayers, metadata.get("gamemapname"), [metadata.get(f"gameplayer{playerIndex}name") for playerIndex in players],
+                   [metadata.get(f"gameplayer{playerIndex}teamid") for playerIndex in players], [metadata.get(f"gameplayer{playerIndex}civ") for playerIndex in players],
+                   {keyName: value for keyName, value in metadata.items() if keyName not in RENAME_METADATA_KEY_NAMES})
+
+def parseRenameMetadata(hierarchy: HierarchyCollection, extraKeys: typing.Tuple[str, ...]=(), extraPlayerFields: typing.Tuple[str, ...]=()) -> RecMetadata:
+    """Read just the metadata keys renaming uses, stepping over everything else without decoding it and stopping once they have all been seen.
+    Also reads the keys in extraKeys, and gameplayerNfield for each player and each field in extraPlayerFields"""
+    data, numkeys, offset = getMetadataTable(hierarchy)
+    found: typing.Dict[typing.Tuple[str, int], typing.Any] = {}
+    extra: typing.Dict[str, typing.Any] = {}
+    numPlayers = None
+    wantedExtras: typing.List[str] = []
+    # Looked up once here rather than every key, this is the loop that runs for every key of every recorded game
+    unpackInt = INT32.unpack_from
+    wantedKeys, keyLengths = getRenameMetadataKeys(extraKeys, extraPlayerFields)
+    widths = METADATA_VALUE_WIDTHS
+    for x in range(0, numkeys):
+        keyEnd = offset + 4 + unpackInt(data, offset)[0]*2
+        keyType = unpackInt(data, keyEnd)[0]
+        wanted = wantedKeys.get(bytes(data[offset+4:keyEnd])) if keyEnd-offset-4 in keyLengths else None
+        offset = keyEnd + 4
+        if wanted is None:
+            width = widths.get(keyType)
+            if width is not None:
+                offset += width
+            else:
+                offset = skipMetadataValue(data, offset, "", keyType)
+            continue
+        if wanted[1] is None:
+            extra[wanted[0]], offset = unpackMetadataValue(data, offset, wanted[0], keyType)
+        else:
+            found[wanted], offset = unpackMetadataValue(data, offset, wanted[0], keyType)
+            if wanted[0] == "gamenumplayers":
+                numPlayers = found[wanted]
+                if numPlayers > MAX_PLAYERS:
+                    raise ValueError(f"Failed num players sanity check ({numPlayers}). Something likely went wrong.")
+                wantedExtras = listExtraMetadataKeys(numPlayers, extraKeys, extraPlayerFields)
+        if numPlayers is not None and len(found) >= 2 + 3*numPlayers and ("gamemapname", 0) in found and all((field, playerIndex) in found for playerIndex in range(1, numPlayers+1) for field in RENAME_PLAYER_FIELDS) \
+                and all(keyName in extra for keyName in wantedExtras):
+            break
+    if numPlayers is None:
+        raise ValueError("Metadata doesn't say how many players there were")
+    players = range(1, numPlayers+1)
+    return RecMetadata(numPlayers, found.get(("gamemapname", 0)), [found.get(("name", playerIndex)) for playerIndex in players],
+                       [found.get(("teamid", playerIndex)) for playerIndex in players], [found.get(("civ", playerIndex)) for playerIndex in players],
+                       {keyName: extra.get(keyName) for keyName in wantedExtras})
+
+def getGameFingerprint(hierarchy: HierarchyCollection, metadata: RecMetadata, ignoredKeys: typing.Collection[str]=()) -> str:
+    """Identify a game from its map, players and a hash of its metadata table, which is the same in every player's recording of it.
+    Keys in ignoredKeys are left out of the hash"""
+    data, numkeys, offset = getMetadataTable(hierarchy)
+    table = hashlib.blake2b(digest_size=16)
+    if len(ignoredKeys) == 0:
+        table.update(data)
+    else:
+        ignored = set(key.encode("utf-16-le") for key in ignoredKeys)
+        for x in range(0, numkeys):
+            keyStart = offset
+            keyEnd = offset + 4 + INT32.unpack_from(data, offset)[0]*2
+            keyType = INT32.unpack_from(data, keyEnd)[0]
+            offset = skipMetadataValue(data, keyEnd + 4, "", keyType)
+            if bytes(data[keyStart+4:keyEnd]) not in ignored:
+                table.update(data[keyStart:offset])
+    import json
+    fields = json.dumps([metadata.mapName, metadata.playerNames, metadata.playerTeams, metadata.playerCivs], ensure_ascii=False).encode("utf8")
+    return hashlib.blake2b(fields + table.digest(), digest_size=16).hexdigest()
+
+class PackedXMB:
+    "Where one XMB packed into a gd entry sits, so that it can be parsed only if it's wanted"
+    __slots__ = ("name", "container", "offset", "length")
+    def __init__(self, name: typing.Optional[str], container: HierarchyTableEntry, offset: int, length: int):
+        # None when the file is the only one in its container, and is named after its root element instead
+        self.name = name
+        self.container = container
+        self.offset = offset
+        self.length = length
+    def events(self) -> typing.Iterator["xmb.XMBEvent"]:
+        import xmb
+        return xmb.iterparseXMB(self.container.view[self.offset:self.offset+self.length])
+    def parse(self, indent=False) -> "ET.ElementTree":
+        import xmb
+        from xml.etree import ElementTree as ET
+        tree = xmb.buildTree(self.events())
+        if indent:
+            ET.indent(tree)
+        return tree
+
+def indexPackedXMBs(container: HierarchyTableEntry) -> typing.List[PackedXMB]:
+    "Walk the file table of a gd entry, using the length in each XMB's header to step over it without parsing it"
+    import xmb
+    data = container.view
+    offset = 1 #unknown
+    numFiles = struct.unpack_from("<I", data, offset)[0]
+    offset += 4
+    packed = []
+    for fileIndex in range(0, numFiles):
+        inheritedName = None
+        if numFiles != 1:
+            # read two strings
+            extraStrings = []
+            for stringIndex in range(0, 2):
+                length = struct.unpack_from("<I", data, offset)[0]
+                offset += 4
+                extraStrings.append(str(data[offset:offset+length*2], "utf-16-le"))
+                offset += length*2
+            inheritedName = os.path.basename(extraStrings[1])
+        if data[offset:offset+2] != b"X1":
+            raise xmb.XMBError(f"Packed file {fileIndex} of {numFiles} does not start with X1 at {offset}")
+        # "X1", then the length of everything after it
+        xmbLength = 6 + struct.unpack_from("<I", data, offset+2)[0]
+        if offset + xmbLength > len(data):
+            raise xmb.XMBError(f"Packed file {fileIndex} of {numFiles} at {offset} claims {xmbLength} bytes, more than its container has left")
+        packed.append(PackedXMB(inheritedName, container, offset, xmbLength))
+        offset += xmbLength
+    return packed
+
+def parseXMBSequentially(container: HierarchyTableEntry, indent=False) -> typing.Iterator[typing.Tuple[str, "ET.ElementTree"]]:
+    "Parse every XMB in a gd entry in order, for when the file table can't be walked using the XMB lengths"
+    import xmb
+    stream = io.BytesIO(container.view)
+    stream.read(1) #unknown
+    numFiles = struct.unpack("<I", stream.read(4))[0]
+    #log(f"Number of files {numFiles} at {stream.tell()}")
+    for fileIndex in range(0, numFiles):
+        if numFiles == 1:
+            inheritedName = None
+        else:
+            # read two strings
+            extraStrings = []
+            for stringIndex in range(0, 2):
+                length = struct.unpack("<I", stream.read(4))[0]
+                #print(f"read extra string length {length} at {stream.tell()}")
+                string = stream.read(length*2).decode("utf-16-le")
+                extraStrings.append(string)
+            inheritedName = extraStrings[1]
+        parsed = xmb.parseXMBStream(stream, indent=indent)
+        xmlName = parsed.getroot().tag
+        if inheritedName is not None:
+            xmlName = os.path.basename(inheritedName)
+        yield xmlName, parsed
+
+def parseXMB(filepath: str, hierarchy: HierarchyCollection, output=False, only: typing.Optional[typing.Collection[str]]=None) -> typing.Dict[str, "ET.ElementTree"]:
+    "Parse packed XMBs, or only those named in only. With output, also write them out as xml next to the recorded game"
     global config
+    import xmb
+    from xml.etree import ElementTree as ET
     containers = hierarchy.find(["GM", "GD", "gd"])
     out = {}
-    # TODO this parses the entire XMB content of the file, the bulk of which is of no interest here
     for container in containers:
-        stream = io.BytesIO(container.data)
-        stream.read(1) #unknown
-        numFiles = struct.unpack("<I", stream.read(4))[0]
-        #log(f"Number of files {numFiles} at {stream.tell()}")
-        for fileIndex in range(0, numFiles):
-            if numFiles == 1:
-                inheritedName = None
-            else:
-                # read two strings
-                extraStrings = []
-                for stringIndex in range(0, 2):
-                    length = struct.unpack("<I", stream.read(4))[0]
-                    #print(f"read extra string length {length} at {stream.tell()}")
-                    string = stream.read(length*2).decode("utf-16-le")
-                    extraStrings.append(string)
-                inheritedName = extraStrings[1]
-            
-        
-            parsed = xmb.parseXMBStream(stream)
-            xmlName = parsed.getroot().tag
-            if inheritedName is not None:
-                xmlName = os.path.basename(inheritedName)
+        try:
+            packedFiles = indexPackedXMBs(container)
+        except (xmb.XMBError, struct.error) as e:
+            log(f"Couldn't index packed XMBs ({e}), parsing all of them instead")
+            parsedFiles = parseXMBSequentially(container, indent=output)
+        else:
+            # Only pay for parsing what was asked for. A lone file is named after its root element, so has to be parsed to know
+            parsedFiles = ((packed.name, packed.parse(indent=output)) for packed in packedFiles if only is None or packed.name is None or packed.name in only)
+        for xmlName, parsed in parsedFiles:
+            if xmlName is None:
+                xmlName = parsed.getroot().tag
+            if only is not None and xmlName not in only:
+                continue
             if output:
                 targetDir = filepath+"_xml"
                 if not os.path.isdir(targetDir):
@@ -244,45 +845,163 @@ def parseXMB(filepath: str, hierarchy: HierarchyCollection, output=False) -> typ
                     f.write(ET.tostring(parsed.getroot()).decode("utf8"))
             out[xmlName] = parsed
             #log(f"Found xmb: {xmlName}")
-        
-        #if stream.read(1) != b"g":
-        #    # We'd probably expect this to be the case on the last entry
-        #    if x != numXmbs-1:
-        #        raise ValueError(f"Abort at {stream.tell()}: parsed xmb does not end on 'g' byte")
-        #    stream.seek(stream.tell()-1)
-        #    break        
-        #stream.seek(stream.tell()+6)
-    #print(f"Finished at {stream.tell()} = {hex(stream.tell())}")
     return out
 
-def renameRec(filepath: str, metadata: typing.Dict[str, typing.Any], hierarchy: HierarchyCollection):
+def civNamesFromEvents(events: typing.Iterator["xmb.XMBEvent"]) -> typing.Optional[typing.List[typing.Optional[str]]]:
+    "Pull the name of each civ out of the civs XMB without building a tree. None if this isn't the civs XMB"
+    civNames = []
+    depth = 0
+    for event, tag, attribs, text in events:
+        if event == "end":
+            depth -= 1
+            continue
+        depth += 1
+        if depth == 1 and tag != "civs":
+            return None
+        if depth == 2 and tag == "civ":
+            civNames.append(None)
+        elif depth == 3 and tag == "name" and len(civNames) > 0 and civNames[-1] is None:
+            civNames[-1] = text
+    return civNames
+
+# Civ name tables already read out of packed game data, by getBuildFingerprint
+civTables: typing.Dict[str, typing.List[typing.Optional[str]]] = {}
+# Tables this process has read since readRecInfo last handed them on to be saved
+learnedCivTables: typing.Dict[str, typing.List[typing.Optional[str]]] = {}
+# Fingerprint of the table the last recorded game used, for readRecInfo to hand on so it can be kept from expiring
+usedCivTable: typing.Optional[str] = None
+
+BUILD_KEY_WORDS = ("version", "build")
+BUILD_KEY_PATTERNS = tuple(word.encode("utf-16-le") for word in BUILD_KEY_WORDS)
+
+def getBuildFingerprint(hierarchy: HierarchyCollection) -> typing.Optional[str]:
+    """Something that changes between game builds, worked out from the metadata keys naming a version or build.
+    Without any of those, the packed civs XMB itself. None if that can't be found either"""
+    data, numkeys, offset = getMetadataTable(hierarchy)
+    buildKeys = {}
+    for x in range(0, numkeys):
+        keyLength, offset = unpackInt32(data, offset)
+        keyEnd = offset + keyLength*2
+        keyType = struct.unpack_from("<i", data, keyEnd)[0]
+        # Lowercasing the utf16 bytes only touches ascii letters, which is enough to rule out names that can't contain the words
+        if any(pattern in bytes(data[offset:keyEnd]).lower() for pattern in BUILD_KEY_PATTERNS):
+            keyName = str(data[offset:keyEnd], "utf-16-le")
+            if any(word in keyName.lower() for word in BUILD_KEY_WORDS):
+                keyValue, offset = unpackMetadataValue(data, keyEnd + 4, keyName, keyType)
+                if keyValue is not None:
+                    buildKeys[keyName] = keyValue
+                continue
+        offset = skipMetadataValue(data, keyEnd + 4, "", keyType)
+    if len(buildKeys) == 0:
+        return getCivsXMBFingerprint(hierarchy)
+    return hashlib.sha1("\n".join(f"{key}={buildKeys[key]}" for key in sorted(buildKeys)).encode("utf8")).hexdigest()
+
+def getCivsXMBFingerprint(hierarchy: HierarchyCollection) -> typing.Optional[str]:
+    "Hash of the packed civs XMB, which can be found and hashed without parsing it. Recorded games with the same one have the same civ names"
+    import xmb
+    for container in hierarchy.find(["GM", "GD", "gd"]):
+        try:
+            packedFiles = indexPackedXMBs(container)
+        except (xmb.XMBError, struct.error):
+            return None
+        for packed in packedFiles:
+            if packed.name == "civs":
+                return "civs:" + hashlib.blake2b(container.view[packed.offset:packed.offset+packed.length], digest_size=16).hexdigest()
+    return None
+
+def lookupCivNames(filepath: str, hierarchy: HierarchyCollection) -> typing.List[typing.Optional[str]]:
+    "Civ names for this recorded game's build: from the table of a previous recorded game of the same build if there is one"
+    global usedCivTable
+    fingerprint = getBuildFingerprint(hierarchy)
+    usedCivTable = fingerprint
+    if fingerprint is not None and fingerprint in civTables:
+        recprofile.count("civTableHits")
+        return civTables[fingerprint]
+    recprofile.count("xmbFallbacks")
+    with recprofile.stage("xmb"):
+        civNames = readCivNames(filepath, hierarchy)
+    if fingerprint is not None:
+        civTables[fingerprint] = civNames
+        learnedCivTables[fingerprint] = civNames
+    return civNames
+
+def readCivNames(filepath: str, hierarchy: HierarchyCollection) -> typing.List[typing.Optional[str]]:
+    "Names of the civs in the packed game data, in civ id order starting from 1"
+    import xmb
+    for container in hierarchy.find(["GM", "GD", "gd"]):
+        try:
+            packedFiles = indexPackedXMBs(container)
+        except (xmb.XMBError, struct.error):
+            break
+        for packed in packedFiles:
+            if packed.name in ("civs", None):
+                civNames = civNamesFromEvents(packed.events())
+                if civNames is not None:
+                    return civNames
+    # Couldn't find it the quick way, so fall back to parsing whole trees
+    civs = parseXMB(filepath, hierarchy, only={"civs"})["civs"]
+    return [civElem.find("name").text for civElem in civs.findall("civ")]
+
+class RecInfo:
+    "Everything renaming needs to know about a recorded game, so it can be cached instead of parsed again"
+    def __init__(self, metadata: typing.Optional[RecMetadata], teams: typing.Optional[typing.List[typing.List[typing.Tuple[str, int]]]]=None, godNames: typing.Optional[typing.Dict[int, str]]=None):
+        # None for a known copy of another game, which isn't read
+        self.metadata = metadata
+        # The whole metadata table, only read when it is going to be written out as json or exported
+        self.fullMetadata: typing.Optional[typing.Dict[str, typing.Any]] = None
+        # [[(player name, civ id), ...] for each team], None if not resolved
+        self.teams = teams
+        # civ id -> god name as resolved when the file was parsed
+        self.godNames = godNames
+        # Civ name tables read out of this file's packed game data, for the main process to remember
+        self.learnedCivTables: typing.Dict[str, typing.List[typing.Optional[str]]] = {}
+        # Fingerprint of the civ name table used to name its gods, if one was
+        self.civTableFingerprint: typing.Optional[str] = None
+        # Hash of the compressed game data, identifying the game for the export however the file is named. Only worked out when exporting
+        self.gameId: typing.Optional[str] = None
+        # Identifies the game (rather than this recording of it) for finding other players' copies. Only worked out when looking for them
+        self.fingerprint: typing.Optional[str] = None
+        # (path, name it was renamed to) of the first copy of the game processed, if this is another copy of it
+        self.duplicateOf: typing.Optional[typing.Tuple[str, typing.Optional[str]]] = None
+        # Memory the decompressed data took up while it was read, for the memory governor. None if it wasn't read
+        self.memoryUsed: typing.Optional[int] = None
+    def getGodName(self, civID: int) -> str:
+        global config
+        # Prefer the ini so that changes there apply to cached recorded games too
+        godName = config.get("rename", f"God{civID}", fallback=None)
+        if godName is None:
+            godName = self.godNames.get(civID, f"Unk{civID}")
+        return godName
+
+def resolveTeams(filepath: str, metadata: RecMetadata, hierarchy: HierarchyCollection) -> typing.Tuple[typing.List[typing.List[typing.Tuple[str, int]]], typing.Dict[int, str]]:
+    "Work out which players were on which team and the names of their gods, returning (teams, god names by civ id)"
     global config
-    nameTemplate = config.get("rename", "RenameFormat")
-    playerTemplate = config.get("rename", "RenameFormatPlayer")
     playersByTeam = {}
-    playerGodNames = {}
-    xmbs = None
-    for playerIndex in range(1, metadata["gamenumplayers"]+1):
-        thisTeam = metadata[f"gameplayer{playerIndex}teamid"]
-        thisName = metadata[f"gameplayer{playerIndex}name"]
-        thisGodID = metadata[f"gameplayer{playerIndex}civ"]
+    playerGodIDs = {}
+    godNames = {}
+    civNames = None
+    for playerIndex in range(1, metadata.numPlayers+1):
+        thisName, thisTeam, thisGodID = metadata.player(playerIndex)
         thisGod = config.get("rename", f"God{thisGodID}", fallback=None)
         # If god id not defined (eg future DLC), go into the xmb data and get it
         if thisGod is None:
-            # Delay parsing xmbs if not required. It's slow and currently will parse all packed XMBs and not just major gods
-            if xmbs is None:
-                xmbs = parseXMB(filepath, hierarchy)
             try:
-                civElem = xmbs["civs"].findall("civ")[thisGodID-1]
-                thisGod = civElem.find("name").text
+                # Delay reading xmbs if not required
+                if civNames is None:
+                    # Set first so that if looking them up fails, the other unknown gods don't go through it all again
+                    civNames = []
+                    civNames = lookupCivNames(filepath, hierarchy)
+                thisGod = civNames[thisGodID-1]
+                if thisGod is None:
+                    raise ValueError(f"civ {thisGodID} has no name")
             except Exception:
                 thisGod = f"Unk{thisGodID}"
                 log(f"Failed to get name for god id {thisGodID} from packed game data, using '{thisGod}' instead")
-        playerGodNames[playerIndex] = thisGod
-        thisPlayerString = playerTemplate.replace("{PLAYER}", thisName).replace("{GOD}", thisGod)
+        playerGodIDs[playerIndex] = thisGodID
+        godNames[thisGodID] = thisGod
         if thisTeam not in playersByTeam:
             playersByTeam[thisTeam] = []
-        playersByTeam[thisTeam].append(thisPlayerString)
+        playersByTeam[thisTeam].append((thisName, thisGodID))
         
     
     # The profile keys derived metadata doesn't contain final team IDs - randoms will show as -1
@@ -295,7 +1014,8 @@ def renameRec(filepath: str, metadata: typing.Dict[str, typing.Any], hierarchy:
         playerNumber = 0
         for dataContainer in playerTreeData:
             # This may have some empty sections in, for some reason
-            if len(dataContainer.data) < 5:
+            data = dataContainer.view
+            if len(data) < 5:
                 continue
             # We do not care about mother nature
             if playerNumber > 0:
@@ -305,86 +1025,503 @@ def renameRec(filepath: str, metadata: typing.Dict[str, typing.Any], hierarchy:
                 # bytes[9]: nulls
                 # String: the name a second time
                 # int32: team id
-                stream = io.BytesIO(dataContainer.data)
-                readPlayerNumber = readInt32(stream)
-                stream.read(1)
+                readPlayerNumber, offset = unpackInt32(data, 0)
+                offset += 1
                 if readPlayerNumber != playerNumber:
                     raise ValueError(f"Binary player data mismatch: expected player number {playerNumber}, found {readPlayerNumber} instead")
-                nameOne = readUtf16(stream)
-                stream.read(9)
-                nameTwo = readUtf16(stream)
+                nameOne, offset = unpackUtf16(data, offset)
+                offset += 9
+                nameTwo, offset = unpackUtf16(data, offset)
                 if nameOne != nameTwo:
                     raise ValueError(f"Binary player data mismatch: packed player names for p{playerNumber} did not match")
-                thisTeam = readInt32(stream)
+                thisTeam, offset = unpackInt32(data, offset)
                 if thisTeam not in playersByTeam:
                     playersByTeam[thisTeam] = []
-                thisPlayerString = playerTemplate.replace("{PLAYER}", nameOne).replace("{GOD}", playerGodNames[playerNumber])
-                playersByTeam[thisTeam].append(thisPlayerString)
+                playersByTeam[thisTeam].append((nameOne, playerGodIDs[playerNumber]))
                 
             playerNumber += 1
-    teamStrings = []
-    for teamID, teamPlayerStrings in playersByTeam.items():
-        teamStrings.append(" ".join(teamPlayerStrings))
-    playerString = " vs ".join(teamStrings)
-    
-    name = nameTemplate.replace("{PLAYERS}", playerString)
-    name = name.replace("{MAP}", metadata["gamemapname"].title())
+    return list(playersByTeam.values()), godNames
+
+def getRecDate(filepath: str) -> str:
+    "When a recorded game was played (as YYYY-MM-DD), from its name if the game put the date in it or when the file was created otherwise"
     # Check for a timestamp in the filename already - eg Record Game 2024-09-21 04-34-17 giza Poseidon-Isis.mythrec
     existingTimestamp = re.match("Record Game (\\d{4})-(\\d{2})-(\\d{2})", os.path.split(filepath)[1])
     if existingTimestamp is not None:
-        year, month, day = map(int, existingTimestamp.groups())
-        timestamp = datetime.date(year, month, day)
-    else:
-        timestamp = datetime.date.fromtimestamp(os.path.getctime(filepath))
-    name = name.replace("{TIMESTAMP}", timestamp.strftime("%Y-%m-%d"))
-    head, tail = os.path.split(filepath)
-    trailingCharacters = ""
-    if config.getboolean("rename", "MarkRenamedRecs", fallback=True):
-        trailingCharacters += "_"
-    maxFilenameLength = int(config.get("rename", "MaxFilenameLength"))
-    if len(name) > maxFilenameLength:
-        name = name[:maxFilenameLength]
-    for illegalchar in ILLEGAL_FILENAME_CHARACTERS:
-        name = name.replace(illegalchar, ".")
-    newfilepath = os.path.join(head, name) + trailingCharacters + ".mythrec"
-    
-    attempt = 2
-    while os.path.isfile(newfilepath):
-        newfilepath = os.path.join(head, name) + str(attempt) + trailingCharacters + ".mythrec"
-        attempt += 1
-    log(f"Renaming: {filepath} -> {newfilepath}")
-    os.rename(filepath, newfilepath)
-    for extra in (".json", ".decompressed"):
-        if os.path.isfile(filepath + extra):
-            log(f"Renaming: {filepath + extra} -> {newfilepath + extra}")
-            os.rename(filepath + extra, newfilepath + extra)
-
-def processFile(filepath: str):
+        return "-".join(existingTimestamp.groups())
+    return time.strftime("%Y-%m-%d", time.localtime(os.path.getctime(filepath)))
+
+def formatMetadataValue(value: typing.Any) -> str:
+    "How a metadata key's value goes into a name: empty if the recorded game doesn't have it"
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return str(value)
+
+def formatGameLength(seconds: typing.Optional[int]) -> str:
+    if seconds is None:
+        return ""
+    seconds = int(seconds)
+    return f"{seconds // 60}m{seconds % 60:02d}s"
+
+def getRenameKey(filepath: str, info: RecInfo, keyName: str) -> typing.Any:
+    "The value of a metadata key a rename field needs, logging it if the recorded game doesn't have it so the field is left empty"
+    value = info.metadata.get(keyName)
+    if value is None:
+        log(f"{filepath} has no {keyName} in its metadata, leaving its field in the name empty")
+    return value
+
+def resolveLength(filepath: str, info: RecInfo, argument: typing.Optional[str]) -> str:
+    try:
+        return formatGameLength(getRenameKey(filepath, info, "gamelength"))
+    except (TypeError, ValueError):
+        log(f"{filepath} has a gamelength of {info.metadata.get('gamelength')!r}, which isn't a number of seconds, leaving it out of the name")
+        return ""
+
+def resolveMap(filepath: str, info: RecInfo, argument: typing.Optional[str]) -> str:
+    if info.metadata.mapName is None:
+        raise ValueError("Metadata doesn't have the map name")
+    return info.metadata.mapName.title()
+
+def resolvePlayers(filepath: str, info: RecInfo, argument: typing.Optional[str]) -> str:
+    plan = getRenamePlan()
+    players = [player for team in info.teams for player in team]
+    # Each field for every player at once, then each player's entry from those
+    columns = [resolve(info, players, fieldArgument) for resolve, fieldArgument in plan.playerResolvers]
+    playerStrings = list(map(plan.player.format.format, *columns)) if len(columns) > 0 else [plan.player.format.format()]*len(players)
+    teamStrings = []
+    start = 0
+    for team in info.teams:
+        teamStrings.append(" ".join(playerStrings[start:start+len(team)]))
+        start += len(team)
+    return " vs ".join(teamStrings)
+
+def resolveRanked(filepath: str, info: RecInfo, argument: typing.Optional[str]) -> str:
+    ranked = getRenameKey(filepath, info, "gameranked")
+    if ranked is None:
+        return ""
+    return "Ranked" if ranked else "Unranked"
+
+def resolvePlayerKey(info: RecInfo, players: typing.List[typing.Tuple[str, int]], field: str) -> typing.List[str]:
+    "The value of gameplayerNfield for each player"
+    values = []
+    for playerName, civID in players:
+        playerIndex = info.metadata.findPlayer(playerName, civID)
+        values.append("" if playerIndex is None else formatMetadataValue(info.metadata.get(f"gameplayer{playerIndex}{field}")))
+    return values
+
+# How to fill in each field RenameFormat can use, given (file, its info, the field's argument)
+RENAME_FIELD_RESOLVERS: typing.Dict[str, typing.Callable[[str, RecInfo, typing.Optional[str]], str]] = {
+    "TIMESTAMP": lambda filepath, info, argument: getRecDate(filepath),
+    "PLAYERS": resolvePlayers,
+    "MAP": resolveMap,
+    "LENGTH": resolveLength,
+    "MODE": resolveRanked,
+    "KEY": lambda filepath, info, argument: formatMetadataValue(info.metadata.get(argument)),
+}
+# And each field RenameFormatPlayer can use, for every player at once, given (info, [(player name, civ id), ...], the field's argument)
+RENAME_PLAYER_FIELD_RESOLVERS: typing.Dict[str, typing.Callable[[RecInfo, typing.List[typing.Tuple[str, int]], typing.Optional[str]], typing.List[str]]] = {
+    "PLAYER": lambda info, players, argument: [playerName for playerName, civID in players],
+    "GOD": lambda info, players, argument: [info.getGodName(civID) for playerName, civID in players],
+    "RATING": lambda info, players, argument: resolvePlayerKey(info, players, "rating"),
+    "KEY": resolvePlayerKey,
+}
+
+class RenamePlan:
+    "RenameFormat and RenameFormatPlayer parsed, along with what naming a recorded game with them needs read out of it"
+    def __init__(self, nameFormat: str, playerFormat: str, maxLength: int):
+        self.name = rectemplate.Template(nameFormat, RENAME_FIELD_RESOLVERS)
+        self.player = rectemplate.Template(playerFormat, RENAME_PLAYER_FIELD_RESOLVERS)
+        # What fills in each of the templates' fields, looked up once here rather than for every recorded game
+        self.nameResolvers = [(RENAME_FIELD_RESOLVERS[field.name], field.argument) for field in self.name.fields]
+        self.playerResolvers = [(RENAME_PLAYER_FIELD_RESOLVERS[field.name], field.argument) for field in self.player.fields]
+        self.maxLength = maxLength
+        # The player format only comes into it through PLAYERS
+        self.needsTeams = self.name.uses("PLAYERS")
+        extraKeys = self.name.arguments("KEY")
+        if self.name.uses("LENGTH"):
+            extraKeys.append("gamelength")
+        if self.name.uses("MODE"):
+            extraKeys.append("gameranked")
+        extraPlayerFields = []
+        if self.needsTeams:
+            extraPlayerFields = self.player.arguments("KEY")
+            if self.player.uses("RATING"):
+                extraPlayerFields.append("rating")
+        # Metadata keys to read besides the ones always read, without repeats
+        self.extraKeys = tuple(keyName for keyName in dict.fromkeys(extraKeys) if keyName not in RENAME_METADATA_KEY_NAMES)
+        self.extraPlayerFields = tuple(field for field in dict.fromkeys(extraPlayerFields) if field not in RENAME_PLAYER_FIELDS)
+
+    def build(self, filepath: str, info: RecInfo) -> str:
+        name = self.name.render([resolve(filepath, info, argument) for resolve, argument in self.nameResolvers])
+        if len(name) > self.maxLength:
+            name = name[:self.maxLength]
+        for illegalchar in ILLEGAL_FILENAME_CHARACTERS:
+            name = name.replace(illegalchar, ".")
+        return name
+
+# The rename formats from the ini, parsed the first time they are needed
+renamePlan: typing.Optional[RenamePlan] = None
+
+def getRenamePlan() -> RenamePlan:
+    global config, renamePlan
+    if renamePlan is None:
+        renamePlan = RenamePlan(config.get("rename", "RenameFormat"), config.get("rename", "RenameFormatPlayer"), int(config.get("rename", "MaxFilenameLength")))
+    return renamePlan
+
+def getExtraMetadataKeys() -> typing.Tuple[typing.Tuple[str, ...], typing.Tuple[str, ...]]:
+    "(extra keys, extra player fields) parseRenameMetadata should read for the rename formats"
     global config
-    with open(filepath, "rb") as f:
-        decompressed = decompressl33tZlib(f, RECORDED_GAME_MAX_DECOMPRESS_SIZE)
+    if not config.getboolean("rename", "Rename", fallback=True):
+        return (), ()
+    plan = getRenamePlan()
+    return plan.extraKeys, plan.extraPlayerFields
+
+def buildRecName(filepath: str, info: RecInfo) -> str:
+    "Work out what a recorded game should be called, without the collision number, renamed marker or extension"
+    return getRenamePlan().build(filepath, info)
+
+# Renames planned so far this batch, done by applyRenames
+renamePlanner: typing.Optional[recrename.RenamePlanner] = None
+
+def moveRec(filepath: str, name: str, folder: typing.Optional[str]=None) -> str:
+    """Plan renaming a recorded game (and its output files) to name, numbering it if that is already taken, optionally moving it to folder.
+    Returns the new path, which applyRenames moves it to"""
+    global config, renamePlanner
+    if shard is not None:
+        # Shards leave renaming to the merge, which can see the names every shard wants
+        entry = getShardEntry(filepath)
+        entry["name"] = name
+        entry["folder"] = None if folder is None else os.path.relpath(folder, shardFolders[filepath][1])
+        return filepath
+    if renamePlanner is None:
+        trailingCharacters = ""
+        if config.getboolean("rename", "MarkRenamedRecs", fallback=True):
+            trailingCharacters += "_"
+        renamePlanner = recrename.RenamePlanner(trailingCharacters)
+    newfilepath, collisions = renamePlanner.plan(filepath, name, folder)
+    recprofile.count("renameCollisions", collisions)
+    return newfilepath
+
+def getRenameJournalPath() -> str:
+    return os.path.join(os.path.dirname(CONFIG_FILE), RENAME_JOURNAL_FILE)
+
+def recMoved(oldpath: str, newpath: str):
+    "Keep track of a recorded game that was just renamed"
+    if cache is not None:
+        cache.move(oldpath, newpath)
+    if stats is not None:
+        stats.move(oldpath, newpath)
+
+def applyRenames() -> typing.Dict[str, str]:
+    "Do every rename planned by moveRec since last time (or with DryRun, just log them). Returns where each of those files ended up"
+    global config
+    if renamePlanner is None:
+        return {}
+    if config.getboolean("rename", "DryRun", fallback=False):
+        return renamePlanner.dryRun(log)
+    return renamePlanner.apply(log, getRenameJournalPath(), recMoved)
+
+def recoverRenames():
+    "Finish off (or roll back) a batch of renames that was interrupted last time"
+    global config
+    journalPath = getRenameJournalPath()
+    if not os.path.isfile(journalPath):
+        return
+    rollBack = config.get("rename", "InterruptedRenames", fallback="Resume").strip().lower() == "rollback"
+    log(f"Found renames interrupted last time, {'rolling them back' if rollBack else 'finishing them off'}")
+    recrename.recoverJournal(journalPath, rollBack, log, recMoved)
+
+def renameRec(filepath: str, metadata: RecMetadata, hierarchy: HierarchyCollection) -> str:
+    info = RecInfo(metadata)
+    if getRenamePlan().needsTeams:
+        info.teams, info.godNames = resolveTeams(filepath, metadata, hierarchy)
+    return moveRec(filepath, buildRecName(filepath, info))
+
+def listTopLevelSections(hierarchy: HierarchyCollection) -> typing.List["recindex.Section"]:
+    "BG and each of its children, as (two letter code, offset of its data, length of its data)"
+    try:
+        # Finish reading the top level, which only skips over the children
+        hierarchy.parseEntries(None)
+    except (ValueError, struct.error, ScanFailureError) as e:
+        log(f"Couldn't read all of the top level of the hierarchy ({e}), the index will only have the sections before that")
+    sections = [(hierarchy.twoLetterCode, hierarchy.startPos, hierarchy.lengthBytes)]
+    for entry in hierarchy.entries:
+        if isinstance(entry, HierarchyCollection):
+            sections.append((entry.twoLetterCode, entry.startPos, entry.lengthBytes))
+        else:
+            sections.append((entry.twoLetterCode, entry.offset, entry.lengthBytes))
+    return sections
+
+DUPLICATE_ACTIONS = ("skip", "link", "group")
+
+def duplicateAction() -> typing.Optional[str]:
+    "What to do with other copies of games already processed (skip, link or group), or None to not look for them"
+    global config
+    action = config.get("duplicates", "Duplicates", fallback="").strip().lower()
+    if action == "":
+        return None
+    if action not in DUPLICATE_ACTIONS:
+        raise ValueError(f"Unknown Duplicates setting {action}, expected one of {', '.join(DUPLICATE_ACTIONS)}")
+    return action
+
+def getDuplicateIgnoredKeys() -> typing.List[str]:
+    global config
+    return [key.strip() for key in config.get("duplicates", "DuplicateIgnoreKeys", fallback="").split("|") if key.strip() != ""]
+
+def getDuplicatesFolder() -> str:
+    global config
+    return config.get("duplicates", "DuplicatesFolder", fallback="_duplicates").strip()
+
+def findOriginal(filepath: str, fingerprint: str) -> typing.Optional[typing.Tuple[str, typing.Optional[str]]]:
+    "(path, name) of the first copy processed of the game with this fingerprint, if there is one besides filepath itself"
+    if cache is None:
+        return None
+    original = cache.lookupOriginal(fingerprint)
+    if original is None:
+        return None
+    # If the first copy has gone, this one takes its place
+    if os.path.normcase(os.path.abspath(original[0])) == os.path.normcase(os.path.abspath(filepath)) or not os.path.isfile(original[0]):
+        return None
+    return original
+
+def linkDuplicate(filepath: str, originalPath: str):
+    "Replace a copy of a recorded game with a hard link to the first copy, so they only take up space once"
+    global config
+    if config.getboolean("rename", "DryRun", fallback=False):
+        log(f"Would link: {filepath} -> {originalPath}")
+        return
+    if os.path.samefile(filepath, originalPath):
+        return
+    temporary = filepath + ".link"
+    try:
+        os.link(originalPath, temporary)
+        os.replace(temporary, filepath)
+    except OSError as e:
+        # eg on a different drive, or a filesystem without hard links
+        log(f"Couldn't link {filepath} to {originalPath}, leaving it as it is: {e}")
+        if os.path.isfile(temporary):
+            os.remove(temporary)
+        return
+    log(f"Linked: {filepath} -> {originalPath}")
+
+def finishDuplicate(filepath: str, info: RecInfo) -> str:
+    "Skip, link or group a copy of a game that has already been processed. Returns where the file ended up"
+    originalPath, originalName = info.duplicateOf
+    log(f"{filepath} is a copy of {originalPath}")
+    recprofile.count("duplicates")
+    action = duplicateAction()
+    if action == "group":
+        if originalName is None:
+            originalName = os.path.splitext(os.path.basename(originalPath))[0]
+        with recprofile.stage("rename"):
+            return moveRec(filepath, originalName, os.path.join(os.path.dirname(filepath), getDuplicatesFolder()))
+    if action == "link":
+        linkDuplicate(filepath, originalPath)
+    cache.storeDuplicate(filepath, info.fingerprint)
+    return filepath
+
+def statsEnabled() -> bool:
+    global config
+    return config.getboolean("stats", "Stats", fallback=False)
+
+def exportEnabled() -> bool:
+    global config
+    return config.get("export", "Export", fallback="").strip() != ""
+
+def needsTeams() -> bool:
+    "Whether teams and gods need working out, which is more than just reading the metadata"
+    global config
+    return (config.getboolean("rename", "Rename", fallback=True) and getRenamePlan().needsTeams) or exportEnabled() or statsEnabled()
+
+def makeExportRecord(filepath: str, info: RecInfo) -> "recexport.ExportRecord":
+    "Everything the export has on a recorded game, apart from where it ends up after renaming"
+    teamNumbers = {}
+    teams = []
+    for teamIndex, team in enumerate(info.teams, 1):
+        teams.append([playerName for playerName, civID in team])
+        for player in team:
+            teamNumbers[player] = teamIndex
+    players = []
+    for playerIndex in range(1, info.metadata.numPlayers+1):
+        name, team, civID = info.metadata.player(playerIndex)
+        players.append({"number": playerIndex, "name": name, "team": teamNumbers.get((name, civID), team), "civ": civID, "god": info.getGodName(civID)})
+    return {"id": info.gameId, "file": None, "originalFile": os.path.abspath(filepath), "timestamp": getRecDate(filepath),
+            "map": info.metadata.mapName, "players": players, "teams": teams, "metadata": info.fullMetadata}
+
+def readRecInfo(filepath: str) -> RecInfo:
+    "Parse a recorded game, writing any of the development outputs that need the parsed data"
+    global config
+    checkpoints = None
+    if config.getboolean("development", "OutputIndex", fallback=False):
+        import recindex
+        checkpoints = recindex.CheckpointIndexBuilder(int(config.getfloat("development", "IndexCheckpointMB", fallback=4)*1024*1024))
+    with recprofile.stage("read"):
+        with open(filepath, "rb") as f:
+            decompressed = decompressl33tZlib(f, RECORDED_GAME_MAX_DECOMPRESS_SIZE, streaming=True, checkpoints=checkpoints,
+                                              spillAbove=getMemoryShare(), spillFolder=config.get("recprocessor", "SpillFolder", fallback="").strip())
     
     if config.getboolean("development", "OutputDecompressed", fallback=False):
-        decompressed.seek(0)
-        with open(filepath + ".decompressed", "wb") as f:
-            f.write(decompressed.read())
-        decompressed.seek(0)
-    hierarchy = tryParsingHierarchy(decompressed)
-    metadata = parseMetadata(hierarchy)
-    if config.getboolean("development", "OutputJson", fallback=False):
-        with open(filepath + ".json", "w") as f:
-            json.dump(metadata, f, indent=1)
+        with recprofile.stage("outputDecompressed"):
+            decompressed.fill(None)
+            with open(filepath + ".decompressed", "wb") as f:
+                f.write(decompressed.getView(0, decompressed.length))
+    # Everything else the renamer might want is read on demand by HierarchyCollection.find
+    with recprofile.stage("hierarchy"):
+        hierarchy = tryParsingHierarchy(decompressed, stopAfter=["MP"], lazy=True)
+    with recprofile.stage("metadata"):
+        metadata = parseRenameMetadata(hierarchy, *getExtraMetadataKeys())
+    info = RecInfo(metadata)
+    recprofile.count("compressedBytes", len(decompressed.compressed))
+    if duplicateAction() is not None or statsEnabled():
+        with recprofile.stage("fingerprint"):
+            info.fingerprint = getGameFingerprint(hierarchy, metadata, getDuplicateIgnoredKeys())
+    if duplicateAction() is not None:
+        # Worker processes don't have the cache, so leave this to finishRec
+        info.duplicateOf = findOriginal(filepath, info.fingerprint)
+        if info.duplicateOf is not None:
+            # Another player's copy of a game already processed, so nothing else needs reading
+            recprofile.count("decompressedBytes", decompressed.length)
+            info.memoryUsed = decompressed.memoryHeld()
+            return info
+    if config.getboolean("development", "OutputJson", fallback=False) or exportEnabled():
+        with recprofile.stage("metadata"):
+            info.fullMetadata = parseMetadata(hierarchy)
+    if exportEnabled():
+        info.gameId = hashlib.blake2b(decompressed.compressed, digest_size=16).hexdigest()
     if config.getboolean("development", "OutputXmb", fallback=False):
-        parseXMB(filepath, hierarchy, output=True)
+        with recprofile.stage("outputXmb"):
+            parseXMB(filepath, hierarchy, output=True)
+    if checkpoints is not None:
+        with recprofile.stage("outputIndex"):
+            decompressed.fill(None)
+            checkpoints.write(filepath + ".index", listTopLevelSections(hierarchy))
+    if needsTeams():
+        global learnedCivTables, usedCivTable
+        usedCivTable = None
+        with recprofile.stage("teams"):
+            info.teams, info.godNames = resolveTeams(filepath, metadata, hierarchy)
+        info.learnedCivTables, learnedCivTables = learnedCivTables, {}
+        info.civTableFingerprint = usedCivTable
+    recprofile.count("decompressedBytes", decompressed.length)
+    info.memoryUsed = decompressed.memoryHeld()
+    return info
+
+def getCachedRecInfo(filepath: str) -> typing.Optional[RecInfo]:
+    global config
+    if cache is None:
+        return None
+    if duplicateAction() is not None:
+        # Copies of other games are passed over without opening them
+        fingerprint = cache.lookupDuplicate(filepath)
+        if fingerprint is not None:
+            original = findOriginal(filepath, fingerprint)
+            if original is not None:
+                info = RecInfo(None)
+                info.fingerprint = fingerprint
+                info.duplicateOf = original
+                return info
+        # Processed before duplicates were being looked for, so it needs fingerprinting
+        elif not cache.hasOriginalAt(filepath):
+            return None
+    # These need the file contents, which aren't cached
+    if config.getboolean("development", "OutputDecompressed", fallback=False) or config.getboolean("development", "OutputXmb", fallback=False):
+        return None
+    if config.getboolean("development", "OutputIndex", fallback=False) and not os.path.isfile(filepath + ".index"):
+        return None
+    # The json output and export need the whole metadata table, which is only cached if it was read when the file was processed
+    wantsJson = config.getboolean("development", "OutputJson", fallback=False) and not os.path.isfile(filepath + ".json")
+    wantsExport = exporter is not None and not exporter.hasFile(filepath)
+    if stats is not None and not stats.hasFile(filepath):
+        return None
+    cached = cache.lookup(filepath)
+    if cached is None:
+        return None
+    metadata, teams, godNames, fullMetadata, gameId = cached
+    info = RecInfo(RecMetadata.fromDict(metadata), teams, godNames)
+    if wantsJson or wantsExport:
+        if fullMetadata is None:
+            return None
+        info.fullMetadata = fullMetadata
+    if wantsExport:
+        if gameId is None:
+            return None
+        info.gameId = gameId
+    if info.teams is None and needsTeams():
+        return None
+    # Cached before the rename formats wanted these
+    if any(keyName not in info.metadata.extra for keyName in listExtraMetadataKeys(info.metadata.numPlayers, *getExtraMetadataKeys())):
+        return None
+    return info
+
+def finishRec(filepath: str, info: RecInfo, fromCache=False) -> str:
+    "Do everything that doesn't need the recorded game's contents: json output, caching and renaming. Returns where the file ended up"
+    global config
+    if governor is not None and info.memoryUsed is not None:
+        # The header's size was only an estimate
+        governor.update(filepath, info.memoryUsed)
+    if cache is not None and info.fingerprint is not None and duplicateAction() is not None:
+        if info.duplicateOf is None:
+            info.duplicateOf = findOriginal(filepath, info.fingerprint)
+        if info.duplicateOf is not None:
+            return finishDuplicate(filepath, info)
+    if config.getboolean("development", "OutputJson", fallback=False) and info.fullMetadata is not None:
+        with recprofile.stage("outputJson"):
+            import json
+            with open(filepath + ".json", "w") as f:
+                json.dump(info.fullMetadata, f, indent=1)
+    if cache is not None:
+        with recprofile.stage("cache"):
+            if not fromCache:
+                cache.store(filepath, info.metadata.toDict(), info.teams, info.godNames, info.fullMetadata, info.gameId)
+            for fingerprint, civNames in info.learnedCivTables.items():
+                civTables[fingerprint] = civNames
+                cache.storeCivTable(fingerprint, civNames)
+            if info.civTableFingerprint in civTables:
+                cache.touchCivTable(info.civTableFingerprint)
+    if info.gameId is not None and (exporter is None or not exporter.hasGame(info.gameId)):
+        with recprofile.stage("export"):
+            # Written out once the renames are done, so it has the name the file ends up with
+            exportQueue.append((filepath, makeExportRecord(filepath, info)))
+    if statsEnabled() and info.fingerprint is not None:
+        # Also counted once the renames are done, so it remembers the name the file ends up with
+        statsQueue.append((filepath, info.fingerprint, info.metadata.mapName, info.teams, {civID: info.getGodName(civID) for team in info.teams for name, civID in team}))
+    name = None
     if config.getboolean("rename", "Rename", fallback=True):
-        renameRec(filepath, metadata, hierarchy)
+        with recprofile.stage("rename"):
+            name = buildRecName(filepath, info)
+    if cache is not None and info.fingerprint is not None and duplicateAction() is not None:
+        cache.storeOriginal(info.fingerprint, filepath, name)
+    if name is not None:
+        with recprofile.stage("rename"):
+            return moveRec(filepath, name)
+    return filepath
+
+def processFile(filepath: str) -> str:
+    with recprofile.stage("cache"):
+        info = getCachedRecInfo(filepath)
+    if info is not None:
+        recprofile.count("cacheHits")
+        return finishRec(filepath, info, fromCache=True)
+    if governor is not None and governor.budget > 0:
+        # One file at a time always fits, but reserving it keeps what was held at once counted the same way as with workers
+        governor.reserve(filepath, estimateMemory(filepath))
+    try:
+        return finishRec(filepath, readRecInfo(filepath))
+    finally:
+        if governor is not None:
+            governor.release(filepath)
 
-config = configparser.ConfigParser()
+config = recconfig.Config()
 
 def shouldOperateOnFile(filepath: str) -> bool:
-    global config
     if not os.path.isfile(filepath):
         return False
+    return shouldOperateOnFilename(filepath)
+
+def shouldOperateOnFilename(filepath: str) -> bool:
+    "The checks from shouldOperateOnFile that don't need to look at the file itself"
+    global config
     if not filepath.endswith(".mythrec"):
         return False
     if filepath.endswith("_.mythrec") and config.getboolean("rename", "IgnoreRecsEndingWithUnderscore", fallback=True):
@@ -392,30 +1529,450 @@ def shouldOperateOnFile(filepath: str) -> bool:
     return True
 
 logfile = None
+cache: typing.Optional["reccache.RecCache"] = None
+profiler: typing.Optional[recprofile.Profiler] = None
+# Holds back files while those in flight would take up more than MaxMemoryMB
+governor: typing.Optional[recmemory.MemoryGovernor] = None
+exporter: typing.Optional["recexport.Exporter"] = None
+# (path before renaming, record) for each recorded game that finishBatch still has to export
+exportQueue: typing.List[typing.Tuple[str, "recexport.ExportRecord"]] = []
+stats: typing.Optional["recstats.StatsAggregator"] = None
+# (path before renaming, fingerprint, map name, teams, god name by civ id) for each recorded game that finishBatch still has to count
+statsQueue: typing.List[typing.Tuple[str, str, typing.Optional[str], "recstats.Teams", typing.Dict[int, str]]] = []
+# (number, path) of the shard being processed, counting from 1, when running with --shard
+shard: typing.Optional[typing.Tuple[int, int]] = None
+# Manifest entry for each file the shard has processed
+shardEntries: typing.Dict[str, "recshard.ManifestEntry"] = {}
+# (ReplayFolder number, the folder) that each file found by a shard is in
+shardFolders: typing.Dict[str, typing.Tuple[int, str]] = {}
+logPath = LOGFILE
+# Worker processes collect their log lines here for the main process to write, so the log stays in file order
+logBuffer: typing.Optional[typing.List[str]] = None
 
 def log(str: str):
     global config, logfile
     if config.getboolean("development", "Log", fallback=True):
+        if logBuffer is not None:
+            logBuffer.append(str)
+            return
         if logfile is None:
-            logfile = open(LOGFILE, "w")
+            logfile = open(logPath, "w")
         logfile.write(str + "\n")
 
-def joinAndProcess(root, file):
-    joinedPath = os.path.join(root, file)
-    if shouldOperateOnFile(joinedPath):
-        try:
-            processFile(joinedPath)
-        except Exception:
-            log(f"FAILED to process {joinedPath}:")
-            log(traceback.format_exc())
-            return
-        log(f"Processed {joinedPath} successfully")
+def logTraceback():
+    "Log the exception being handled"
+    import traceback
+    log(traceback.format_exc())
 
-def main():
-    global config, logfile
+def startProfile(filepath: str, profile: typing.Optional[recprofile.FileProfile]=None):
+    "Start (or with profile, carry on) timing a file, if profiling is on"
+    global config
+    if profile is None and config.getboolean("development", "Profile", fallback=False):
+        profile = recprofile.FileProfile(filepath)
+    recprofile.current = profile
+
+def endProfile(success: bool):
+    if recprofile.current is not None and profiler is not None:
+        recprofile.current.success = success
+        profiler.record(recprofile.current)
+    recprofile.current = None
+
+def processAndLog(filepath: str) -> typing.Optional[str]:
+    "Process a file, logging how it went. Returns where the file ended up, or None if it failed"
+    startProfile(filepath)
+    try:
+        with recprofile.stage("total"):
+            newfilepath = processFile(filepath)
+    except Exception:
+        log(f"FAILED to process {filepath}:")
+        logTraceback()
+        endProfile(False)
+        return None
+    endProfile(True)
+    log(f"Processed {filepath} successfully")
+    return newfilepath
+
+def makeFolderWalker(folderState: typing.Optional[recwalk.FolderState]=None) -> recwalk.FolderWalker:
+    global config
+    excludes = [exclude.strip() for exclude in config.get("recprocessor", "ExcludeFolders", fallback="").split("|") if exclude.strip() != ""]
+    if duplicateAction() == "group":
+        excludes.append(getDuplicatesFolder())
+    return recwalk.FolderWalker(shouldOperateOnFilename, config.getboolean("recprocessor", "RecursiveFolderCheck", fallback=False),
+                                config.getint("recprocessor", "MaxFolderDepth", fallback=0), excludes,
+                                config.getboolean("recprocessor", "SkipHiddenFolders", fallback=True),
+                                config.getboolean("recprocessor", "SkipXmlOutputFolders", fallback=True), folderState)
+
+def iterFilesToProcess(dirsToProcess: typing.List[str]) -> typing.Iterator[str]:
+    global config
+    folderState = None
+    if cache is not None and config.getboolean("recprocessor", "SkipUnchangedFolders", fallback=False):
+        folderState = cache
+    walker = makeFolderWalker(folderState)
+    for folderNumber, dirToWorkOn in enumerate(dirsToProcess, 1):
+        if not os.path.isdir(dirToWorkOn):
+            log(f"Target folder {dirToWorkOn} doesn't exist or isn't a folder, ignored")
+            continue
+        for entry in walker.walk(dirToWorkOn):
+            if shard is not None:
+                import recshard
+                if recshard.shardOf(os.path.relpath(entry.path, dirToWorkOn), shard[1]) != shard[0]:
+                    continue
+                shardFolders[entry.path] = (folderNumber, dirToWorkOn)
+            yield entry.path
+    if walker.foldersSkipped > 0:
+        log(f"Skipped {walker.foldersSkipped} folders that haven't changed since they were last checked")
+
+def initWorker(configValues: recconfig.Values, knownCivTables: typing.Dict[str, typing.List[typing.Optional[str]]]):
+    global config, logBuffer, cache, renamePlan
+    # Handed over rather than read again
+    config = recconfig.Config(configValues)
+    renamePlan = None
+    civTables.update(knownCivTables)
+    # Only the main process uses the cache (a forked worker would otherwise inherit its connection)
+    cache = None
+    logBuffer = []
+
+def processFileInWorker(filepath: str) -> typing.Tuple[typing.Optional[RecInfo], typing.List[str], typing.Optional[recprofile.FileProfile]]:
+    "Worker side of processFile: parses the file and returns (info or None on failure, log lines, profile so far)"
+    global logBuffer
+    logBuffer = []
+    info = None
+    startProfile(filepath)
+    try:
+        with recprofile.stage("total"):
+            info = readRecInfo(filepath)
+    except Exception:
+        log(f"FAILED to process {filepath}:")
+        logTraceback()
+    profile = recprofile.current
+    recprofile.current = None
+    return info, logBuffer, profile
+
+def finishWorkerFile(filepath: str, future: "concurrent.futures.Future", fromCache: bool) -> typing.Optional[str]:
+    from concurrent.futures.process import BrokenProcessPool
+    try:
+        info, lines, profile = future.result()
+    except BrokenProcessPool:
+        log(f"FAILED to process {filepath}: a worker process stopped unexpectedly while it was being processed, like from running out of memory")
+        return None
+    except Exception:
+        log(f"FAILED to process {filepath}:")
+        logTraceback()
+        return None
+    for line in lines:
+        log(line)
+    startProfile(filepath, profile)
+    if info is None:
+        endProfile(False)
+        return None
+    # Renames happen here, one at a time and in listing order, so name collisions resolve the same way as a serial run
+    try:
+        with recprofile.stage("total"):
+            newfilepath = finishRec(filepath, info, fromCache)
+    except Exception:
+        log(f"FAILED to process {filepath}:")
+        logTraceback()
+        endProfile(False)
+        return None
+    endProfile(True)
+    log(f"Processed {filepath} successfully")
+    return newfilepath
+
+def processFilesParallel(filepaths: typing.Iterable[str], workers: int, onProcessed: typing.Optional[typing.Callable[[str, typing.Optional[str]], None]]=None,
+                         governor: typing.Optional[recmemory.MemoryGovernor]=None):
+    """Process files with a pool of worker processes. onProcessed is called with each file and where it ended up (None if it failed), in order.
+    With a governor, files only start once there is room in its budget for them"""
+    # Only keep a couple of files per worker in flight so memory use doesn't scale with the archive size
+    maxInFlight = workers*2
+    # (file, its result, whether it came from the cache)
+    import concurrent.futures
+    from concurrent.futures.process import BrokenProcessPool
+    pending: typing.Deque[typing.Tuple[str, concurrent.futures.Future, bool]] = collections.deque()
+    pool: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+    def submit(filepath: str) -> concurrent.futures.Future:
+        nonlocal pool
+        if pool is not None:
+            try:
+                return pool.submit(processFileInWorker, filepath)
+            except BrokenProcessPool:
+                # A worker died (a crash or the OS killing it), which takes the pool with it, so carry on with a new one
+                pool.shutdown(wait=False)
+        pool = concurrent.futures.ProcessPoolExecutor(workers, initializer=initWorker, initargs=(config.values, civTables))
+        return pool.submit(processFileInWorker, filepath)
+    def finishOldest():
+        filepath, future, fromCache = pending.popleft()
+        if not fromCache and isinstance(future.exception(), BrokenProcessPool):
+            # Everything in flight fails along with whichever file killed the worker, so each gets one more try.
+            # The file that did it should just kill its worker again, and only fail then
+            log(f"A worker process stopped unexpectedly while {filepath} was in flight, trying it again")
+            future = submit(filepath)
+        newfilepath = finishWorkerFile(filepath, future, fromCache)
+        if governor is not None:
+            governor.release(filepath)
+        if onProcessed is not None:
+            onProcessed(filepath, newfilepath)
+    try:
+        for filepath in filepaths:
+            startProfile(filepath)
+            with recprofile.stage("total"):
+                with recprofile.stage("cache"):
+                    info = getCachedRecInfo(filepath)
+            profile = recprofile.current
+            recprofile.current = None
+            if info is not None:
+                if profile is not None:
+                    profile.counters["cacheHits"] = 1
+                # Still queued behind the files in flight to keep the log and renames in order
+                future = concurrent.futures.Future()
+                future.set_result((info, [], profile))
+                pending.append((filepath, future, True))
+            else:
+                if governor is not None and governor.budget > 0:
+                    reserved = estimateMemory(filepath)
+                    if not governor.fits(reserved):
+                        governor.waits += 1
+                    while not governor.fits(reserved):
+                        finishOldest()
+                    governor.reserve(filepath, reserved)
+                pending.append((filepath, submit(filepath), False))
+            if len(pending) >= maxInFlight:
+                finishOldest()
+        while len(pending) > 0:
+            finishOldest()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+def getWorkers() -> int:
+    global config
+    workers = config.getint("recprocessor", "Workers", fallback=1)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+def getMemoryBudget() -> int:
+    "MaxMemoryMB in bytes, 0 for no limit"
+    global config
+    return int(config.getfloat("recprocessor", "MaxMemoryMB", fallback=0)*1024*1024)
+
+def getMemoryShare() -> int:
+    "How much of the memory budget each file being processed at once gets, beyond which it is spilled to a temporary file. 0 for no limit"
+    return getMemoryBudget() // getWorkers()
+
+def estimateMemory(filepath: str) -> int:
+    "How much memory processing a file will hold onto, going by its header"
+    try:
+        size = recmemory.readDecompressedSize(filepath)
+    except OSError:
+        size = None
+    if size is None:
+        # It will fail quickly
+        return 0
+    size = min(size, RECORDED_GAME_MAX_DECOMPRESS_SIZE)
+    # Anything beyond its share goes to a temporary file instead
+    share = getMemoryShare()
+    return min(size, share) if share > 0 else size
+
+def logPeakMemory(governor: typing.Optional[recmemory.MemoryGovernor]=None):
+    mainPeak = recmemory.peakRSSMB()
+    if mainPeak is None:
+        return
+    message = f"Peak memory use: {mainPeak:.1f} MB"
+    # A serial run has no workers, so whatever was counted for child processes wasn't one of them
+    workerPeak = recmemory.peakRSSMB(children=True) if getWorkers() > 1 else None
+    if workerPeak:
+        message += f", {workerPeak:.1f} MB in the largest worker process"
+    if governor is not None and governor.budget > 0:
+        message += f". At most {governor.peakHeld/1024/1024:.1f} MB of the {governor.budget/1024/1024:.1f} MB budget was reserved at once, and files waited for room {governor.waits} times"
+    log(message)
+
+def openCache() -> typing.Optional["reccache.RecCache"]:
+    global config
+    if not config.getboolean("cache", "Cache", fallback=False):
+        return None
+    import reccache
+    cachePath = os.path.join(os.path.dirname(CONFIG_FILE), config.get("cache", "CacheFile", fallback="_recprocessor_cache.sqlite"))
+    return reccache.RecCache(cachePath, config.getint("cache", "MaxEntries", fallback=100000), config.getint("cache", "MaxAgeDays", fallback=180),
+                             config.getint("cache", "MaxCivTables", fallback=20))
+
+def flushOutputs():
+    "Get everything so far onto disk, for when the process isn't about to exit"
+    if logfile is not None:
+        logfile.flush()
+    if cache is not None:
+        cache.commit()
+    if profiler is not None:
+        profiler.flush()
+    if exporter is not None:
+        exporter.flush()
+    if stats is not None:
+        stats.save()
+
+def finishBatch(processed: typing.List[typing.Tuple[str, typing.Optional[str]]], watcher: typing.Optional[recwatch.FolderWatcher]):
+    "Do the renames planned while processing a batch of (file, where it is to end up or None if it failed), then export and count them and tell the watcher where each ended up"
+    global exportQueue, statsQueue
+    if shard is not None:
+        # Kept for the shard's manifest instead
+        for filepath, record in exportQueue:
+            getShardEntry(filepath)["export"] = record
+        for filepath, fingerprint, mapName, teams, godNames in statsQueue:
+            getShardEntry(filepath)["stats"] = [fingerprint, mapName, teams, godNames]
+        exportQueue = []
+        statsQueue = []
+        return
+    renamed = applyRenames()
+    if exporter is not None:
+        for filepath, record in exportQueue:
+            # The same game might have been in the batch twice under different names
+            if not exporter.hasGame(record["id"]):
+                record["file"] = os.path.abspath(renamed.get(filepath, filepath))
+                exporter.add(record)
+        exporter.flush()
+    exportQueue = []
+    if stats is not None:
+        for filepath, fingerprint, mapName, teams, godNames in statsQueue:
+            stats.add(fingerprint, renamed.get(filepath, filepath), mapName, teams, godNames.__getitem__)
+    statsQueue = []
+    if watcher is not None:
+        for filepath, newfilepath in processed:
+            watcher.processed(filepath, None if newfilepath is None else renamed.get(filepath, filepath))
+
+def watchFolders(watcher: recwatch.FolderWatcher, interval: float):
+    "Process recorded games as they appear in the watched folders, until interrupted"
+    log(f"Watching for new recorded games every {interval:g} seconds")
+    flushOutputs()
+    try:
+        while True:
+            time.sleep(interval)
+            ready = watcher.poll()
+            if len(ready) > 0 and cache is not None:
+                # Otherwise everything used while watching would look as old as when the process started
+                cache.now = time.time()
+            if len(ready) > 0:
+                finishBatch([(filepath, processAndLog(filepath)) for filepath in ready], watcher)
+                flushOutputs()
+    except KeyboardInterrupt:
+        log("Stopped watching.")
+
+def openExporter() -> typing.Optional["recexport.Exporter"]:
+    global config
+    if not exportEnabled():
+        return None
+    import recexport
+    return recexport.openExporter(config.get("export", "Export").strip(), config.get("export", "ExportFile", fallback="").strip(), os.path.dirname(CONFIG_FILE))
+
+def openStats() -> typing.Optional["recstats.StatsAggregator"]:
+    global config
+    if not statsEnabled():
+        return None
+    import recstats
+    return recstats.StatsAggregator(os.path.join(os.path.dirname(CONFIG_FILE), config.get("stats", "StatsFile", fallback="").strip() or recstats.DEFAULT_STATS_FILE))
+
+def writeStatsReport():
+    global config
+    reportFile = config.get("stats", "ReportFile", fallback="_recprocessor_stats.txt").strip()
+    if reportFile == "":
+        return
+    with open(os.path.join(os.path.dirname(CONFIG_FILE), reportFile), "w", encoding="utf8") as f:
+        for line in stats.report(config.getint("stats", "ReportTop", fallback=20)):
+            f.write(line + "\n")
+
+def processFolders(dirsToProcess: typing.List[str]):
+    "Process every recorded game in the replay folders, then watch them for more if Watch is on"
+    global config, governor
+    watcher = None
+    if config.getboolean("recprocessor", "Watch", fallback=False) and shard is not None:
+        log("Watch doesn't work with --shard, only the recorded games there now are processed")
+    elif config.getboolean("recprocessor", "Watch", fallback=False):
+        # Taken before processing what is already there, so anything that turns up meanwhile is still noticed
+        # Remembering folders with nothing to process for the run means polls only list them again once they change
+        watcher = recwatch.FolderWatcher(dirsToProcess, makeFolderWalker(recwalk.MemoryFolderState()), config.getfloat("recprocessor", "WatchSettleSeconds", fallback=10))
+        watcher.snapshot()
+    # Where each file is to end up, for the watcher once the renames are done
+    processed: typing.List[typing.Tuple[str, typing.Optional[str]]] = []
+    onProcessed = None if watcher is None else lambda filepath, newfilepath: processed.append((filepath, newfilepath))
+    workers = getWorkers()
+    if workers == 1:
+        for filepath in iterFilesToProcess(dirsToProcess):
+            newfilepath = processAndLog(filepath)
+            if onProcessed is not None:
+                onProcessed(filepath, newfilepath)
+    else:
+        processFilesParallel(iterFilesToProcess(dirsToProcess), workers, onProcessed, governor)
+    finishBatch(processed, watcher)
+    if watcher is not None:
+        watchFolders(watcher, config.getfloat("recprocessor", "WatchInterval", fallback=5))
+
+def getShardEntry(filepath: str) -> "recshard.ManifestEntry":
+    entry = shardEntries.get(filepath)
+    if entry is None:
+        folderNumber, folder = shardFolders[filepath]
+        # Relative to the replay folder, as other machines might have it somewhere else
+        entry = {"replayFolder": folderNumber, "file": os.path.relpath(filepath, folder), "name": None, "folder": None, "export": None, "stats": None}
+        shardEntries[filepath] = entry
+    return entry
+
+def writeShardManifest():
+    import recshard
+    path = recshard.manifestPath(os.path.dirname(CONFIG_FILE), *shard)
+    recshard.writeManifest(path, shardEntries.values())
+    log(f"Wrote what shard {shard[0]} of {shard[1]} found out about {len(shardEntries)} recorded games to {path}, run with --merge once every shard is done to rename them")
+
+def mergeShards(dirsToProcess: typing.List[str]):
+    "Rename, export and count everything in the manifests of shards that have all finished, then remove those manifests"
+    import recshard
+    manifests, problems = recshard.findManifests(os.path.dirname(CONFIG_FILE))
+    for problem in problems:
+        log(problem)
+    entries = []
+    for path in manifests:
+        entries += recshard.readManifest(path)
+    # Planned in path order, so how names are numbered doesn't depend on which shard finished first
+    entries.sort(key=lambda entry: (entry["replayFolder"], entry["file"]))
+    merged = 0
+    for entry in entries:
+        if entry["replayFolder"] > len(dirsToProcess):
+            log(f"A shard's manifest has {entry['file']} in ReplayFolder{entry['replayFolder']}, which isn't set here, left out of the merge")
+            continue
+        folder = dirsToProcess[entry["replayFolder"]-1]
+        filepath = os.path.join(folder, entry["file"])
+        if not os.path.isfile(filepath):
+            log(f"{filepath} from a shard's manifest isn't there any more, left out of the merge")
+            continue
+        if entry["name"] is not None:
+            moveRec(filepath, entry["name"], None if entry["folder"] is None else os.path.join(folder, entry["folder"]))
+        if entry["export"] is not None:
+            exportQueue.append((filepath, entry["export"]))
+        if entry["stats"] is not None:
+            fingerprint, mapName, teams, godNames = entry["stats"]
+            # json made the civ ids strings
+            statsQueue.append((filepath, fingerprint, mapName, teams, {int(civID): name for civID, name in godNames.items()}))
+        merged += 1
+    finishBatch([], None)
+    for path in manifests:
+        os.remove(path)
+    log(f"Merged {merged} recorded games from {len(manifests)} shard manifests")
+
+def parseArguments(argv: typing.Optional[typing.List[str]]=None) -> "argparse.Namespace":
+    if argv is None:
+        argv = sys.argv[1:]
+    # A scheduled run has no arguments, so argparse is only needed when there are some
+    if len(argv) == 0:
+        return types.SimpleNamespace(shard=None, merge=False, no_config_snapshot=False)
+    import argparse
+    parser = argparse.ArgumentParser(description="Rename and process Age of Mythology: Retold recorded games, as set up in recprocessor.ini")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--shard", help="only process this share of the recorded games, eg 2/4 for the second of four, and leave renaming them to --merge")
+    mode.add_argument("--merge", action="store_true", help="rename (and export and count) what every shard has processed, once they have all finished")
+    parser.add_argument("--no-config-snapshot", action="store_true", help="read recprocessor.ini without using or writing its snapshot, like ConfigSnapshot=0")
+    return parser.parse_args(argv)
+
+def main(argv: typing.Optional[typing.List[str]]=None):
+    global config, logfile, cache, profiler, exporter, stats, shard, logPath, governor
+    args = parseArguments(argv)
     try:
         try:
-            config.read("./recprocessor.ini")
+            config.read(CONFIG_FILE, snapshot=not args.no_config_snapshot, switch=("recprocessor", "ConfigSnapshot"))
         except FileNotFoundError:
             with open(LOGFILE, "w") as f:
                 f.write("Could not find recprocessor.ini. Exiting.")
@@ -429,21 +1986,69 @@ def main():
             dirsToProcess.append(thisDir)
             index += 1
 
-        for dirToWorkOn in dirsToProcess:
-            if not os.path.isdir(dirToWorkOn):
-                log(f"Target folder {dirToWorkOn} doesn't exist or isn't a folder, ignored")
-                continue
-            if config.getboolean("recprocessor", "RecursiveFolderCheck", fallback=False):
-                for root, dirs, files in os.walk(dirToWorkOn):
-                    for file in files:
-                        joinAndProcess(root, file)
-            else:
-                for file in os.listdir(dirToWorkOn):
-                    joinAndProcess(dirToWorkOn, file)
+        profilePath = recprofile.PROFILEFILE
+        if args.shard is not None:
+            import recshard
+            shard = recshard.parseShard(args.shard)
+            # Every shard might be running in the same folder
+            logPath = LOGFILE.replace(".log", f"_shard{recshard.suffix(*shard)}.log")
+            profilePath = profilePath.replace(".jsonl", f"_shard{recshard.suffix(*shard)}.jsonl")
+            # The cache, export, stats and renames are files all the shards would be fighting over, so they are left to the merge
+            log(f"Processing shard {shard[0]} of {shard[1]}. The cache isn't used, and renaming, exporting and stats happen when merging")
+        else:
+            cache = openCache()
+            exporter = openExporter()
+            stats = openStats()
+            recoverRenames()
+        governor = recmemory.MemoryGovernor(getMemoryBudget())
+        if duplicateAction() is not None and cache is None:
+            log("Duplicates needs the cache to be on to remember which games have been seen, so copies won't be looked for")
+        if config.getboolean("development", "Profile", fallback=False):
+            profiler = recprofile.Profiler(profilePath)
+        if cache is not None:
+            civTables.update(cache.loadCivTables())
+        if args.merge:
+            mergeShards(dirsToProcess)
+        else:
+            processFolders(dirsToProcess)
     except:
         log("FATAL ERROR")
-        log(traceback.format_exc())
-        
+        logTraceback()
+
+    # Whatever was processed before an error still gets renamed and exported
+    try:
+        finishBatch([], None)
+        if shard is not None:
+            writeShardManifest()
+    except Exception:
+        log("Failed to rename or export processed recorded games:")
+        logTraceback()
+    if exporter is not None:
+        try:
+            exporter.close()
+        except Exception:
+            log("Failed to save export:")
+            logTraceback()
+    if stats is not None:
+        try:
+            stats.close()
+            writeStatsReport()
+        except Exception:
+            log("Failed to save stats:")
+            logTraceback()
+    if cache is not None:
+        try:
+            removed = cache.close()
+            if removed > 0:
+                log(f"Removed {removed} old entries from the cache")
+        except Exception:
+            log("Failed to save cache:")
+            logTraceback()
+    if profiler is not None:
+        for line in profiler.summarise():
+            log(line)
+        profiler.close()
+    logPeakMemory(governor)
     log("Finished processing.")
 
     if logfile is not None:
@@ -451,4 +2056,8 @@ def main():
 		
 
 if __name__ == "__main__":
+    # Needed for worker processes to start from a frozen executable (and does nothing otherwise)
+    if getattr(sys, "frozen", False):
+        import multiprocessing
+        multiprocessing.freeze_support()
     main()
\ No newline at end of file
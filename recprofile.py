@@ -0,0 +1,99 @@
+# Per-file timing and counters, switched on with Profile=1 in the [development] section of the ini.
+# Each processed file gets a FileProfile, written as one line of json, and the run ends with a summary of the slowest files and stages.
+# Stages can nest: "inflate" is also counted in whichever stage pulled the data, "xmb" in "teams", and everything in "total".
+
+import contextlib
+import math
+import time
+import typing
+
+PROFILEFILE = "_recprocessor_profile.jsonl"
+SLOWEST_FILES = 10
+PERCENTILES = (50, 95, 99)
+
+class FileProfile:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        # stage name -> [wall seconds, cpu seconds]
+        self.stages: typing.Dict[str, typing.List[float]] = {}
+        self.counters: typing.Dict[str, int] = {}
+        self.success = False
+    def addTime(self, stageName: str, wall: float, cpu: float):
+        times = self.stages.setdefault(stageName, [0.0, 0.0])
+        times[0] += wall
+        times[1] += cpu
+    def toDict(self) -> typing.Dict[str, typing.Any]:
+        return {"file": self.filepath, "success": self.success,
+                "stages": {name: {"wall": round(wall, 6), "cpu": round(cpu, 6)} for name, (wall, cpu) in self.stages.items()},
+                "counters": self.counters}
+
+# The file currently being profiled in this process, None if profiling is off
+current: typing.Optional[FileProfile] = None
+
+@contextlib.contextmanager
+def stage(stageName: str):
+    "Add the wall and cpu time spent inside the with block to stageName of the current file"
+    if current is None:
+        yield
+        return
+    profile = current
+    wallStart = time.perf_counter()
+    cpuStart = time.process_time()
+    try:
+        yield
+    finally:
+        profile.addTime(stageName, time.perf_counter() - wallStart, time.process_time() - cpuStart)
+
+def count(counterName: str, amount=1):
+    if current is not None:
+        current.counters[counterName] = current.counters.get(counterName, 0) + amount
+
+def percentile(sortedValues: typing.List[float], percent: float) -> float:
+    "Nearest rank percentile of an already sorted list"
+    return sortedValues[max(0, math.ceil(percent / 100 * len(sortedValues)) - 1)]
+
+class Profiler:
+    "Collects finished FileProfiles in the main process, writing them out and keeping what the summary needs"
+    def __init__(self, path=PROFILEFILE):
+        self.file = open(path, "w")
+        self.stageTimes: typing.Dict[str, typing.List[float]] = {}
+        self.stageCpu: typing.Dict[str, float] = {}
+        self.counterTotals: typing.Dict[str, int] = {}
+        self.fileTimes: typing.List[typing.Tuple[float, str]] = []
+        self.wallStart = time.perf_counter()
+        self.cpuStart = time.process_time()
+    def record(self, profile: FileProfile):
+        import json
+        self.file.write(json.dumps(profile.toDict()) + "\n")
+        for stageName, (wall, cpu) in profile.stages.items():
+            self.stageTimes.setdefault(stageName, []).append(wall)
+            self.stageCpu[stageName] = self.stageCpu.get(stageName, 0.0) + cpu
+        for counterName, amount in profile.counters.items():
+            self.counterTotals[counterName] = self.counterTotals.get(counterName, 0) + amount
+        self.fileTimes.append((profile.stages.get("total", (0.0, 0.0))[0], profile.filepath))
+    def summarise(self) -> typing.List[str]:
+        "Write the summary as the last json line, and return it as lines for the log"
+        import json
+        stages = {}
+        for stageName, times in self.stageTimes.items():
+            times.sort()
+            stages[stageName] = {"files": len(times), "total": round(sum(times), 6), "cpu": round(self.stageCpu[stageName], 6)}
+            for percent in PERCENTILES:
+                stages[stageName][f"p{percent}"] = round(percentile(times, percent), 6)
+        slowest = sorted(self.fileTimes, reverse=True)[:SLOWEST_FILES]
+        summary = {"files": len(self.fileTimes), "wall": round(time.perf_counter() - self.wallStart, 6), "cpu": round(time.process_time() - self.cpuStart, 6),
+                   "stages": stages, "counters": self.counterTotals, "slowest": [{"file": filepath, "wall": round(wall, 6)} for wall, filepath in slowest]}
+        self.file.write(json.dumps({"summary": summary}) + "\n")
+        lines = [f"Profile: {summary['files']} files in {summary['wall']:.3f}s wall, {summary['cpu']:.3f}s cpu in the main process"]
+        for stageName, stats in sorted(stages.items(), key=lambda item: -item[1]["total"]):
+            lines.append(f"  {stageName}: {stats['total']:.3f}s total ({stats['cpu']:.3f}s cpu) over {stats['files']} files, " + ", ".join(f"p{percent} {stats[f'p{percent}']*1000:.2f}ms" for percent in PERCENTILES))
+        for counterName, amount in sorted(self.counterTotals.items()):
+            lines.append(f"  {counterName}: {amount}")
+        lines.append("  Slowest files:")
+        for wall, filepath in slowest:
+            lines.append(f"    {wall*1000:.2f}ms {filepath}")
+        return lines
+    def flush(self):
+        self.file.flush()
+    def close(self):
+        self.file.close()
@@ -0,0 +1,166 @@
+# Works out where every recorded game in a run is going to be renamed to, then does all the renames at once.
+# Each target folder is listed once and the names in it kept in memory, along with the next free number for each name,
+# so finding a free name doesn't need a stat per attempt however many games end up with the same name.
+# Before anything is renamed the whole plan is written to a journal, which lets an interrupted batch be finished or undone next time.
+
+import os
+import typing
+
+# Files written next to a recorded game that get renamed along with it
+SIDECAR_EXTENSIONS = (".json", ".decompressed", ".index")
+EXTENSION = ".mythrec"
+
+class PlannedRename:
+    __slots__ = ("source", "target")
+    def __init__(self, source: str, target: str):
+        self.source = source
+        self.target = target
+
+def moveWithSidecars(source: str, target: str, log: typing.Callable[[str], None]) -> bool:
+    "Rename a recorded game and whichever of its sidecar files exist. Returns whether the recorded game itself was moved"
+    if not os.path.isfile(source) or os.path.exists(target):
+        return False
+    log(f"Renaming: {source} -> {target}")
+    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+    os.rename(source, target)
+    for extra in SIDECAR_EXTENSIONS:
+        if os.path.isfile(source + extra) and not os.path.exists(target + extra):
+            log(f"Renaming: {source + extra} -> {target + extra}")
+            os.rename(source + extra, target + extra)
+    return True
+
+def whyNotMoved(source: str, target: str) -> str:
+    "Why moveWithSidecars returned False"
+    return "source missing" if not os.path.isfile(source) else "target exists"
+
+def recoverRename(source: str, target: str, log: typing.Callable[[str], None], onMoved: typing.Optional[typing.Callable[[str, str], None]]):
+    if moveWithSidecars(source, target, log):
+        if onMoved is not None:
+            onMoved(source, target)
+    # Only missing the source with the target there is a rename that happened before the batch was interrupted
+    elif os.path.isfile(source) or not os.path.exists(target):
+        log(f"FAILED to rename {source} -> {target}: {whyNotMoved(source, target)}")
+
+class RenamePlanner:
+    def __init__(self, trailingCharacters: str):
+        self.trailingCharacters = trailingCharacters
+        # normcased folder -> normcased names of everything in it, as it will be once the planned renames are done
+        self.taken: typing.Dict[str, typing.Set[str]] = {}
+        # (normcased folder, name) -> lowest number that might still be free for that name
+        self.nextNumber: typing.Dict[typing.Tuple[str, str], int] = {}
+        self.planned: typing.List[PlannedRename] = []
+
+    def takenNames(self, folder: str) -> typing.Set[str]:
+        key = os.path.normcase(os.path.abspath(folder))
+        taken = self.taken.get(key)
+        if taken is None:
+            # A folder that doesn't exist yet gets made when something is moved into it
+            taken = set(os.path.normcase(name) for name in os.listdir(folder)) if os.path.isdir(folder) else set()
+            self.taken[key] = taken
+        return taken
+
+    def baseName(self, filename: str) -> typing.Optional[str]:
+        "The name (without number, marker or extension) that one of the names given out here was made from, or None if it can't have been"
+        if not filename.endswith(self.trailingCharacters + EXTENSION):
+            return None
+        return filename[:len(filename)-len(self.trailingCharacters + EXTENSION)].rstrip("0123456789")
+
+    def plan(self, filepath: str, name: str, folder: typing.Optional[str]=None) -> typing.Tuple[str, int]:
+        """Pick a free name for filepath to be renamed to, based on name, in folder or the folder it is already in.
+        Returns the new path and how many names were already taken"""
+        sourceFolder, tail = os.path.split(filepath)
+        head = sourceFolder if folder is None else folder
+        taken = self.takenNames(head)
+        folderKey = os.path.normcase(os.path.abspath(head))
+        candidate = name + self.trailingCharacters + EXTENSION
+        collisions = 0
+        if os.path.normcase(candidate) in taken:
+            numberKey = (folderKey, os.path.normcase(name))
+            attempt = self.nextNumber.get(numberKey, 2)
+            while True:
+                candidate = name + str(attempt) + self.trailingCharacters + EXTENSION
+                if os.path.normcase(candidate) not in taken:
+                    break
+                attempt += 1
+            collisions = attempt - 1
+            self.nextNumber[numberKey] = attempt + 1
+        newfilepath = os.path.join(head, candidate)
+        # The old name is free once this has been renamed, which matters if it is one of the names given out here
+        oldName = os.path.normcase(tail)
+        self.takenNames(sourceFolder).discard(oldName)
+        base = self.baseName(oldName)
+        if base is not None:
+            self.nextNumber.pop((os.path.normcase(os.path.abspath(sourceFolder)), base), None)
+        taken.add(os.path.normcase(candidate))
+        self.planned.append(PlannedRename(filepath, newfilepath))
+        return newfilepath, collisions
+
+    def writeJournal(self, journalPath: str):
+        import json
+        with open(journalPath, "w") as f:
+            for rename in self.planned:
+                f.write(json.dumps({"from": rename.source, "to": rename.target}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def apply(self, log: typing.Callable[[str], None], journalPath: typing.Optional[str]=None, onMoved: typing.Optional[typing.Callable[[str, str], None]]=None) -> typing.Dict[str, str]:
+        "Do the planned renames in order, keeping a journal of them while it happens. Returns where each planned file ended up"
+        results = {}
+        if len(self.planned) == 0:
+            return results
+        if journalPath is not None:
+            self.writeJournal(journalPath)
+        for rename in self.planned:
+            try:
+                moved = moveWithSidecars(rename.source, rename.target, log)
+                if not moved:
+                    log(f"FAILED to rename {rename.source} -> {rename.target}: {whyNotMoved(rename.source, rename.target)}")
+            except OSError as e:
+                log(f"FAILED to rename {rename.source} -> {rename.target}: {e}")
+                moved = False
+            if moved and onMoved is not None:
+                onMoved(rename.source, rename.target)
+            results[rename.source] = rename.target if moved else rename.source
+        if journalPath is not None:
+            os.remove(journalPath)
+        self.clear()
+        return results
+
+    def dryRun(self, log: typing.Callable[[str], None]) -> typing.Dict[str, str]:
+        "Log the planned renames without doing them"
+        for rename in self.planned:
+            log(f"Would rename: {rename.source} -> {rename.target}")
+        results = {rename.source: rename.source for rename in self.planned}
+        self.clear()
+        return results
+
+    def clear(self):
+        self.planned = []
+        # Things may have changed by the time anything else is planned
+        self.taken = {}
+        self.nextNumber = {}
+
+def readJournal(journalPath: str) -> typing.List[PlannedRename]:
+    import json
+    renames = []
+    with open(journalPath) as f:
+        for line in f:
+            line = line.strip()
+            # The last line might not have been finished
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            renames.append(PlannedRename(entry["from"], entry["to"]))
+    return renames
+
+def recoverJournal(journalPath: str, rollBack: bool, log: typing.Callable[[str], None], onMoved: typing.Optional[typing.Callable[[str, str], None]]=None):
+    "Finish (or with rollBack, undo) the renames from a batch that was interrupted. Renames that already happened (or were undone) are left as they are"
+    renames = readJournal(journalPath)
+    if rollBack:
+        for rename in reversed(renames):
+            recoverRename(rename.target, rename.source, log, onMoved)
+    else:
+        for rename in renames:
+            recoverRename(rename.source, rename.target, log, onMoved)
+    os.remove(journalPath)
@@ -0,0 +1,74 @@
+# Splitting the recorded games in the replay folders between several processes (possibly on different machines sharing the folders).
+# Each shard takes the files whose path within their replay folder hashes to it, so every shard agrees on who has what without talking to the others.
+# Shards don't rename anything: each writes a manifest of what it would rename each file to and what it read out of it,
+# and a merge run afterwards plans all of the renames together (so names taken by other shards are numbered around) and applies them as one batch.
+
+import glob
+import hashlib
+import json
+import os
+import typing
+
+MANIFEST_PREFIX = "_recprocessor_shard"
+MANIFEST_EXTENSION = ".jsonl"
+
+# One file's entry in a manifest: replayFolder (the N of the ReplayFolderN it is in), file (its path relative to that folder, so the merge
+# works wherever another machine has the folder), name and folder (where renaming would move it, the folder also relative to the replay folder,
+# both None if it isn't renamed), export (its export record or None) and stats ([fingerprint, map name, teams, {civ id: god name}] or None)
+ManifestEntry = typing.Dict[str, typing.Any]
+
+def parseShard(text: str) -> typing.Tuple[int, int]:
+    "Parse i/N (counting from 1, eg 2/4) into (i, N)"
+    try:
+        index, count = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise ValueError(f"Shard should look like 2/4, not {text}")
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Shard {text} is out of range, it should be between 1/{count} and {count}/{count}")
+    return index, count
+
+def shardOf(relativePath: str, count: int) -> int:
+    "Which shard (counting from 1) a file belongs to, from its path within its replay folder. The same on every machine and every run"
+    key = relativePath.replace(os.sep, "/").encode("utf8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") % count + 1
+
+def suffix(index: int, count: int) -> str:
+    "Added to the names of files each shard writes, so shards working in the same folder don't write over each other's"
+    return f"{index}of{count}"
+
+def manifestPath(folder: str, index: int, count: int) -> str:
+    return os.path.join(folder, f"{MANIFEST_PREFIX}{suffix(index, count)}{MANIFEST_EXTENSION}")
+
+def writeManifest(path: str, entries: typing.Iterable[ManifestEntry]):
+    "Write a shard's manifest in one go, so a merge never sees half of one"
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf8") as f:
+        for entry in entries:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+def findManifests(folder: str) -> typing.Tuple[typing.List[str], typing.List[str]]:
+    "Return (manifests ready to merge, problems stopping the rest from being merged). Shards split N ways are only ready once all N have finished"
+    byCount: typing.Dict[int, typing.Dict[int, str]] = {}
+    for path in glob.glob(os.path.join(glob.escape(folder), f"{MANIFEST_PREFIX}*of*{MANIFEST_EXTENSION}")):
+        name = os.path.basename(path)[len(MANIFEST_PREFIX):-len(MANIFEST_EXTENSION)]
+        try:
+            index, count = parseShard(name.replace("of", "/"))
+        except ValueError:
+            continue
+        byCount.setdefault(count, {})[index] = path
+    ready = []
+    problems = []
+    for count, paths in sorted(byCount.items()):
+        missing = [str(index) for index in range(1, count+1) if index not in paths]
+        if len(missing) > 0:
+            problems.append(f"Shards {', '.join(missing)} of {count} haven't finished, so the other {len(paths)} of {count} weren't merged")
+            continue
+        ready += [paths[index] for index in range(1, count+1)]
+    return ready, problems
+
+def readManifest(path: str) -> typing.List[ManifestEntry]:
+    with open(path, encoding="utf8") as f:
+        return [json.loads(line) for line in f if line.strip() != ""]
@@ -0,0 +1,187 @@
+# Running totals over every recorded game processed: god picks, which gods played against which, map and per-player game counts.
+# Each game is counted once (by fingerprint, so other players' copies of it don't count again) and the totals are kept between runs,
+# so reports come straight from them rather than from reading the recorded games or their json output again.
+# Counts are arrays indexed by civ id, map id or player id, with the ids of maps and players given out in the order they were first seen.
+# Everything is kept in a SQLite database: the totals as one json row, rewritten when they change, and the games and files already counted
+# as tables that only get added to, so saving doesn't take longer the more games have been counted.
+# Usage: python recstats.py [STATS_FILE] [--top N]
+
+import argparse
+import array
+import json
+import os
+import sqlite3
+import typing
+
+VERSION = 2
+COUNTER_TYPE = "I"
+DEFAULT_STATS_FILE = "_recprocessor_stats.sqlite"
+
+# [[(player name, civ id), ...] for each team], like RecInfo.teams
+Teams = typing.List[typing.List[typing.Tuple[str, int]]]
+
+def makeCounters(values: typing.Iterable[int]=()) -> array.array:
+    return array.array(COUNTER_TYPE, values)
+
+def growCounters(counters: array.array, length: int):
+    if len(counters) < length:
+        counters.frombytes(bytes(counters.itemsize*(length - len(counters))))
+
+class IdTable:
+    "Gives out ids counting up from 0 to names in the order they are first seen"
+    def __init__(self, names: typing.Iterable[str]=()):
+        self.names: typing.List[str] = list(names)
+        self.ids = {name: index for index, name in enumerate(self.names)}
+    def get(self, name: str) -> int:
+        index = self.ids.get(name)
+        if index is None:
+            index = len(self.names)
+            self.names.append(name)
+            self.ids[name] = index
+        return index
+    def __len__(self) -> int:
+        return len(self.names)
+
+class StatsAggregator:
+    def __init__(self, path: str):
+        self.path = path
+        self.totalGames = 0
+        self.maps = IdTable()
+        self.players = IdTable()
+        # Indexed by civ id, as named the last time each was seen
+        self.godNames: typing.List[typing.Optional[str]] = []
+        self.godPicks = makeCounters()
+        # Times a player of civ a had an opponent of civ b, at matchups[a*matchupWidth + b]
+        self.matchupWidth = 0
+        self.matchups = makeCounters()
+        self.mapGames = makeCounters()
+        self.playerGames = makeCounters()
+        self.changed = False
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS totals (version INTEGER NOT NULL, totals TEXT NOT NULL)")
+        # Fingerprints of the games counted, and where the files they were counted from are now
+        self.db.execute("CREATE TABLE IF NOT EXISTS games (fingerprint TEXT PRIMARY KEY)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY)")
+        self.load()
+
+    def load(self):
+        row = self.db.execute("SELECT version, totals FROM totals").fetchone()
+        if row is None:
+            return
+        if row[0] != VERSION:
+            raise ValueError(f"{self.path} is stats version {row[0]}, only {VERSION} is supported")
+        saved = json.loads(row[1])
+        self.totalGames = saved["totalGames"]
+        self.maps = IdTable(saved["maps"])
+        self.players = IdTable(saved["players"])
+        self.godNames = saved["godNames"]
+        self.godPicks = makeCounters(saved["godPicks"])
+        self.matchupWidth = saved["matchupWidth"]
+        self.matchups = makeCounters(saved["matchups"])
+        self.mapGames = makeCounters(saved["mapGames"])
+        self.playerGames = makeCounters(saved["playerGames"])
+
+    def hasFile(self, filepath: str) -> bool:
+        return self.db.execute("SELECT 1 FROM files WHERE path = ?", (os.path.abspath(filepath),)).fetchone() is not None
+
+    def hasGame(self, gameId: str) -> bool:
+        return self.db.execute("SELECT 1 FROM games WHERE fingerprint = ?", (gameId,)).fetchone() is not None
+
+    def widenMatchups(self, civID: int):
+        "Make room in the matchup table for civ ids up to civID, keeping what is already counted"
+        if civID < self.matchupWidth:
+            return
+        width = max(civID + 1, self.matchupWidth*2, 16)
+        matchups = makeCounters()
+        growCounters(matchups, width*width)
+        for row in range(self.matchupWidth):
+            matchups[row*width:row*width+self.matchupWidth] = self.matchups[row*self.matchupWidth:(row+1)*self.matchupWidth]
+        self.matchups = matchups
+        self.matchupWidth = width
+
+    def add(self, gameId: str, filepath: str, mapName: typing.Optional[str], teams: Teams, godName: typing.Callable[[int], str]):
+        "Count a game, unless it has already been counted (when only where it was seen is remembered)"
+        self.db.execute("INSERT OR IGNORE INTO files (path) VALUES (?)", (os.path.abspath(filepath),))
+        self.changed = True
+        if self.db.execute("INSERT OR IGNORE INTO games (fingerprint) VALUES (?)", (gameId,)).rowcount == 0:
+            return
+        self.totalGames += 1
+        if mapName is not None:
+            mapID = self.maps.get(mapName)
+            growCounters(self.mapGames, mapID + 1)
+            self.mapGames[mapID] += 1
+        for team in teams:
+            for playerName, civID in team:
+                playerID = self.players.get(playerName)
+                growCounters(self.playerGames, playerID + 1)
+                self.playerGames[playerID] += 1
+                growCounters(self.godPicks, civID + 1)
+                self.godPicks[civID] += 1
+                while len(self.godNames) <= civID:
+                    self.godNames.append(None)
+                self.godNames[civID] = godName(civID)
+                self.widenMatchups(civID)
+        for teamIndex, team in enumerate(teams):
+            for otherTeam in teams[teamIndex+1:]:
+                for playerName, civID in team:
+                    for otherName, otherCivID in otherTeam:
+                        self.matchups[civID*self.matchupWidth + otherCivID] += 1
+                        self.matchups[otherCivID*self.matchupWidth + civID] += 1
+
+    def move(self, oldpath: str, newpath: str):
+        "Carry over where a counted file is after renaming it"
+        if self.db.execute("UPDATE OR REPLACE files SET path = ? WHERE path = ?", (os.path.abspath(newpath), os.path.abspath(oldpath))).rowcount > 0:
+            self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        saved = {"totalGames": self.totalGames, "maps": self.maps.names, "players": self.players.names, "godNames": self.godNames,
+                 "godPicks": self.godPicks.tolist(), "matchupWidth": self.matchupWidth, "matchups": self.matchups.tolist(),
+                 "mapGames": self.mapGames.tolist(), "playerGames": self.playerGames.tolist()}
+        # Committed along with the games and files added since the last save, so the totals never disagree with what has been counted
+        self.db.execute("DELETE FROM totals")
+        self.db.execute("INSERT INTO totals (version, totals) VALUES (?, ?)", (VERSION, json.dumps(saved, ensure_ascii=False)))
+        self.db.commit()
+        self.changed = False
+
+    def godName(self, civID: int) -> str:
+        name = self.godNames[civID] if civID < len(self.godNames) else None
+        return name if name is not None else f"Unk{civID}"
+
+    def report(self, top=20) -> typing.List[str]:
+        "A plain text summary of the totals, with the top most picked gods, most played maps and most active players"
+        lines = [f"{self.totalGames} games"]
+        totalPicks = sum(self.godPicks)
+        gods = sorted((civID for civID in range(len(self.godPicks)) if self.godPicks[civID] > 0), key=lambda civID: -self.godPicks[civID])[:top]
+        lines.append("God picks:")
+        for civID in gods:
+            lines.append(f"  {self.godName(civID):<12} {self.godPicks[civID]:7} ({self.godPicks[civID]/totalPicks*100:5.1f}% of picks)")
+        if len(gods) > 1:
+            lines.append("Matchups (times each row's god faced each column's):")
+            width = max(len(self.godName(civID)) for civID in gods) + 1
+            lines.append("  " + " "*width + "".join(f"{self.godName(civID):>{width}}" for civID in gods))
+            for civID in gods:
+                lines.append(f"  {self.godName(civID):<{width}}" + "".join(f"{self.matchups[civID*self.matchupWidth + otherCivID]:>{width}}" for otherCivID in gods))
+        lines.append("Maps:")
+        for mapID in sorted(range(len(self.mapGames)), key=lambda mapID: -self.mapGames[mapID])[:top]:
+            lines.append(f"  {self.maps.names[mapID]:<24} {self.mapGames[mapID]:7} ({self.mapGames[mapID]/self.totalGames*100:5.1f}% of games)")
+        lines.append("Most active players:")
+        for playerID in sorted(range(len(self.playerGames)), key=lambda playerID: -self.playerGames[playerID])[:top]:
+            lines.append(f"  {self.players.names[playerID]:<24} {self.playerGames[playerID]:7} games")
+        return lines
+
+    def close(self):
+        self.save()
+        self.db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Print the totals kept by recprocessor's [stats] option")
+    parser.add_argument("stats", nargs="?", default=DEFAULT_STATS_FILE)
+    parser.add_argument("--top", type=int, default=20, help="how many gods, maps and players to list")
+    args = parser.parse_args()
+    for line in StatsAggregator(args.stats).report(args.top):
+        print(line)
+
+if __name__ == "__main__":
+    main()
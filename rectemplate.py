@@ -0,0 +1,56 @@
+# The rename formats from the ini, parsed once per run into the literal text between fields and the fields themselves.
+# Naming a recorded game then only looks up the fields its format actually uses, and each of those only once,
+# so nothing a format doesn't mention (the teams, the file's creation date, extra metadata keys) has to be read or decoded.
+# Fields look like {NAME}, or {NAME:argument} for ones like KEY that need to be told which metadata key to use.
+# Each template becomes a str.format string with one argument per different field, so a field used twice is only looked up once.
+# Anything in {} that isn't a known field is left as it is, as it always has been.
+
+import re
+import typing
+
+FIELD_PATTERN = re.compile(r"\{([A-Z]+)(?::([^{}]*))?\}")
+
+class Field:
+    __slots__ = ("name", "argument")
+    def __init__(self, name: str, argument: typing.Optional[str]):
+        self.name = name
+        self.argument = argument
+    def key(self) -> typing.Tuple[str, typing.Optional[str]]:
+        return self.name, self.argument
+
+class Template:
+    def __init__(self, text: str, knownFields: typing.Collection[str]):
+        self.text = text
+        # Each different field, in the order they first come up
+        self.fields: typing.List[Field] = []
+        # The text with the fields swapped for their positions in fields, ready for str.format
+        formatParts = []
+        positions: typing.Dict[typing.Tuple[str, typing.Optional[str]], int] = {}
+        position = 0
+        for match in FIELD_PATTERN.finditer(text):
+            if match.group(1) not in knownFields:
+                continue
+            field = Field(match.group(1), match.group(2))
+            if field.key() not in positions:
+                positions[field.key()] = len(self.fields)
+                self.fields.append(field)
+            formatParts.append(escape(text[position:match.start()]))
+            formatParts.append(f"{{{positions[field.key()]}}}")
+            position = match.end()
+        formatParts.append(escape(text[position:]))
+        self.format = "".join(formatParts)
+
+    def uses(self, name: str) -> bool:
+        return any(field.name == name for field in self.fields)
+
+    def arguments(self, name: str) -> typing.List[str]:
+        "What each use of a field was given, eg the metadata key names for KEY"
+        return [field.argument for field in self.fields if field.name == name and field.argument is not None]
+
+    def render(self, values: typing.Sequence[str]) -> str:
+        "Fill in the fields, given the value of each of fields in order"
+        return self.format.format(*values)
+
+def escape(text: str) -> str:
+    "Make literal text safe to put in a str.format string"
+    return text.replace("{", "{{").replace("}", "}}")
@@ -0,0 +1,110 @@
+# Finds recorded games in the replay folders with os.scandir, using the file type information that comes with each directory entry
+# so nothing needs stat-ing just to tell files from folders, and files are filtered by name before anything else is looked at.
+# Folders can be pruned by depth, name, being hidden or being OutputXmb's output, and (given somewhere to remember them)
+# folders that had nothing to process last time are skipped while their mtime stays the same.
+
+import fnmatch
+import os
+import stat
+import time
+import typing
+
+# Folders modified this recently might still have files arriving within the same mtime tick, so aren't remembered as unchanged
+RACY_MTIME_NS = 2*1000*1000*1000
+XML_OUTPUT_SUFFIX = ".mythrec_xml"
+
+# (name, hidden) for each subfolder of a remembered folder
+RememberedSubfolders = typing.List[typing.Tuple[str, bool]]
+
+class FolderState(typing.Protocol):
+    def lookupFolder(self, path: str) -> typing.Optional[typing.Tuple[int, RememberedSubfolders]]: ...
+    def storeFolder(self, path: str, mtime: int, subfolders: RememberedSubfolders): ...
+    def forgetFolder(self, path: str): ...
+
+class MemoryFolderState:
+    "A FolderState that only lasts for the run, for walking the same folders over and over like watch mode does"
+    def __init__(self):
+        self.folders: typing.Dict[str, typing.Tuple[int, RememberedSubfolders]] = {}
+    def lookupFolder(self, path: str) -> typing.Optional[typing.Tuple[int, RememberedSubfolders]]:
+        return self.folders.get(path)
+    def storeFolder(self, path: str, mtime: int, subfolders: RememberedSubfolders):
+        self.folders[path] = (mtime, subfolders)
+    def forgetFolder(self, path: str):
+        self.folders.pop(path, None)
+
+def isHidden(entry: os.DirEntry) -> bool:
+    if entry.name.startswith("."):
+        return True
+    # The attribute only exists on Windows, where stat() comes free with the directory listing
+    if os.name != "nt":
+        return False
+    attributes = getattr(entry.stat(follow_symlinks=False), "st_file_attributes", 0)
+    return bool(attributes & getattr(stat, "FILE_ATTRIBUTE_HIDDEN", 0))
+
+class FolderWalker:
+    def __init__(self, wanted: typing.Callable[[str], bool], recursive=False, maxDepth=0, excludes: typing.Iterable[str]=(), skipHidden=True, skipXmlOutput=True,
+                 folderState: typing.Optional[FolderState]=None):
+        "wanted should only look at the path, it gets called before anything is known about the file besides its name"
+        self.wanted = wanted
+        self.recursive = recursive
+        # 0 for no limit
+        self.maxDepth = maxDepth
+        self.excludes = [exclude.lower() for exclude in excludes]
+        self.skipHidden = skipHidden
+        self.skipXmlOutput = skipXmlOutput
+        self.folderState = folderState
+        self.foldersSkipped = 0
+
+    def shouldEnter(self, name: str, hidden: bool, depth: int) -> bool:
+        "Whether to look inside a subfolder called name, which would be depth folders below where the walk started"
+        if not self.recursive:
+            return False
+        if self.maxDepth > 0 and depth > self.maxDepth:
+            return False
+        if self.skipHidden and hidden:
+            return False
+        if self.skipXmlOutput and name.endswith(XML_OUTPUT_SUFFIX):
+            return False
+        lowered = name.lower()
+        return not any(fnmatch.fnmatchcase(lowered, exclude) for exclude in self.excludes)
+
+    def walk(self, folder: str) -> typing.Iterator[os.DirEntry]:
+        "Yield the wanted files under folder, each folder's files before its subfolders, like os.walk"
+        stack = [(folder, 0)]
+        while len(stack) > 0:
+            path, depth = stack.pop()
+            mtime = None
+            if self.folderState is not None:
+                try:
+                    mtime = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                remembered = self.folderState.lookupFolder(path)
+                if remembered is not None and remembered[0] == mtime:
+                    self.foldersSkipped += 1
+                    stack.extend((os.path.join(path, name), depth+1) for name, hidden in reversed(remembered[1]) if self.shouldEnter(name, hidden, depth+1))
+                    continue
+            try:
+                # Listed in full first, as the files are likely to be renamed while this is being iterated
+                with os.scandir(path) as iterator:
+                    entries = list(iterator)
+            except OSError:
+                continue
+            files = []
+            subfolders: RememberedSubfolders = []
+            for entry in entries:
+                try:
+                    if self.wanted(entry.path) and entry.is_file():
+                        files.append(entry)
+                    elif entry.is_dir(follow_symlinks=False):
+                        subfolders.append((entry.name, isHidden(entry)))
+                except OSError:
+                    # Gone since the folder was listed
+                    continue
+            if self.folderState is not None:
+                if len(files) == 0 and time.time_ns() - mtime > RACY_MTIME_NS:
+                    self.folderState.storeFolder(path, mtime, subfolders)
+                elif remembered is not None:
+                    self.folderState.forgetFolder(path)
+            yield from files
+            stack.extend((os.path.join(path, name), depth+1) for name, hidden in reversed(subfolders) if self.shouldEnter(name, hidden, depth+1))
@@ -0,0 +1,122 @@
+# Keeps track of the recorded games in the replay folders between polls, for watch mode.
+# The game writes a recorded game out over a while, so a new (or changed) file is only handed back once its size and mtime
+# have stayed the same for settleSeconds. Files that have been dealt with are remembered, so each poll only does work for new files.
+# Given a walker with a FolderState, folders with nothing to process are only listed again once their mtime changes, and files that failed
+# too many times aren't stat-ed again until something in their folder changes.
+
+import os
+import time
+import typing
+import recwalk
+
+# Times to try a recorded game that failed to process (it might have still been open in the game) before leaving it alone until it changes
+MAX_ATTEMPTS = 3
+
+# (size, mtime in ns)
+FileState = typing.Tuple[int, int]
+
+class PendingFile:
+    __slots__ = ("state", "since", "attempts")
+    def __init__(self, state: FileState, since: float, attempts=0):
+        self.state = state
+        self.since = since
+        self.attempts = attempts
+
+def getMtime(path: str) -> typing.Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class FolderWatcher:
+    def __init__(self, dirs: typing.List[str], walker: recwalk.FolderWalker, settleSeconds: float):
+        self.dirs = dirs
+        self.walker = walker
+        self.settleSeconds = settleSeconds
+        # Files that have been processed (or were there before watching started), as they were at the time
+        self.known: typing.Dict[str, FileState] = {}
+        # New or changed files waiting to stop changing
+        self.pending: typing.Dict[str, PendingFile] = {}
+        # Files that failed MAX_ATTEMPTS times -> the mtime of their folder at the time
+        self.givenUp: typing.Dict[str, int] = {}
+
+    def scan(self) -> typing.Dict[str, FileState]:
+        found: typing.Dict[str, FileState] = {}
+        # Folder -> its mtime (None if that couldn't be found), for the folders of files given up on
+        folderMtimes: typing.Dict[str, typing.Optional[int]] = {}
+        for folder in self.dirs:
+            if not os.path.isdir(folder):
+                continue
+            for entry in self.walker.walk(folder):
+                givenUpAt = self.givenUp.get(entry.path)
+                if givenUpAt is not None:
+                    parent = os.path.dirname(entry.path)
+                    if parent not in folderMtimes:
+                        folderMtimes[parent] = getMtime(parent)
+                    if folderMtimes[parent] == givenUpAt:
+                        found[entry.path] = self.known[entry.path]
+                        continue
+                    del self.givenUp[entry.path]
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Deleted or renamed since the folder was listed
+                    continue
+                found[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return found
+
+    def snapshot(self):
+        "Remember every file there now, so only ones that appear or change later are returned by poll"
+        self.known = self.scan()
+        self.pending = {}
+
+    def poll(self) -> typing.List[str]:
+        "Return the files that are new or changed since they were last seen and have since stopped changing"
+        now = time.monotonic()
+        found = self.scan()
+        for filepath in [filepath for filepath in self.known if filepath not in found]:
+            del self.known[filepath]
+            self.givenUp.pop(filepath, None)
+        for filepath in [filepath for filepath in self.pending if filepath not in found]:
+            del self.pending[filepath]
+        ready = []
+        for filepath, state in found.items():
+            if self.known.get(filepath) == state:
+                continue
+            pending = self.pending.get(filepath)
+            if pending is None:
+                self.pending[filepath] = PendingFile(state, now)
+            elif pending.state != state:
+                # Still being written, start waiting again
+                pending.state = state
+                pending.since = now
+            elif now - pending.since >= self.settleSeconds:
+                ready.append(filepath)
+        return ready
+
+    def processed(self, filepath: str, newfilepath: typing.Optional[str]):
+        "Record that filepath was processed and is now called newfilepath, or with None that processing it failed"
+        pending = self.pending.pop(filepath, None)
+        self.givenUp.pop(filepath, None)
+        if newfilepath is not None:
+            self.known.pop(filepath, None)
+            try:
+                stat = os.stat(newfilepath)
+            except OSError:
+                return
+            self.known[newfilepath] = (stat.st_size, stat.st_mtime_ns)
+            return
+        attempts = 1 if pending is None else pending.attempts + 1
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return
+        state = (stat.st_size, stat.st_mtime_ns)
+        if attempts >= MAX_ATTEMPTS:
+            self.known[filepath] = state
+            folderMtime = getMtime(os.path.dirname(filepath))
+            if folderMtime is not None:
+                self.givenUp[filepath] = folderMtime
+        else:
+            self.known.pop(filepath, None)
+            self.pending[filepath] = PendingFile(state, time.monotonic(), attempts)
@@ -8,69 +8,116 @@ import xml.etree.ElementTree as ET
 class XMBError(Exception):
     pass
 
-def readUint32(stream: typing.BinaryIO) -> int:
-    return struct.unpack("<i", stream.read(4))[0]
+# (event, tag, attributes, text): "start" events carry the element's attributes and text, "end" events just the tag
+XMBEvent = typing.Tuple[str, str, typing.Optional[typing.Dict[str, str]], typing.Optional[str]]
 
-def readUtf16(stream: typing.BinaryIO) -> str:
-    length = readUint32(stream)
-    s = stream.read(length*2).decode("utf-16-le")
-    return s
+def unpackUint32(data: memoryview, offset: int) -> typing.Tuple[int, int]:
+    return struct.unpack_from("<i", data, offset)[0], offset+4
 
-def parseXMBStream(stream: typing.BinaryIO) -> ET.Element:
-    header = stream.read(2)
-    if header != b"X1":
-        raise XMBError(f"Bad X1 header at {stream.tell()}: got {header.decode(errors='replace')}")
-    dataLength = readUint32(stream)
-    unk1 = stream.read(2)
-    if unk1 != b"XR":
-        raise XMBError(f"Bad XR header at {stream.tell()}: got {unk1.decode(errors='replace')}")
-    unk2 = readUint32(stream)
-    if unk2 != 4:
-        raise XMBError(f"Bad unk2 at {stream.tell()}: got {unk2}, expected 4")
-    version = readUint32(stream)
-    if version != 8:
-        raise XMBError(f"Bad version at {stream.tell()}: got {version}, expected 8")
-    numElements = readUint32(stream)
-    elements: typing.List[str] = []
-    for x in range(0, numElements):
-        elements.append(readUtf16(stream))
-    numAttributes = readUint32(stream)
-    attributes: typing.List[str] = []
-    for x in range(0, numAttributes):
-        attributes.append(readUtf16(stream))
-    root = parseNodeRecursive(stream, None, elements, attributes)
-    tree = ET.ElementTree(root)
-    ET.indent(tree)
-    return tree
+def unpackUtf16(data: memoryview, offset: int) -> typing.Tuple[str, int]:
+    length, offset = unpackUint32(data, offset)
+    end = offset+length*2
+    if end > len(data):
+        raise XMBError(f"String of {length} characters at {offset} runs past the end of the data")
+    return str(data[offset:end], "utf-16-le"), end
+
+class XMBReader:
+    "Reads an XMB straight out of a buffer without recursing or copying it. Nothing past the header is read until events() is iterated"
+    def __init__(self, data: typing.Union[bytes, memoryview], offset=0):
+        self.data = memoryview(data)
+        data = self.data
+        header = bytes(data[offset:offset+2])
+        if header != b"X1":
+            raise XMBError(f"Bad X1 header at {offset}: got {header.decode(errors='replace')}")
+        self.dataLength = struct.unpack_from("<i", data, offset+2)[0]
+        offset += 6
+        unk1 = bytes(data[offset:offset+2])
+        if unk1 != b"XR":
+            raise XMBError(f"Bad XR header at {offset}: got {unk1.decode(errors='replace')}")
+        unk2, offset = unpackUint32(data, offset+2)
+        if unk2 != 4:
+            raise XMBError(f"Bad unk2 at {offset}: got {unk2}, expected 4")
+        version, offset = unpackUint32(data, offset)
+        if version != 8:
+            raise XMBError(f"Bad version at {offset}: got {version}, expected 8")
+        numElements, offset = unpackUint32(data, offset)
+        self.elements: typing.List[str] = []
+        for x in range(0, numElements):
+            element, offset = unpackUtf16(data, offset)
+            self.elements.append(element)
+        numAttributes, offset = unpackUint32(data, offset)
+        self.attributes: typing.List[str] = []
+        for x in range(0, numAttributes):
+            attribute, offset = unpackUtf16(data, offset)
+            self.attributes.append(attribute)
+        self.rootOffset = offset
+        # Offset just past the last node, set once events() has been run to the end
+        self.end: typing.Optional[int] = None
 
-def parseNodeRecursive(stream: typing.BinaryIO, parent: typing.Union[None, ET.Element], elements: typing.List[str], attributes: typing.List[str]) -> ET.Element:
-    header = stream.read(2)
-    if header == b"XN":
-        unk = stream.read(4)
-        innerText = readUtf16(stream)
-        nameID = readUint32(stream)
-        name = elements[nameID]
-        unk2 = stream.read(4)
-        numAttribs = readUint32(stream)
-        attribs: typing.Dict[str, str] = {}
-        for x in range(0, numAttribs):
-            attribID = readUint32(stream)
-            attribName = attributes[attribID]
-            attribValue = readUtf16(stream)
-            attribs[attribName] = attribValue
+    def events(self) -> typing.Iterator[XMBEvent]:
+        "Yield iterparse-style (event, tag, attributes, text) tuples for every node, in document order"
+        data = self.data
+        offset = self.rootOffset
+        # [tag, children still to read] for each element that has been started but not ended
+        openElements: typing.List[list] = []
+        while True:
+            header = bytes(data[offset:offset+2])
+            if header != b"XN":
+                raise XMBError(f"Bad XN header at {offset}: got {header.decode(errors='replace')}")
+            # 4 unknown bytes after the header, and another 4 after the name
+            innerText, offset = unpackUtf16(data, offset+6)
+            nameID, offset = unpackUint32(data, offset)
+            name = self.elements[nameID]
+            numAttribs, offset = unpackUint32(data, offset+4)
+            attribs: typing.Dict[str, str] = {}
+            for x in range(0, numAttribs):
+                attribID, offset = unpackUint32(data, offset)
+                attribs[self.attributes[attribID]], offset = unpackUtf16(data, offset)
+            numChildren, offset = unpackUint32(data, offset)
+            yield ("start", name, attribs, innerText)
+            if numChildren > 0:
+                openElements.append([name, numChildren])
+                continue
+            yield ("end", name, None, None)
+            # Close every element whose last child this was
+            while len(openElements) > 0:
+                openElements[-1][1] -= 1
+                if openElements[-1][1] > 0:
+                    break
+                yield ("end", openElements.pop()[0], None, None)
+            if len(openElements) == 0:
+                self.end = offset
+                return
 
-        if parent is None:
-            newparent = ET.Element(name, attribs)
+def iterparseXMB(data: typing.Union[bytes, memoryview], offset=0) -> typing.Iterator[XMBEvent]:
+    return XMBReader(data, offset).events()
+
+def buildTree(events: typing.Iterable[XMBEvent]) -> ET.ElementTree:
+    root = None
+    stack: typing.List[ET.Element] = []
+    for event, tag, attribs, text in events:
+        if event == "start":
+            if len(stack) == 0:
+                element = ET.Element(tag, attribs)
+            else:
+                element = ET.SubElement(stack[-1], tag, attribs)
+            element.text = text
+            stack.append(element)
         else:
-            newparent = ET.SubElement(parent, name, attribs)
-        newparent.text = innerText
+            root = stack.pop()
+    return ET.ElementTree(root)
 
-        numChildren = readUint32(stream)
-        for x in range(0, numChildren):
-            parseNodeRecursive(stream, newparent, elements, attributes)
-            
-        return newparent
-                
+def parseXMBStream(stream: typing.BinaryIO, indent=True) -> ET.ElementTree:
+    "Parse the XMB at the current position of stream into an ElementTree, leaving the stream just after it"
+    start = stream.tell()
+    if hasattr(stream, "getbuffer"):
+        data = stream.getbuffer()[start:]
     else:
-        raise XMBError(f"Bad XR header in parseNodeRecursive at {stream.tell()}: got {header.decode(errors='replace')}")
-        
+        data = memoryview(stream.read())
+    reader = XMBReader(data)
+    tree = buildTree(reader.events())
+    stream.seek(start + reader.end)
+    # Only worth doing if the xml is going to be read by a person
+    if indent:
+        ET.indent(tree)
+    return tree